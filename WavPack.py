@@ -11,27 +11,80 @@
 **
 """
 
-import sys
+import os
+import bisect
+import struct
+import hashlib
+import tempfile
+import mmap
+import io
+import multiprocessing
+from collections import deque
+from array import array
 
-# Change the following value to an even number to reflect the maximum number of samples to be processed
-# per call to WavpackUnpackSamples()
+# NumPy is optional; it is needed for WavpackUnpackNumpy() and
+# WavpackUnpackInto(), and when present is also used to check block crcs
+# and for the last steps of unpacking (see finish_samples_numpy())
+
+try :
+    import numpy
+except ImportError :
+    numpy = None
+
+# Number of complete samples WvDemo.py asks for per call to
+# WavpackUnpackSamples() (any number can be asked for), and the initial size
+# of the temp buffer used when unpacking into something other than a list
+
+SAMPLE_BUFFER_SIZE = 4096
+
+# Seek index files are normally kept next to the WavPack file they describe
+# (with ".wvidx" appended to its name). Set this to a directory to keep them
+# all in one shared place instead.
+
+INDEX_CACHE_DIR = None
+
+# Number of bytes of a block WavpackProbe() reads at a time while looking
+# through its metadata, which is normally all there in the first read
+
+PROBE_READ_SIZE = 1024
+
+# Number of bytes read at a time, going backwards from the end of the file,
+# when looking for the last block header (see find_final_index())
+
+TAIL_SCAN_SIZE = 4096
+
+# array typecode of 32-bit ints, used to send decoded samples back from the
+# WavpackUnpackParallel() workers
+
+if array('i').itemsize == 4 :
+    INT32_TYPECODE = 'i'
+else :
+    INT32_TYPECODE = 'l'
 
-SAMPLE_BUFFER_SIZE = 256
 FALSE = 0
 TRUE = 1
 
+# The decorrelation passes of a block are normally applied together, one
+# sample at a time, by a function built for the block's list of terms (see
+# get_fused_decorr()). Set this to FALSE to apply them one pass at a time
+# over the whole buffer instead, as the C code does (with the kernels from
+# get_decorr_kernel()). The choice is made as each block is read (see
+# select_decorr()).
+
+DECORR_FUSED = TRUE
+
 BYTES_STORED = 3;       # 1-4 bytes/sample
 MONO_FLAG  = 4;       # not stereo
 HYBRID_FLAG = 8;       # hybrid mode
 FALSE_STEREO = 0x40000000;      # block is stereo, but data is mono
 
 SHIFT_LSB = 13;
-SHIFT_MASK = (0x1fL << SHIFT_LSB);
+SHIFT_MASK = (0x1f << SHIFT_LSB);
 
 FLOAT_DATA  = 0x80;    # ieee 32-bit floating point data
 
 SRATE_LSB = 23;
-SRATE_MASK = (0xfL << SRATE_LSB);
+SRATE_MASK = (0xf << SRATE_LSB);
 
 FINAL_BLOCK = 0x1000;  # final block of multichannel segment
 
@@ -80,7 +133,7 @@ MAX_NTERMS = 16;
 MAX_TERM = 8;
 
 MAG_LSB = 18;
-MAG_MASK = (0x1fL << MAG_LSB);
+MAG_MASK = (0x1f << MAG_LSB);
 
 ID_RIFF_HEADER   = 0x21;
 ID_RIFF_TRAILER  = 0x22;
@@ -122,9 +175,42 @@ MODE_VALID_TAG  = 0x10;
 MODE_HIGH       = 0x20;
 MODE_FAST       = 0x40;
 
+OPEN_CACHE_INDEX = 0x1;    # save / reuse the seek index in a sidecar file
+OPEN_TAIL_SCAN = 0x2;      # find an unknown length from the last block header
+
+# crc checking modes for WavpackSetCrcMode()
+
+CRC_STRICT = 0;      # crc is updated as samples are decoded (default)
+CRC_DEFERRED = 1;    # samples are saved and the crc done at the end of the block
+CRC_DISABLED = 2;    # crcs are neither calculated nor checked
+
+# layout of the 32-byte block header, used to rebuild the header of a block
+# handed to another process
+
+WAVPACK_HEADER_FORMAT = '<4sIHBBIIIII'
+
+INDEX_FILE_ID = b'wvix'
+INDEX_FILE_VERSION = 1
+INDEX_HEADER_FORMAT = '<4sHHQdI20s'
 
 sample_rates = (6000, 8000, 9600, 11025, 12000, 16000, 22050, 24000, 32000, 44100, 48000, 64000, 88200, 96000, 192000)
 
+# range of the values of lossy samples for each number of bytes stored, as
+# (min, max); fixup_samples() clips to these
+
+hybrid_limits = ((-128, 127), (-32768, 32767), (-8388608, 8388607), (-0x80000000, 0x7FFFFFFF))
+
+# flags of the blocks where unpack_samples() has more to do after the
+# decorrelation than check the samples, so finish_samples_numpy() is used
+
+NUMPY_FINISH_FLAGS = JOINT_STEREO | FLOAT_DATA | INT32_DATA | HYBRID_FLAG | FALSE_STEREO | SHIFT_MASK
+
+# values after decorrelation larger than this are left to the list code, so
+# that the 64-bit NumPy arithmetic can't overflow (only a corrupt block gets
+# values anything like this large)
+
+NUMPY_VALUE_LIMIT = 1 << 60
+
 
 LIMIT_ONES = 16  # maximum consecutive 1s sent for "div" data
 
@@ -200,15 +286,36 @@ exp2_table = (
 
 
 
-ones_count_table = (
-0,1,0,2,0,1,0,3,0,1,0,2,0,1,0,4,0,1,0,2,0,1,0,3,0,1,0,2,0,1,0,5,
-0,1,0,2,0,1,0,3,0,1,0,2,0,1,0,4,0,1,0,2,0,1,0,3,0,1,0,2,0,1,0,6,
-0,1,0,2,0,1,0,3,0,1,0,2,0,1,0,4,0,1,0,2,0,1,0,3,0,1,0,2,0,1,0,5,
-0,1,0,2,0,1,0,3,0,1,0,2,0,1,0,4,0,1,0,2,0,1,0,3,0,1,0,2,0,1,0,7,
-0,1,0,2,0,1,0,3,0,1,0,2,0,1,0,4,0,1,0,2,0,1,0,3,0,1,0,2,0,1,0,5,
-0,1,0,2,0,1,0,3,0,1,0,2,0,1,0,4,0,1,0,2,0,1,0,3,0,1,0,2,0,1,0,6,
-0,1,0,2,0,1,0,3,0,1,0,2,0,1,0,4,0,1,0,2,0,1,0,3,0,1,0,2,0,1,0,5,
-0,1,0,2,0,1,0,3,0,1,0,2,0,1,0,4,0,1,0,2,0,1,0,3,0,1,0,2,0,1,0,8)
+# get_words() decodes the unary prefix of each word with a single lookup in
+# unary_table, indexed by the holding_one state shifted up by
+# UNARY_PEEK_BITS plus that many of the next bits in the stream. Each entry
+# is (ones_count, bits used, new holding_one) with the holding_one
+# adjustment already applied, or None if the bits are all 1s, in which case
+# the run is counted the long way.
+
+UNARY_PEEK_BITS = 12
+UNARY_PEEK_MASK = (1 << UNARY_PEEK_BITS) - 1
+
+# Bits get_words() makes sure it has in its window before each word: the
+# peek, up to 32 bits for the value (or for the bisection of a hybrid one)
+# and the sign bit
+
+WORD_BITS = UNARY_PEEK_BITS + 32 + 1
+
+def make_unary_table() :
+    table = []
+
+    for holding_one in range(2) :
+        for peek in range(1 << UNARY_PEEK_BITS) :
+            if (peek == UNARY_PEEK_MASK) :
+                table.append(None)
+            else :
+                ones = (~peek & (peek + 1)).bit_length() - 1
+                table.append(((ones >> 1) + holding_one, ones + 1, ones & 1))
+
+    return tuple(table)
+
+unary_table = make_unary_table()
 
 
 class entropy_data :
@@ -255,7 +362,7 @@ class WavpackHeader :
 class WavpackMetadata :
     def __init__(self):
         self.byte_length = 0
-        self.data = [0] * 1024
+        self.data = None        # memoryview slice of the block buffer
         self.id = 0
         self.hasdata = 0;    # 0 does not have data, 1 has data
         self.status = 0;    # 0 ok, 1 error
@@ -271,22 +378,25 @@ class WavpackConfig :
 
 class Bitstream :
     def __init__(self):
-        self.end = 0
-        self.ptr = 0
-        self.file_bytes = 0
-        self.sr = 0
+        self.words = None       # the whole bitstream as 32-bit words
+        self.word_index = 0     # next word to be loaded into sr
+        self.sr = 0             # bits loaded but not yet used, next bit lowest
+        self.bc = 0             # number of bits in sr
         self.error = 0
-        self.bc = 0
-        self.file = None;
-        self.bitval = 0;
-        self.buf = [0] * 1024
-        self.buf_index = 0
 
 class WavpackStream:
     def __init__(self):
         self.wphdr = WavpackHeader()
         self.wvbits = Bitstream()
         self.w = words_data()
+        self.blockbuff = None       # contents of the current block after the header
+        self.blockbuff_index = 0    # offset of the next metadata sub-block in it
+        self.crc_mode = CRC_STRICT
+        self.crc_values = []
+        self.first_channel = 0      # number of the block's first channel in the file
+        self.skipped = FALSE        # TRUE if none of the block's channels are decoded
+        self.fused_decorr = None    # function applying the block's passes together, if used
+        self.decorr_kernels = []    # otherwise the kernel for each of its passes
 
         num_terms = 0
         mute_error = 0
@@ -321,42 +431,128 @@ class WavpackStream:
 
         self.decorr_passes =  [dp1, dp2, dp3, dp4, dp5, dp6, dp7, dp8, dp9, dp10, dp11, dp12, dp13, dp14, dp15, dp16]
 
+# Table of the blocks in a file that start a multichannel segment (these are
+# the only ones that can be seeked to), as parallel lists kept in file order.
+
+class WavpackBlockIndex :
+    def __init__(self):
+        self.block_index = []
+        self.block_samples = []
+        self.offset = []
+
+# File information returned by WavpackProbe(). It also has the "config" and
+# "lossy_blocks" of a context, so that the metadata readers and
+# WavpackGetMode() can be used to fill it in.
+
+class WavpackProbeInfo :
+    def __init__(self):
+        self.error = FALSE
+        self.error_message = ""
+        self.sample_rate = 0
+        self.num_channels = 0
+        self.channel_mask = 0
+        self.bytes_per_sample = 0
+        self.bits_per_sample = 0
+        self.total_samples = -1     # -1 if unknown
+        self.duration = -1.0        # seconds, -1.0 if unknown
+        self.mode = 0               # MODE_xxx flags, as from WavpackGetMode()
+        self.version = 0            # stream version from the block header
+        self.config = WavpackConfig()
+        self.lossy_blocks = 0
+
 class WavpackContext:
     def __init__(self):
         self.config = WavpackConfig()
         self.stream = WavpackStream()
-        self.READ_BUFFER_SIZE = 1024
-
-        self.read_buffer = [0] * self.READ_BUFFER_SIZE
+        self.streams = [self.stream]    # one per block of a multichannel segment
+        self.num_streams = 1            # streams used by the current segment
+        self.segment_pending = FALSE    # TRUE until the segment's final block is read
+        self.pending_header = None      # packed header of a block read but not used yet
+        self.channel_select = 0         # channel mask asked for on open, 0 for all
+        self.channel_map = None         # column in the output of each channel, or -1
+        self.metadata_handlers = metadata_handlers  # shared until given its own handlers
+        self.seek_index = None
+        self.temp_buffer = [0] * SAMPLE_BUFFER_SIZE
         self.error_message = ""
         self.error = FALSE
         self.infile = 0
+        self.input_buffer = None    # bytes fed to a push decoder, not yet decoded
+        self.bytes_skipped = 0      # bytes of the fed data skipped looking for a block
+        self.stream_started = FALSE # TRUE once the first block with audio has been read
         self.total_samples = 0
         self.crc_errors = 0
         self.first_flags = 0        
         self.open_flags = 0
+        self.crc_mode = CRC_STRICT
         self.norm_offset = 0
         self.reduced_channels = 0
         self.lossy_blocks = 0
+        self.float_bits = FALSE     # float blocks give IEEE bits (see float_bits_values())
         self.status = 0;    # 0 ok, 1 error
 
-class case_selector(Exception):
-   def __init__(self, value): # overridden to ensure we've got a value argument
-      Exception.__init__(self, value)
+# File-like wrapper for a memory-mapped WavPack file (see WavpackOpenFileMmap).
+# Reading just hands out slices of the mapping at the current offset, which
+# are memoryviews and so are not copied (Python 2 can't make a memoryview of
+# an mmap, so there the slices are copies). Closing it unmaps the file and
+# closes the file it was mapped from; it can also be used in a with
+# statement. unmap() releases just the mapping, leaving the file open.
+
+class MappedFile :
+    def __init__(self, infile, mapping):
+        self.infile = infile
+        self.mapping = mapping
+        self.position = 0
+        self.name = getattr(infile, 'name', None)
+
+        try :
+            self.view = memoryview(mapping)
+        except TypeError :
+            self.view = mapping
+
+    def read(self, size = -1):
+        start = min(self.position, len(self.mapping))
+
+        if (size < 0) :
+            self.position = len(self.mapping)
+        else :
+            self.position = min(start + size, len(self.mapping))
+
+        return self.view[start:self.position]
+
+    def seek(self, offset, whence = 0):
+        if (whence == 1) :
+            offset += self.position
+        elif (whence == 2) :
+            offset += len(self.mapping)
+
+        self.position = max(offset, 0)
+
+    def tell(self):
+        return self.position
+
+    def fileno(self):
+        return self.infile.fileno()
+
+    def unmap(self):
+        if (self.view is not self.mapping) :
+            self.view.release()
+
+        # a slice somebody still holds keeps the mapping open until it's freed
 
-def switch(variable):
-   raise case_selector(variable)
+        try :
+            self.mapping.close()
+        except BufferError :
+            pass
 
-def case(value):
-   exclass, exobj, tb = sys.exc_info()
-   if exclass is case_selector and exobj.args[0] == value: return exclass
-   return None
+    def close(self):
+        self.unmap()
+        self.infile.close()
 
-def multicase(*values):
-   exclass, exobj, tb = sys.exc_info()
-   if exclass is case_selector and exobj.args[0] in values: return exclass
-   return None
+    def __enter__(self):
+        return self
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 # This function reads data from the specified stream in search of a valid
 # WavPack 4.0 audio block. If this fails in 1 megabyte (or an invalid or
@@ -366,77 +562,229 @@ def multicase(*values):
 # functions in this module). This can be initiated at the beginning of a
 # WavPack file, or anywhere inside a WavPack file. To determine the exact
 # position within the file use WavpackGetSampleIndex().  Also,
-# this function will not handle "correction" files, plays only the first
-# two channels of multi-channel files, and is limited in resolution in some
-# large integer or floating point files (but always provides at least 24 bits
-# of resolution).
-
-def WavpackOpenFileInput(infile):
+# this function will not handle "correction" files, and is limited in
+# resolution in some large integer or floating point files (but always
+# provides at least 24 bits of resolution). All the channels of
+# multi-channel files are decoded. The optional flags are a combination of
+# the OPEN_xxx values above; with OPEN_TAIL_SCAN the length of a seekable
+# file whose header doesn't give it is found from the end of the file. To
+# decode only some of the channels, give their bits in "channel_mask" (as
+# in WavpackGetChannelMask()); the blocks holding only other channels are
+# then skipped without being decoded. "handlers" is an optional dict of
+# metadata handlers for this context, by id, set up as with
+# WavpackSetMetadataHandler() before the first block is read, so that they
+# also see the metadata of the first block (such as ID_RIFF_HEADER,
+# ID_REPLAY_GAIN and ID_MD5_CHECKSUM).
+
+def WavpackOpenFileInput(infile, flags = 0, channel_mask = 0, handlers = None):
     wpc = WavpackContext();
-    wps = wpc.stream;
 
     wpc.infile = infile;
     wpc.total_samples = -1;
     wpc.norm_offset = 0;
-    wpc.open_flags = 0;
+    wpc.open_flags = flags;
+    wpc.channel_select = channel_mask;
+    set_metadata_handlers(wpc, handlers)
+
+    if (open_stream(wpc) == FALSE and wpc.error == FALSE) :
+        wpc.error_message = "not compatible with this version of WavPack file!";
+        wpc.error = TRUE;
+
+    if (wpc.error == FALSE and wpc.total_samples == -1 and (flags & OPEN_TAIL_SCAN) != 0) :
+        wpc.total_samples = find_final_index(infile)
+
+    return wpc
 
 
-    # open the source file for reading and store the size
+# Create a push decoder, which is a context that isn't tied to a file.
+# Instead the WavPack data is handed to WavpackFeed() in chunks of any
+# size as it arrives (from a socket, a queue or a blob in memory) and each
+# call returns the audio from the blocks completed by it. Nothing is read
+# by the decoder itself, and at most one incomplete block is buffered. The
+# file information functions (WavpackGetNumChannels() etc.) are valid once
+# a call to WavpackFeed() has returned with wpc.stream_started set. The
+# arguments are the same as for WavpackOpenFileInput().
+
+def WavpackOpenDecoder(flags = 0, channel_mask = 0, handlers = None):
+    wpc = WavpackContext();
+
+    wpc.input_buffer = bytearray()
+    wpc.total_samples = -1;
+    wpc.open_flags = flags;
+    wpc.channel_select = channel_mask;
+    set_metadata_handlers(wpc, handlers)
+
+    return wpc
+
+
+# Add the next chunk of WavPack data to a push decoder and return a list
+# of the interleaved samples (in the same form as WavpackUnpackSamples())
+# decoded from the blocks it completed, which may be empty. Errors are
+# reported in the context as usual; data that doesn't contain a valid
+# block within 1 megabyte is an error, after which nothing is decoded.
+# An incomplete block left over when the data ends is never decoded.
+
+def WavpackFeed(wpc, data) :
+    if (wpc.stream_started == FALSE) :
+        if (wpc.error == TRUE) :
+            return []
+
+        wpc.input_buffer += data
+
+        if (open_stream(wpc) == FALSE) :
+            return []
+    else :
+        wpc.input_buffer += data
+
+    wps = wpc.stream
+    num_channels = WavpackGetReducedChannels(wpc)
+    samples = []
+
+    while (next_block(wpc) == TRUE) :
+        if (wps.sample_index < wps.wphdr.block_index) :
+            count = wps.wphdr.block_index - wps.sample_index
+        else :
+            count = wps.wphdr.block_index + wps.wphdr.block_samples - wps.sample_index
+
+        buffer = [0] * (count * num_channels)
+        count = unpack_to_buffer(wpc, buffer, count)
+
+        if (count == 0) :
+            break
+
+        samples += buffer[0:count * num_channels]
+
+    return samples
+
+
+# Read blocks until the first one containing audio has been unpacked and
+# set up the file information from it. Returns FALSE if that couldn't be
+# done, which for a push decoder may just mean it needs more data.
+
+def open_stream(wpc) :
+    wps = wpc.stream;
 
     while (wps.wphdr.block_samples == 0) :
-        wps.wphdr = read_next_header(wpc.infile, wps.wphdr);
+        blockbuff = read_next_block(wpc, wps.wphdr)
 
-        if (wps.wphdr.status == 1) :
-            wpc.error_message = "not compatible with this version of WavPack file!";
-            wpc.error = TRUE;
-            return (wpc);
+        if (blockbuff == None) :
+            return FALSE
 
         if (wps.wphdr.block_samples > 0 and wps.wphdr.total_samples != -1) :
             wpc.total_samples = wps.wphdr.total_samples;
 
-        # lets put the stream back in the context
+        if ((unpack_init(wpc, blockbuff)) == FALSE) :
+            wpc.error = TRUE;
+            return FALSE;
 
-        wpc.stream = wps;
+    start_segment(wpc)
+    setup_config(wpc.config, wps.wphdr)
+    wpc.config.float_norm_exp = wps.float_norm_exp;
 
-        if ((unpack_init(wpc)) == FALSE) :
-            wpc.error = TRUE;
-            return wpc;
+    if (select_channels(wpc) == FALSE) :
+        wpc.error_message = "none of the requested channels are in the file!"
+        wpc.error = TRUE
+        return FALSE
 
-    wpc.config.flags = wpc.config.flags & ~0xff;
-    wpc.config.flags = wpc.config.flags | (wps.wphdr.flags & 0xff);
+    wps.skipped = (block_selected(wpc, wps) == FALSE)
+    wpc.stream_started = TRUE
 
-    wpc.config.bytes_per_sample = ((wps.wphdr.flags & BYTES_STORED) + 1);
-    wpc.config.float_norm_exp = wps.float_norm_exp;
+    return TRUE
+
+
+# Fill in the parts of "config" that come from the header of the first block
+# with audio, and the defaults for those that weren't given in metadata.
 
-    wpc.config.bits_per_sample = ((wpc.config.bytes_per_sample * 8) \
-        - ((wps.wphdr.flags & SHIFT_MASK) >> SHIFT_LSB));
+def setup_config(config, wphdr) :
+    config.flags = config.flags & ~0xff;
+    config.flags = config.flags | (wphdr.flags & 0xff);
 
-    if ((wpc.config.flags & FLOAT_DATA) > 0) :
-        wpc.config.bytes_per_sample = 3
-        wpc.config.bits_per_sample = 24
+    config.bytes_per_sample = ((wphdr.flags & BYTES_STORED) + 1);
 
-    if (wpc.config.sample_rate == 0) :
-        if (wps.wphdr.block_samples == 0 or (wps.wphdr.flags & SRATE_MASK) == SRATE_MASK) :
-            wpc.config.sample_rate = 44100
+    config.bits_per_sample = ((config.bytes_per_sample * 8) \
+        - ((wphdr.flags & SHIFT_MASK) >> SHIFT_LSB));
+
+    if ((config.flags & FLOAT_DATA) > 0) :
+        config.bytes_per_sample = 3
+        config.bits_per_sample = 24
+
+    if (config.sample_rate == 0) :
+        if (wphdr.block_samples == 0 or (wphdr.flags & SRATE_MASK) == SRATE_MASK) :
+            config.sample_rate = 44100
         else :
-            wpc.config.sample_rate = sample_rates[((wps.wphdr.flags & SRATE_MASK) \
+            config.sample_rate = sample_rates[((wphdr.flags & SRATE_MASK) \
                 >> SRATE_LSB)]
 
-    if (wpc.config.num_channels == 0) :
-        if ((wps.wphdr.flags & MONO_FLAG) > 0) :
-            wpc.config.num_channels = 1
+    if (config.num_channels == 0) :
+        if ((wphdr.flags & MONO_FLAG) > 0) :
+            config.num_channels = 1
         else :
-            wpc.config.num_channels = 2
+            config.num_channels = 2
+
+        config.channel_mask = 0x5 - config.num_channels
+
 
-        wpc.config.channel_mask = 0x5 - wpc.config.num_channels
+# Work out where each channel of the file goes in the samples returned,
+# from the channel mask given on open (0 for all the channels). Channels
+# are numbered in the order they are stored, which is the order of the bits
+# set in the file's channel mask; any channels beyond those have no bit and
+# are only returned when all the channels are. Returns FALSE if none of the
+# requested channels are in the file.
 
-    if ((wps.wphdr.flags & FINAL_BLOCK) == 0) :
-        if ((wps.wphdr.flags & MONO_FLAG) != 0) :
-            wpc.reduced_channels = 1
+def select_channels(wpc) :
+    mask = wpc.config.channel_mask
+    wpc.channel_map = []
+    column = 0
+    bit = 0
+
+    for channel in range(0, wpc.config.num_channels) :
+        while (bit < 32 and (mask & (1 << bit)) == 0) :
+            bit = bit + 1
+
+        if (wpc.channel_select == 0 or (bit < 32 and (wpc.channel_select & (1 << bit)) != 0)) :
+            wpc.channel_map.append(column)
+            column = column + 1
         else :
-            wpc.reduced_channels = 2
+            wpc.channel_map.append(-1)
 
-    return wpc
+        bit = bit + 1
+
+    if (column == 0) :
+        return FALSE
+
+    if (wpc.channel_select != 0) :
+        wpc.reduced_channels = column
+
+    return TRUE
+
+
+# Return TRUE if any of the channels of the stream's block are to be decoded
+
+def block_selected(wpc, wps) :
+    for channel in range(wps.first_channel, wps.first_channel + stream_channels(wps)) :
+        if (channel < len(wpc.channel_map) and wpc.channel_map[channel] >= 0) :
+            return TRUE
+
+    return FALSE
+
+
+# Open a WavPack file for decoding through a read-only memory mapping of
+# it instead of file reads. Header scanning, metadata parsing and the
+# bitstream then work directly on the mapped pages, and processes that open
+# the same file share those pages through the page cache. "infile" must be
+# a file opened in binary mode, and as with WavpackOpenFileInput() it
+# should stay open while the file is decoded. wpc.infile.close() then
+# unmaps the file as well as closing "infile". If the file can't be mapped
+# (a pipe or socket, or an empty file) this falls back to
+# WavpackOpenFileInput(). The arguments are the same as for that function.
+
+def WavpackOpenFileMmap(infile, flags = 0, channel_mask = 0, handlers = None):
+    try :
+        mapping = mmap.mmap(infile.fileno(), 0, access = mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError) :
+        return WavpackOpenFileInput(infile, flags, channel_mask, handlers)
+
+    return WavpackOpenFileInput(MappedFile(infile, mapping), flags, channel_mask, handlers)
 
 
 # This function obtains general information about an open file and returns
@@ -475,438 +823,1510 @@ def WavpackGetMode (wpc) :
     return mode
 
 
+# Get the information about a WavPack file (given by its path, or as a file
+# opened in binary mode) that WavpackOpenFileInput() and the WavpackGetXxx()
+# functions would give, returned as a WavpackProbeInfo, without unpacking
+# anything. Only the first block header and the metadata sub-blocks before
+# the audio bitstream are read (normally just the start of the file), and
+# of those only the configuration, channel, sample rate, float and int32
+# information is looked at. OPEN_TAIL_SCAN in "flags" works as for
+# WavpackOpenFileInput(). Errors are reported in the returned info.
 
-# Unpack the specified number of samples from the current file position.
-# Note that "samples" here refers to "complete" samples, which would be
-# 2 longs for stereo files. The audio data is returned right-justified in
-# 32-bit longs in the endian mode native to the executing processor. So,
-# if the original data was 16-bit, then the values returned would be
-# +/-32k. Floating point data will be returned as 24-bit integers (and may
-# also be clipped). The actual number of samples unpacked is returned,
-# which should be equal to the number requested unless the end of fle is
-# encountered or an error occurs.
+def WavpackProbe(source, flags = 0) :
+    info = WavpackProbeInfo()
 
-def  WavpackUnpackSamples(wpc, buffer, samples) :
-    wps = wpc.stream;
-    samples_unpacked = 0
-    samples_to_unpack = 0
-    num_channels = wpc.config.num_channels
-    bcounter = 0
+    if (hasattr(source, 'read')) :
+        probe_file(info, source, flags)
+        return info
 
-    temp_buffer = [0] * SAMPLE_BUFFER_SIZE
-    buf_idx = 0
-    bytes_returned = 0
+    try :
+        infile = open(source, "rb")
+    except IOError :
+        info.error = TRUE
+        info.error_message = "can't open file!"
+        return info
 
-    while (samples > 0) :
-        if (wps.wphdr.block_samples == 0 or (wps.wphdr.flags & INITIAL_BLOCK) == 0
-            or wps.sample_index >= wps.wphdr.block_index
-            + wps.wphdr.block_samples) :
+    try :
+        probe_file(info, infile, flags)
+    finally :
+        infile.close()
 
-            wps.wphdr = read_next_header(wpc.infile, wps.wphdr)
+    return info
 
-            if (wps.wphdr.status == 1) :
-                break;
 
-            if (wps.wphdr.block_samples == 0 or wps.sample_index == wps.wphdr.block_index) :
-                if ((unpack_init(wpc)) == FALSE) :
-                    break;
+def probe_file(info, infile, flags) :
+    wphdr = WavpackHeader()
 
-        if (wps.wphdr.block_samples == 0 or (wps.wphdr.flags & INITIAL_BLOCK) == 0
-            or wps.sample_index >= wps.wphdr.block_index
-            + wps.wphdr.block_samples) :
-            continue;
+    while (TRUE) :
+        wphdr = read_next_header(infile, wphdr)
 
-        if (wps.sample_index < wps.wphdr.block_index) :
-            samples_to_unpack = wps.wphdr.block_index - wps.sample_index;
+        if (wphdr.status == 1) :
+            info.error = TRUE
+            info.error_message = "not compatible with this version of WavPack file!"
+            return FALSE
 
-            if (samples_to_unpack > samples) :
-                samples_to_unpack = samples
+        size = max(wphdr.ckSize - 24, 0)
+        data = probe_metadata(info, infile, size)
 
-            wps.sample_index += samples_to_unpack;
-            samples_unpacked += samples_to_unpack;
-            samples -= samples_to_unpack;
+        if (data == None) :
+            info.error = TRUE
+            info.error_message = "invalid metadata!"
+            return FALSE
 
-            if (wpc.reduced_channels > 0) :
-                samples_to_unpack *= wpc.reduced_channels;
-            else :
-                samples_to_unpack *= num_channels;
+        if (wphdr.block_samples > 0) :
+            break
 
-            while (samples_to_unpack > 0) :
-                temp_buffer[bcounter] = 0
-                bcounter = bcounter + 1
-                samples_to_unpack = samples_to_unpack - 1
+        # metadata only blocks come before the first one with audio
 
-            continue
+        if (size > len(data)) :
+            try :
+                infile.seek(size - len(data), 1)
+            except (IOError, OSError, ValueError) :
+                infile.read(size - len(data))
 
-        samples_to_unpack = wps.wphdr.block_index + wps.wphdr.block_samples - wps.sample_index
+    setup_config(info.config, wphdr)
 
-        if (samples_to_unpack > samples) :
-            samples_to_unpack = samples
+    info.sample_rate = info.config.sample_rate
+    info.num_channels = info.config.num_channels
+    info.channel_mask = info.config.channel_mask
+    info.bytes_per_sample = info.config.bytes_per_sample
+    info.bits_per_sample = info.config.bits_per_sample
+    info.mode = WavpackGetMode(info)
+    info.version = wphdr.version
 
-        for mycleanup in range(0,256) :
-            temp_buffer[mycleanup] = 0
-        
-        unpack_samples(wpc, temp_buffer, samples_to_unpack)
+    info.total_samples = wphdr.total_samples
 
-        if (wpc.reduced_channels > 0) :
-            bytes_returned = (samples_to_unpack * wpc.reduced_channels)
-        else :
-            bytes_returned = (samples_to_unpack * num_channels)
+    if (info.total_samples == -1 and (flags & OPEN_TAIL_SCAN) != 0) :
+        info.total_samples = find_final_index(infile)
 
-        tempcount = 0
-        for mycount in range (buf_idx, buf_idx+bytes_returned) :
-            buffer[mycount] = temp_buffer[tempcount]
-            tempcount = tempcount + 1
+    if (info.total_samples != -1) :
+        info.duration = float(info.total_samples) / info.sample_rate
 
-        buf_idx += bytes_returned;
+    return TRUE
 
-        samples_unpacked += samples_to_unpack;
-        samples -= samples_to_unpack;
 
-        if (wps.sample_index == wps.wphdr.block_index + wps.wphdr.block_samples) :
-            if (check_crc_error(wpc) > 0) :
-                wpc.crc_errors = wpc.crc_errors + 1
+# Read the metadata sub-blocks of the block body of "size" bytes at the
+# current position of "infile" up to the audio bitstream, a piece at a
+# time, and apply the ones WavpackProbe() is interested in to "info".
+# Returns the part of the body that was read, or None if the metadata is
+# invalid.
 
-        if (wps.sample_index == wpc.total_samples) :
-            break;
+def probe_metadata(info, infile, size) :
+    data = bytearray()
+    wpmd = WavpackMetadata()
+    index = 0
 
-    return (samples_unpacked)
+    while (index + 2 <= size) :
+        if (probe_read(infile, data, min(index + 4, size), size) == FALSE) :
+            break
 
+        wpmd.id = data[index]
+        wpmd.byte_length = data[index + 1] << 1
+        header_bytes = 2
 
-# Get total number of samples contained in the WavPack file, or -1 if unknown
+        if ((wpmd.id & ID_LARGE) != 0) :
+            wpmd.id &= ~ID_LARGE
+            wpmd.byte_length += (data[index + 2] << 9) + (data[index + 3] << 17)
+            header_bytes = 4
 
-def WavpackGetNumSamples(wpc) :
-    # -1 would mean an unknown number of samples
+        if ((wpmd.id & ID_ODD_SIZE) != 0) :
+            wpmd.id &= ~ID_ODD_SIZE
+            wpmd.byte_length = wpmd.byte_length - 1
 
-    if( None != wpc) :
-        return (wpc.total_samples)
-    else :
-        return -1
+        if (wpmd.id == ID_WV_BITSTREAM) :
+            break
 
+        start = index + header_bytes
+        index = start + wpmd.byte_length + (wpmd.byte_length & 1)
 
-# Get the current sample index position, or -1 if unknown
+        if (index > size or probe_read(infile, data, index, size) == FALSE) :
+            return None
 
-def WavpackGetSampleIndex (wpc) :
-    if (null != wpc) :
-        return wpc.stream.sample_index;
+        wpmd.data = bytes(data[start:start + wpmd.byte_length])
+        wpmd.hasdata = (wpmd.byte_length != 0)
 
-    return -1;
+        if (wpmd.id == ID_CHANNEL_INFO) :
+            if (read_channel_info(info, wpmd) == FALSE) :
+                return None
+        elif (wpmd.id == ID_CONFIG_BLOCK) :
+            read_config_info(info, wpmd)
+        elif (wpmd.id == ID_SAMPLE_RATE) :
+            read_sample_rate(info, wpmd)
+        elif (wpmd.id == ID_INT32_INFO and wpmd.byte_length == 4) :
+            # sent bits make an int32 file lossy, as in unpack_init()
 
+            if (data[start] != 0) :
+                info.lossy_blocks = 1
+        elif (wpmd.id == ID_FLOAT_INFO and wpmd.byte_length == 4) :
+            if ((data[start] & (FLOAT_EXCEPTIONS | FLOAT_ZEROS_SENT | FLOAT_SHIFT_SENT | FLOAT_SHIFT_SAME)) != 0) :
+                info.lossy_blocks = 1
 
-# Get the number of errors encountered so far
+    return data
 
-def WavpackGetNumErrors(wpc) :
-    if( None != wpc) :
-        return wpc.crc_errors
-    else :
-        return 0
 
+# Read from "infile" onto the end of "data" until it holds at least "count"
+# bytes, at least PROBE_READ_SIZE at a time but never more than "size" in
+# all, so that nothing past the block body is read. Returns FALSE at the end
+# of the file.
 
-# return if any uncorrected lossy blocks were actually written or read
+def probe_read(infile, data, count, size) :
+    while (len(data) < count) :
+        try :
+            temp = infile.read(min(max(count - len(data), PROBE_READ_SIZE), size - len(data)))
+        except (IOError, OSError, ValueError) :
+            return FALSE
 
-def WavpackLossyBlocks (wpc) :
-    if(None != wpc) :
-         return wpc.lossy_blocks
-    else :
-        return 0
+        if (len(temp) == 0) :
+            return FALSE
 
+        data += temp
 
-# Returns the sample rate of the specified WavPack file
+    return TRUE
 
-def WavpackGetSampleRate(wpc) :
-    if ( None != wpc and wpc.config.sample_rate != 0) :
-        return wpc.config.sample_rate
-    else :
-        return 44100
 
-        
-# Returns the number of channels of the specified WavPack file. Note that
-# this is the actual number of channels contained in the file, but this
-# version can only decode the first two.
+# Unpack the specified number of samples from the current file position.
+# Note that "samples" here refers to "complete" samples, which would be
+# 2 longs for stereo files. The audio data is returned right-justified in
+# 32-bit longs in the endian mode native to the executing processor. So,
+# if the original data was 16-bit, then the values returned would be
+# +/-32k. Floating point data will be returned as 24-bit integers (and may
+# also be clipped). The actual number of samples unpacked is returned,
+# which should be equal to the number requested unless the end of fle is
+# encountered or an error occurs.
 
-def WavpackGetNumChannels(wpc) :
-    if ( None != wpc and wpc.config.num_channels != 0) :
-        return wpc.config.num_channels
-    else :
-        return 2
+def  WavpackUnpackSamples(wpc, buffer, samples) :
+    return unpack_to_buffer(wpc, buffer, samples)
 
 
-# Returns the actual number of valid bits per sample contained in the
-# original file, which may or may not be a multiple of 8. Floating data
-# always has 32 bits, integers may be from 1 to 32 bits each. When this
-# value is not a multiple of 8, then the "extra" bits are located in the
-# LSBs of the results. That is, values are right justified when unpacked
-# into longs, but are left justified in the number of bytes used by the
-# original data.
+# Unpack samples straight into "out", a preallocated NumPy array of int32
+# values (it may have any shape, but must be C-contiguous), interleaved the
+# same way as WavpackUnpackSamples(). As many complete samples as fit in the
+# array are unpacked and the actual number unpacked is returned. Blocks are
+# decoded in a buffer kept by the context and finished with NumPy straight
+# into the array, so there is no list of the samples returned and the same
+# array can be reused for every call.
 
-def WavpackGetBitsPerSample(wpc) :
-    if (None != wpc and wpc.config.bits_per_sample != 0) :
-        return wpc.config.bits_per_sample
-    else :
-        return 16
+def WavpackUnpackInto(wpc, out) :
+    if (numpy is None) :
+        raise ImportError("NumPy is required for WavpackUnpackInto()")
 
+    if (out.dtype != numpy.int32 or not out.flags.c_contiguous or not out.flags.writeable) :
+        raise ValueError("output must be a writeable, C-contiguous int32 array")
 
-# Returns the number of bytes used for each sample (1 to 4) in the original
-# file. This is required information for the user of this module because the
-# audio data is returned in the LOWER bytes of the long buffer and must be
-# left-shifted 8, 16, or 24 bits if normalized longs are required.
+    if (out.ndim != 1) :
+        out = out.reshape(-1)
 
-def WavpackGetBytesPerSample(wpc) :
-    if ( None != wpc and wpc.config.bytes_per_sample != 0) :
-        return wpc.config.bytes_per_sample
-    else :
-        return 2
+    return unpack_to_buffer(wpc, out, out.size // WavpackGetReducedChannels(wpc))
 
 
-# This function will return the actual number of channels decoded from the
-# file (which may or may not be less than the actual number of channels, but
-# will always be 1 or 2). Normally, this will be the front left and right
-# channels of a multi-channel file.
+# Unpack up to the specified number of complete samples into a new NumPy
+# int32 array, which is returned trimmed to the samples actually unpacked
+# (so it is empty at the end of the file).
 
-def WavpackGetReducedChannels(wpc) :
-    if (None != wpc and wpc.reduced_channels != 0) :
-        return wpc.reduced_channels
-    elif (None != wpc and wpc.config.num_channels != 0) :
-        return wpc.config.num_channels
-    else :
-        return 2
+def WavpackUnpackNumpy(wpc, samples) :
+    if (numpy is None) :
+        raise ImportError("NumPy is required for WavpackUnpackNumpy()")
 
+    num_channels = WavpackGetReducedChannels(wpc)
+    out = numpy.empty(samples * num_channels, numpy.int32)
+    samples_unpacked = WavpackUnpackInto(wpc, out)
 
+    return out[:samples_unpacked * num_channels]
 
-# Read from current file position until a valid 32-byte WavPack 4.0 header is
-# found and read into the specified pointer. If no WavPack header is found within 1 meg,
-# then an error is returned. No additional bytes are read past the header. 
 
-def read_next_header(infile, wphdr) :
-    buffer = [0] * 32 # 32 is the size of a WavPack Header
-    temp = [0] * 32
+# Unpack samples into "out", a preallocated NumPy float32 array, in the same
+# way as WavpackUnpackInto(), returning the number of complete samples
+# unpacked. Integer data is scaled to +/-1.0 full scale for the file's
+# bytes per sample. Float data is returned as the floats it was encoded
+# from: the bits of each float are put together from the block's exponent
+# (float_max_exp) without going through 24-bit integers, and only files not
+# normalized to +/-1.0 (float_norm_exp isn't 127) are scaled afterwards.
 
-    bytes_skipped = 0
-    bleft = 0  # bytes left in buffer
-    counter = 0
-    i = 0
+def WavpackUnpackFloat32Into(wpc, out) :
+    if (numpy is None) :
+        raise ImportError("NumPy is required for WavpackUnpackFloat32Into()")
 
-    while (TRUE) :
-        for i in range(0,bleft) :
-            buffer[i] = buffer[32 - bleft + i];
+    if (out.dtype != numpy.float32 or not out.flags.c_contiguous or not out.flags.writeable) :
+        raise ValueError("output must be a writeable, C-contiguous float32 array")
 
-        counter = 0;
+    if (out.ndim != 1) :
+        out = out.reshape(-1)
 
-        try :
-            temp = infile.read(32 - bleft)
-        except:
-            wphdr.status = 1;
-            return wphdr;
+    num_channels = WavpackGetReducedChannels(wpc)
+    values = out.view(numpy.int32)
 
-        # Check if we are at the end of the file
-        if len(temp) < (32-bleft) :
-            wphdr.status = 1;
-            return wphdr;            
+    wpc.float_bits = TRUE
+
+    try :
+        samples_unpacked = unpack_to_buffer(wpc, values, out.size // num_channels)
+    finally :
+        wpc.float_bits = FALSE
+
+    count = samples_unpacked * num_channels
+
+    if ((wpc.config.flags & CONFIG_FLOAT_DATA) == 0) :
+        scale = 1.0 / (1 << (WavpackGetBytesPerSample(wpc) * 8 - 1))
+        numpy.multiply(values[:count], scale, out = out[:count], casting = 'unsafe')
+    elif (wpc.config.float_norm_exp != 127 and wpc.config.float_norm_exp != 0) :
+        out[:count] *= numpy.float32(2.0 ** (127 - wpc.config.float_norm_exp))
+
+    return samples_unpacked
+
+
+# Unpack up to the specified number of complete samples into a new NumPy
+# float32 array, as WavpackUnpackNumpy() does for int32
+
+def WavpackUnpackFloat32(wpc, samples) :
+    if (numpy is None) :
+        raise ImportError("NumPy is required for WavpackUnpackFloat32()")
+
+    num_channels = WavpackGetReducedChannels(wpc)
+    out = numpy.empty(samples * num_channels, numpy.float32)
+    samples_unpacked = WavpackUnpackFloat32Into(wpc, out)
+
+    return out[:samples_unpacked * num_channels]
+
+
+# Make sure the current block still has samples to decode, reading the
+# following block headers as needed (and starting to unpack the block that
+# begins the next group of samples). Returns FALSE at the end of the file
+# or if a block can't be unpacked.
+
+def next_block(wpc) :
+    wps = wpc.stream
+
+    while (wpc.segment_pending == TRUE or wps.wphdr.block_samples == 0
+        or (wps.wphdr.flags & INITIAL_BLOCK) == 0
+        or wps.sample_index >= wps.wphdr.block_index
+        + wps.wphdr.block_samples) :
+
+        if (wpc.segment_pending == TRUE) :
+            if (read_segment_block(wpc) == FALSE) :
+                return FALSE;
+
+            continue
+
+        if (read_block_header(wpc, wps.wphdr) == FALSE) :
+            return FALSE;
+
+        if (wps.wphdr.block_samples == 0 or wps.sample_index == wps.wphdr.block_index) :
+            if ((unpack_first_block(wpc)) == FALSE) :
+                # the block's samples are returned as silence if decoding goes on
+
+                wps.mute_error = 1
+                wpc.num_streams = 1
+                wpc.segment_pending = FALSE
+                return FALSE;
+        else :
+            skip_block_body(wpc, wps.wphdr)
+
+    return TRUE
+
+
+# Unpack the block whose header has just been read into the first stream,
+# or skip over it if none of its channels are wanted, and start its segment.
+# Returns FALSE if it can't be unpacked.
+
+def unpack_first_block(wpc) :
+    wps = wpc.stream
+    wps.first_channel = 0
+
+    if (wps.wphdr.block_samples > 0 and block_selected(wpc, wps) == FALSE) :
+        skip_block_body(wpc, wps.wphdr)
+        wps.sample_index = wps.wphdr.block_index
+        wps.skipped = TRUE
+    else :
+        if ((unpack_init(wpc, read_block_body(wpc, wps.wphdr))) == FALSE) :
+            return FALSE
+
+        wps.skipped = FALSE
+
+    if (wps.wphdr.block_samples > 0) :
+        start_segment(wpc)
+
+    return TRUE
+
+
+# Called when the first block of a segment (the blocks holding the same
+# samples for all the channels, from the one flagged INITIAL_BLOCK to the
+# one flagged FINAL_BLOCK) has been unpacked into the first stream. The
+# rest of the segment's blocks then follow it in the file and are read by
+# read_segment_block() before anything is decoded.
+
+def start_segment(wpc) :
+    wpc.num_streams = 1
+    wpc.segment_pending = ((wpc.stream.wphdr.flags & FINAL_BLOCK) == 0)
+
+
+# Read the next block of the current segment and unpack it into the next
+# stream, so that all the channels of the segment are decoded from a single
+# pass over its blocks. A block holding none of the channels asked for is
+# skipped over using its size, without even parsing its metadata. Returns
+# FALSE if a push decoder hasn't been fed the block yet. If the segment
+# ends early (at the end of the file, or because the next block isn't part
+# of it) the channels that are missing are returned as silence. A block
+# that isn't part of the segment is left to be read again by the next
+# read_block_header(), so the next segment can start from it.
+
+def read_segment_block(wpc) :
+    first = wpc.streams[0]
+    last = wpc.streams[wpc.num_streams - 1]
+
+    if (wpc.num_streams == len(wpc.streams)) :
+        wpc.streams.append(WavpackStream())
+
+    wps = wpc.streams[wpc.num_streams]
+
+    if (read_block_header(wpc, wps.wphdr) == FALSE) :
+        if (wpc.input_buffer != None and wpc.error == FALSE) :
+            return FALSE
+
+        wpc.segment_pending = FALSE
+        return TRUE
+
+    if (wps.wphdr.block_samples == 0) :
+        skip_block_body(wpc, wps.wphdr)
+        return TRUE
+
+    if ((wps.wphdr.flags & INITIAL_BLOCK) != 0 or wps.wphdr.block_index != first.wphdr.block_index
+        or wps.wphdr.block_samples != first.wphdr.block_samples) :
+        wpc.pending_header = pack_wavpack_header(wps.wphdr)
+        wpc.segment_pending = FALSE
+        return TRUE
+
+    wps.first_channel = last.first_channel + stream_channels(last)
+
+    if (block_selected(wpc, wps) == FALSE) :
+        skip_block_body(wpc, wps.wphdr)
+        wps.sample_index = wps.wphdr.block_index
+        wps.skipped = TRUE
+    else :
+        wpc.stream = wps
+        result = unpack_init(wpc, read_block_body(wpc, wps.wphdr))
+        wpc.stream = first
+
+        if (result == FALSE) :
+            wpc.segment_pending = FALSE
+            return TRUE
+
+        wps.skipped = FALSE
+
+    wpc.num_streams += 1
+
+    if ((wps.wphdr.flags & FINAL_BLOCK) != 0) :
+        wpc.segment_pending = FALSE
+
+    return TRUE
+
+
+# Get the next block from the context's source into "wphdr", returning the
+# rest of the block after the header (as a memoryview), or None if there
+# are no more blocks.
+
+def read_next_block(wpc, wphdr) :
+    if (read_block_header(wpc, wphdr) == FALSE) :
+        return None
+
+    return read_block_body(wpc, wphdr)
+
+
+# Get the header of the next block from the context's source into "wphdr"
+# and return TRUE, or FALSE if there are no more blocks. For a file the
+# header is read from the file; for a push decoder it is found in the data
+# fed to it, and FALSE means that the next block hasn't been completely fed
+# yet. The rest of the block must then be taken with read_block_body() or
+# passed over with skip_block_body(). These are the only places blocks are
+# read, everything after them works on the block contents. A header handed
+# back by read_segment_block() is returned again first (its block is still
+# next in the source).
+
+def read_block_header(wpc, wphdr) :
+    if (wpc.pending_header != None) :
+        parse_header(wpc.pending_header, 0, wphdr)
+        wpc.pending_header = None
+        return TRUE
+
+    if (wpc.input_buffer != None) :
+        return find_fed_block(wpc, wphdr)
+
+    wphdr = read_next_header(wpc.infile, wphdr)
+
+    if (wphdr.status == 1) :
+        return FALSE
+
+    return TRUE
+
+
+# Return the rest of the block whose header was just read, as a memoryview.
+# From a file it is read with a single call and the metadata is then parsed
+# from slices of it.
+
+def read_block_body(wpc, wphdr) :
+    size = max(wphdr.ckSize - 24, 0)
+
+    if (wpc.input_buffer != None) :
+        blockbuff = wpc.input_buffer[32:size + 32]
+        del wpc.input_buffer[0:size + 32]
+        return memoryview(blockbuff)
+
+    try :
+        return memoryview(wpc.infile.read(size))
+    except (IOError, OSError, ValueError) :
+        return memoryview(b'')
+
+
+# Pass over the rest of the block whose header was just read. Files are
+# seeked past it where possible (so a memory-mapped file doesn't even touch
+# its pages) and otherwise it is read and thrown away.
+
+def skip_block_body(wpc, wphdr) :
+    size = max(wphdr.ckSize - 24, 0)
+
+    if (wpc.input_buffer != None) :
+        del wpc.input_buffer[0:size + 32]
+        return
+
+    try :
+        wpc.infile.seek(size, 1)
+    except (AttributeError, IOError, OSError, ValueError) :
+        try :
+            wpc.infile.read(size)
+        except (IOError, OSError, ValueError) :
+            pass
+
+
+# Look for the next complete block in the data fed to a push decoder, in
+# the same way as read_next_header() finds it in a file, and read its header
+# into "wphdr". Bytes before it are dropped, so that only the incomplete
+# block is kept, and "wphdr" is only changed once the whole block is there.
+
+def find_fed_block(wpc, wphdr) :
+    data = wpc.input_buffer
+
+    while (len(data) >= 32) :
+        if (parse_header(data, 0, WavpackHeader()) == TRUE) :
+            block_size = max(struct.unpack_from('<I', data, 4)[0] + 8, 32)
+
+            if (len(data) < block_size) :
+                return FALSE
+
+            parse_header(data, 0, wphdr)
+            wpc.bytes_skipped = 0
+
+            return TRUE
+
+        skip = data.find(b'w', 1)
+
+        if (skip < 0) :
+            skip = len(data)
+
+        del data[0:skip]
+        wpc.bytes_skipped += skip
+
+        if (wpc.bytes_skipped > 1048576) :
+            del data[:]
+            wpc.error_message = "not compatible with this version of WavPack file!"
+            wpc.error = TRUE
+            return FALSE
+
+    return FALSE
+
+
+# Generator returning the audio a block at a time as (start_sample, samples)
+# tuples, where "samples" is a list of interleaved values in the same form
+# as from WavpackUnpackSamples(). "source" is a file name, a file opened in
+# binary mode, or a context from one of the WavpackOpenFileXxx() functions,
+# which is continued from its current position. Only one block is held in
+# memory at a time, and an IOError is raised if the file can't be opened.
+
+def WavpackIterBlocks(source) :
+    wpc, release = open_source(source)
+
+    try :
+        wps = wpc.stream
+        num_channels = WavpackGetReducedChannels(wpc)
+
+        while (next_block(wpc) == TRUE) :
+            start_sample = wps.sample_index
+
+            if (wps.sample_index < wps.wphdr.block_index) :
+                samples = wps.wphdr.block_index - wps.sample_index
+            else :
+                samples = wps.wphdr.block_index + wps.wphdr.block_samples - wps.sample_index
+
+            buffer = [0] * (samples * num_channels)
+            samples_unpacked = WavpackUnpackSamples(wpc, buffer, samples)
+
+            if (samples_unpacked == 0) :
+                break
+
+            if (samples_unpacked < samples) :
+                del buffer[samples_unpacked * num_channels:]
+
+            yield (start_sample, buffer)
+    finally :
+        if (release != None) :
+            release()
+
+
+# Generator like WavpackIterBlocks(), but returning the audio in frames of
+# "frame_size" samples (the last one may be shorter) regardless of the
+# block boundaries.
+
+def WavpackIterFrames(source, frame_size) :
+    wpc, release = open_source(source)
+
+    try :
+        num_channels = WavpackGetReducedChannels(wpc)
+
+        while (TRUE) :
+            start_sample = wpc.stream.sample_index
+            buffer = [0] * (frame_size * num_channels)
+            samples_unpacked = WavpackUnpackSamples(wpc, buffer, frame_size)
+
+            if (samples_unpacked == 0) :
+                break
+
+            if (samples_unpacked < frame_size) :
+                del buffer[samples_unpacked * num_channels:]
+
+            yield (start_sample, buffer)
+    finally :
+        if (release != None) :
+            release()
+
+
+# Get a context for the source given to the generator functions, returning
+# it along with the function (or None) that releases what was opened for
+# it once the generator is done: the file opened for a file name (which
+# also unmaps it), or just the mapping of a file given by the caller, which
+# stays open. A context given by the caller is left as it is.
+
+def open_source(source) :
+    if (isinstance(source, WavpackContext)) :
+        return (source, None)
+
+    if (hasattr(source, 'read')) :
+        wpc = WavpackOpenFileMmap(source)
+
+        if (isinstance(wpc.infile, MappedFile)) :
+            release = wpc.infile.unmap
+        else :
+            release = None
+    else :
+        wpc = WavpackOpenFileMmap(open(source, "rb"))
+        release = wpc.infile.close
+
+    if (wpc.error) :
+        if (release != None) :
+            release()
+
+        raise IOError(wpc.error_message)
+
+    return (wpc, release)
+
+
+# Common code for the WavpackUnpackXxx() functions. A list is unpacked
+# into directly, each piece of a block going straight to its place in the
+# list, so a single call can return any number of samples across any number
+# of blocks. For a NumPy array each piece is decoded in the context's temp
+# buffer and finished with NumPy straight into its place in the array (see
+# unpack_samples()). The channels of a multichannel segment are interleaved
+# by unpack_segment().
+
+def unpack_to_buffer(wpc, buffer, samples) :
+    wps = wpc.stream;
+    samples_unpacked = 0
+    samples_to_unpack = 0
+    num_channels = WavpackGetReducedChannels(wpc)
+    direct = isinstance(buffer, list)
+
+    buf_idx = 0
+    values_returned = 0
+
+    while (samples > 0) :
+        if (next_block(wpc) == FALSE) :
+            break;
+
+        if (wps.sample_index < wps.wphdr.block_index) :
+            samples_to_unpack = wps.wphdr.block_index - wps.sample_index;
+
+            if (samples_to_unpack > samples) :
+                samples_to_unpack = samples
+
+            wps.sample_index += samples_to_unpack;
+            samples_unpacked += samples_to_unpack;
+            samples -= samples_to_unpack;
+
+            samples_to_unpack *= num_channels;
+
+            if (direct) :
+                buffer[buf_idx:buf_idx + samples_to_unpack] = [0] * samples_to_unpack
+            else :
+                buffer[buf_idx:buf_idx + samples_to_unpack] = 0
+
+            buf_idx += samples_to_unpack
+
+            continue
+
+        samples_to_unpack = wps.wphdr.block_index + wps.wphdr.block_samples - wps.sample_index
+
+        if (samples_to_unpack > samples) :
+            samples_to_unpack = samples
+
+        values_returned = samples_to_unpack * num_channels
+
+        if (wpc.num_streams > 1 or wps.skipped == TRUE or stream_channels(wps) != num_channels) :
+            unpack_segment(wpc, buffer, samples_to_unpack, buf_idx, num_channels)
+        elif (direct) :
+            unpack_samples(wpc, buffer, samples_to_unpack, buf_idx)
+        else :
+            unpack_samples(wpc, get_temp_buffer(wpc, values_returned), samples_to_unpack, 0,
+                buffer, buf_idx)
+
+        buf_idx += values_returned;
+
+        samples_unpacked += samples_to_unpack;
+        samples -= samples_to_unpack;
+
+        if (wps.sample_index == wps.wphdr.block_index + wps.wphdr.block_samples) :
+            for stream in wpc.streams[0:wpc.num_streams] :
+                wpc.stream = stream
+
+                if (stream.skipped == FALSE and check_crc_error(wpc) > 0) :
+                    wpc.crc_errors = wpc.crc_errors + 1
+
+            wpc.stream = wps
+
+        if (wps.sample_index == wpc.total_samples) :
+            break;
+
+    return (samples_unpacked)
+
+
+# Unpack "sample_count" samples from each stream of the current segment in
+# turn and interleave their channels into "buffer" at "buf_idx", each in its
+# column from the channel map. Streams with none of the channels asked for
+# are just moved on, and any channels missing from the segment are silence.
+
+def unpack_segment(wpc, buffer, sample_count, buf_idx, num_channels) :
+    wps = wpc.stream
+    end_idx = buf_idx + sample_count * num_channels
+    channel_map = wpc.channel_map
+    filled = [FALSE] * num_channels
+
+    for stream in wpc.streams[0:wpc.num_streams] :
+        if (stream.skipped == TRUE) :
+            stream.sample_index += sample_count
+            continue
+
+        wpc.stream = stream
+        count = stream_channels(stream)
+        temp_buffer = get_temp_buffer(wpc, sample_count * 2)
+
+        unpack_samples(wpc, temp_buffer, sample_count, 0)
+
+        for i in range(0, count) :
+            channel = stream.first_channel + i
+
+            if (channel < len(channel_map) and channel_map[channel] >= 0) :
+                column = channel_map[channel]
+                buffer[buf_idx + column:end_idx:num_channels] = temp_buffer[i:sample_count * count:count]
+                filled[column] = TRUE
+
+    wpc.stream = wps
+
+    for column in range(0, num_channels) :
+        if (filled[column] == FALSE) :
+            if (isinstance(buffer, list)) :
+                buffer[buf_idx + column:end_idx:num_channels] = [0] * sample_count
+            else :
+                buffer[buf_idx + column:end_idx:num_channels] = 0
+
+
+# Number of channels returned by unpack_samples() for the stream's block
+
+def stream_channels(wps) :
+    if ((wps.wphdr.flags & MONO_FLAG) != 0) :
+        return 1
+    else :
+        return 2
+
+
+# Return the context's temp buffer, first growing it if it holds fewer than
+# "size" values. It is kept for the next call, so it is only reallocated
+# when a larger piece than before is unpacked.
+
+def get_temp_buffer(wpc, size) :
+    if (len(wpc.temp_buffer) < size) :
+        wpc.temp_buffer = [0] * size
+
+    return wpc.temp_buffer
+
+
+# Build the seek index for the file by hopping from one block header to the
+# next using the ckSize field, so nothing is entropy decoded. If a block
+# isn't found where its predecessor said it would be, read_next_header()
+# resynchronizes on the next valid header. The file must be seekable; the
+# current file position is restored afterwards. If the file was opened with
+# OPEN_CACHE_INDEX, a still valid index file is loaded instead of walking
+# the headers, and a freshly built index is saved for the next open.
+# Returns TRUE on success, or FALSE (with the error set) for a push decoder
+# or a file that can't be seeked.
+
+def WavpackBuildIndex(wpc) :
+    index = WavpackBlockIndex()
+    wphdr = WavpackHeader()
+
+    if (wpc.input_buffer != None) :
+        wpc.error = TRUE
+        wpc.error_message = "can't index the data fed to a push decoder!"
+        return FALSE
+
+    try :
+        saved_position = wpc.infile.tell()
+    except (IOError, OSError) :
+        wpc.error = TRUE
+        wpc.error_message = "can't index a file that isn't seekable!"
+        return FALSE
+
+    if ((wpc.open_flags & OPEN_CACHE_INDEX) != 0) :
+        wpc.seek_index = read_index_file(wpc)
+
+        if (wpc.seek_index != None) :
+            wpc.infile.seek(saved_position)
+            return TRUE
+
+    wpc.infile.seek(0)
+
+    while (TRUE) :
+        wphdr = read_next_header(wpc.infile, wphdr)
+
+        if (wphdr.status == 1) :
+            break
+
+        offset = wpc.infile.tell() - 32
+
+        if (wphdr.block_samples > 0 and (wphdr.flags & INITIAL_BLOCK) != 0) :
+            index.block_index.append(wphdr.block_index)
+            index.block_samples.append(wphdr.block_samples)
+            index.offset.append(offset)
+
+        wpc.infile.seek(offset + wphdr.ckSize + 8)
+
+    wpc.seek_index = index
+
+    if ((wpc.open_flags & OPEN_CACHE_INDEX) != 0) :
+        write_index_file(wpc)
+
+    wpc.infile.seek(saved_position)
+
+    return TRUE
+
+
+# Return the name of the file used to cache the seek index of the open
+# WavPack file, or None if the file has no name (i.e. it is not on disk).
+
+def index_file_name(wpc) :
+    name = getattr(wpc.infile, 'name', None)
+
+    if (not name or not hasattr(name, 'startswith') or name.startswith('<')) :
+        return None
+
+    if (INDEX_CACHE_DIR == None) :
+        return name + '.wvidx'
+
+    path = os.path.abspath(name)
+
+    if (not isinstance(path, bytes)) :
+        path = path.encode('utf-8')
+
+    return os.path.join(INDEX_CACHE_DIR, hashlib.sha1(path).hexdigest() + '.wvidx')
+
+
+# The index file is tied to the exact WavPack file it was built from by the
+# file size, the modification time and a hash of the first and last indexed
+# block headers. This returns those values for the open file, given the
+# offsets of those two headers.
+
+def index_file_key(wpc, first_offset, last_offset) :
+    st = os.fstat(wpc.infile.fileno())
+    headers = hashlib.sha1()
+
+    wpc.infile.seek(first_offset)
+    headers.update(wpc.infile.read(32))
+    wpc.infile.seek(last_offset)
+    headers.update(wpc.infile.read(32))
+
+    return (st.st_size, st.st_mtime, headers.digest())
+
+
+# Load the seek index from its index file, returning None if there isn't
+# one or it doesn't match the WavPack file anymore.
+
+def read_index_file(wpc) :
+    name = index_file_name(wpc)
+    header_size = struct.calcsize(INDEX_HEADER_FORMAT)
+
+    if (name == None) :
+        return None
+
+    try :
+        f = open(name, 'rb')
+        data = f.read()
+        f.close()
+
+        if (len(data) < header_size) :
+            return None
+
+        ident, version, reserved, file_size, mtime, count, digest = \
+            struct.unpack(INDEX_HEADER_FORMAT, data[:header_size])
+
+        if (ident != INDEX_FILE_ID or version != INDEX_FILE_VERSION or count == 0
+            or len(data) != header_size + count * 16) :
+            return None
+
+        index = WavpackBlockIndex()
+        pos = header_size
+        index.block_index = list(struct.unpack('<%dI' % count, data[pos:pos + count * 4]))
+        pos += count * 4
+        index.block_samples = list(struct.unpack('<%dI' % count, data[pos:pos + count * 4]))
+        pos += count * 4
+        index.offset = list(struct.unpack('<%dQ' % count, data[pos:pos + count * 8]))
+
+        if (index_file_key(wpc, index.offset[0], index.offset[-1]) != (file_size, mtime, digest)) :
+            return None
+    except (IOError, OSError) :
+        return None
+
+    return index
+
+
+# Save the seek index to its index file. This is only a cache, so failing
+# to write it (for example in a read-only directory) is not an error.
+
+def write_index_file(wpc) :
+    index = wpc.seek_index
+    name = index_file_name(wpc)
+    count = len(index.offset)
+
+    if (name == None or count == 0) :
+        return
+
+    temp_name = None
+
+    try :
+        file_size, mtime, digest = index_file_key(wpc, index.offset[0], index.offset[-1])
+
+        data = struct.pack(INDEX_HEADER_FORMAT, INDEX_FILE_ID, INDEX_FILE_VERSION, 0,
+            file_size, mtime, count, digest)
+        data += struct.pack('<%dI' % count, *index.block_index)
+        data += struct.pack('<%dI' % count, *index.block_samples)
+        data += struct.pack('<%dQ' % count, *index.offset)
+
+        # write to a temporary file first so that readers never see half an
+        # index, with a name of its own so that several opens of the same
+        # file can save the index at once
+
+        fd, temp_name = tempfile.mkstemp('.tmp', os.path.basename(name) + '.',
+            os.path.dirname(name) or os.curdir)
+        f = os.fdopen(fd, 'wb')
+
+        try :
+            f.write(data)
+        finally :
+            f.close()
+
+        os.chmod(temp_name, 0o644)    # mkstemp() makes the file private
+
+        if (hasattr(os, 'replace')) :
+            os.replace(temp_name, name)
+        else :
+            try :
+                os.rename(temp_name, name)
+            except OSError :
+                os.remove(name)
+                os.rename(temp_name, name)
+
+        temp_name = None
+    except (IOError, OSError) :
+        pass
+    finally :
+        if (temp_name != None) :
+            try :
+                os.remove(temp_name)
+            except OSError :
+                pass
+
+
+# Seek to the specified sample index, so that the next call to
+# WavpackUnpackSamples() returns audio starting at that sample. The seek
+# index is built on first use (see WavpackBuildIndex()). Because WavPack
+# blocks can only be decoded from their start, the block containing the
+# sample is read and the samples ahead of the requested one are decoded and
+# discarded. Returns TRUE on success, FALSE if the sample is outside the
+# file or the file can't be seeked (which includes a push decoder).
+
+def WavpackSeekSample(wpc, sample) :
+    wps = wpc.stream
+
+    if (wpc.seek_index == None and WavpackBuildIndex(wpc) == FALSE) :
+        return FALSE
+
+    index = wpc.seek_index
+    i = bisect.bisect_right(index.block_index, sample) - 1
+
+    if (sample < 0 or i < 0 or sample >= index.block_index[i] + index.block_samples[i]) :
+        wpc.error = TRUE
+        wpc.error_message = "can't seek to sample " + str(sample) + "!"
+        return FALSE
+
+    wpc.infile.seek(index.offset[i])
+    wpc.pending_header = None
+
+    if (read_block_header(wpc, wps.wphdr) == FALSE or unpack_first_block(wpc) == FALSE) :
+        wpc.error = TRUE
+        wpc.error_message = "invalid WavPack file!"
+        return FALSE
+
+    while (wpc.segment_pending == TRUE) :
+        read_segment_block(wpc)
+
+    samples_to_skip = sample - wps.sample_index
+
+    if (samples_to_skip > 0) :
+        for stream in wpc.streams[0:wpc.num_streams] :
+            if (stream.skipped == TRUE) :
+                stream.sample_index += samples_to_skip
+                continue
+
+            wpc.stream = stream
+            unpack_samples(wpc, get_temp_buffer(wpc, samples_to_skip * 2), samples_to_skip, 0)
+
+        wpc.stream = wps
+
+    return TRUE
+
+
+# Decode the rest of the file using a pool of worker processes and return
+# a generator of lists of interleaved samples, one list for each block, in
+# sample order (the same values WavpackUnpackSamples() would return). Each
+# WavPack block carries all the state needed to decode it, so the parent
+# only splits the file into blocks (together with any following blocks for
+# the other channels of a multichannel file) and reassembles the results.
+# "workers" is the number of processes to use (default is one per CPU) and
+# "depth" the maximum number of blocks in flight at once (default is twice
+# the number of workers), which bounds the memory used. The file doesn't
+# need to be seekable. Blocks that fail to decode, including any that raise
+# an exception in their worker, are returned as silence and counted as crc
+# errors.
+
+def WavpackUnpackParallel(wpc, workers = 0, depth = 0) :
+    if (workers <= 0) :
+        workers = multiprocessing.cpu_count()
+
+    if (depth <= 0) :
+        depth = workers * 2
+
+    pool = multiprocessing.Pool(workers)
+
+    try :
+        for samples in unpack_parallel(wpc, pool, depth) :
+            yield samples
+    finally :
+        pool.terminate()
+        pool.join()
+
+
+# Split the rest of the file into byte strings that can be decoded on their
+# own: each block that starts a new group of samples, with the blocks holding
+# its other channels appended. Yields (block_index, block_samples, data)
+# tuples.
+
+def read_block_groups(wpc) :
+    wphdr = WavpackHeader()
+    group = None
+
+    while (TRUE) :
+        data = read_next_block(wpc, wphdr)
+
+        if (data == None) :
+            break
+
+        data = data.tobytes()
+
+        if (wphdr.block_samples > 0 and (wphdr.flags & INITIAL_BLOCK) != 0) :
+            if (group != None) :
+                yield (group[0], group[1], b''.join(group[2]))
+
+            group = (wphdr.block_index, wphdr.block_samples, [])
+
+        if (group != None) :
+            group[2].append(pack_wavpack_header(wphdr))
+            group[2].append(data)
+
+    if (group != None) :
+        yield (group[0], group[1], b''.join(group[2]))
+
+
+def pack_wavpack_header(wphdr) :
+    return struct.pack(WAVPACK_HEADER_FORMAT, b'wvpk', wphdr.ckSize, wphdr.version,
+        wphdr.track_no, wphdr.index_no, wphdr.total_samples & 0xffffffff,
+        wphdr.block_index & 0xffffffff, wphdr.block_samples, wphdr.flags, wphdr.crc)
+
+
+# Decode one group of blocks from read_block_groups() in a worker process,
+# returning the interleaved samples, the number of crc errors and whether
+# any of the blocks were lossy (as in WavpackLossyBlocks()). The samples are
+# returned as an array of 32-bit ints, which is sent back to the parent as
+# its raw bytes rather than as thousands of separate ints. The channel
+# layout is passed in from the file's context because it is only stored in
+# the first block of the file.
+
+def unpack_block_group(args) :
+    data, crc_mode, num_channels, channel_mask, channel_select = args
+    wpc = WavpackContext()
+
+    wpc.infile = io.BytesIO(data)
+    wpc.total_samples = -1
+    wpc.channel_select = channel_select
+    wpc.config.num_channels = num_channels
+    wpc.config.channel_mask = channel_mask
+
+    if (open_stream(wpc) == FALSE) :
+        return (array(INT32_TYPECODE), 1, wpc.lossy_blocks)
+
+    WavpackSetCrcMode(wpc, crc_mode)
+
+    count = wpc.stream.wphdr.block_samples
+    num_channels = WavpackGetReducedChannels(wpc)
+    buffer = [0] * (count * num_channels)
+    count = WavpackUnpackSamples(wpc, buffer, count)
+
+    return (array(INT32_TYPECODE, buffer[0:count * num_channels]), WavpackGetNumErrors(wpc),
+        wpc.lossy_blocks)
+
+
+# Hand the block groups to "pool" keeping at most "depth" in flight, and
+# yield the results in order, with silence filling any gaps between blocks
+# and replacing blocks that failed. The context's position and error count
+# are kept up to date.
+
+def unpack_parallel(wpc, pool, depth) :
+    wps = wpc.stream
+    num_channels = WavpackGetReducedChannels(wpc)
+    pending = deque()
+    groups = read_block_groups(wpc)
+    more = TRUE
+
+    # the rest of the segment already started is decoded here
+
+    if (wps.wphdr.block_samples > 0 and (wps.wphdr.flags & INITIAL_BLOCK) != 0
+        and wps.sample_index < wps.wphdr.block_index + wps.wphdr.block_samples) :
+        count = wps.wphdr.block_index + wps.wphdr.block_samples - wps.sample_index
+        samples = [0] * (count * num_channels)
+        count = unpack_to_buffer(wpc, samples, count)
+
+        yield samples[0:count * num_channels]
+
+    while (more or len(pending) > 0) :
+        while (more and len(pending) < depth) :
+            try :
+                block_index, block_samples, data = next(groups)
+            except StopIteration :
+                more = FALSE
+                break
+
+            result = pool.apply_async(unpack_block_group, ((data, wpc.crc_mode,
+                wpc.config.num_channels, wpc.config.channel_mask, wpc.channel_select),))
+            pending.append((block_index, block_samples, result))
+
+        if (len(pending) == 0) :
+            break
+
+        block_index, block_samples, result = pending.popleft()
+
+        try :
+            samples, crc_errors, lossy_blocks = result.get()
+        except Exception :
+            samples, crc_errors, lossy_blocks = None, 0, 0
+
+        if (samples == None or len(samples) != block_samples * num_channels) :
+            samples = [0] * (block_samples * num_channels)
+            crc_errors = crc_errors + 1
+        else :
+            samples = samples.tolist()
+
+        wpc.crc_errors += crc_errors
+
+        if (lossy_blocks) :
+            wpc.lossy_blocks = 1
+
+        if (wps.sample_index < block_index) :
+            yield [0] * ((block_index - wps.sample_index) * num_channels)
+        elif (wps.sample_index > block_index) :
+            samples = samples[(wps.sample_index - block_index) * num_channels:]
+
+        wps.sample_index = block_index + block_samples
+
+        yield samples
+
+
+# Get total number of samples contained in the WavPack file, or -1 if unknown
+
+def WavpackGetNumSamples(wpc) :
+    # -1 would mean an unknown number of samples
+
+    if( None != wpc) :
+        return (wpc.total_samples)
+    else :
+        return -1
+
+
+# Get the current sample index position, or -1 if unknown
 
-        for i in range(0, 32 - bleft) : 
-            buffer[bleft + i] = temp[i];
+def WavpackGetSampleIndex (wpc) :
+    if (None != wpc) :
+        return wpc.stream.sample_index;
+
+    return -1;
+
+
+# Get the number of errors encountered so far
+
+def WavpackGetNumErrors(wpc) :
+    if( None != wpc) :
+        return wpc.crc_errors
+    else :
+        return 0
+
+
+# Select how block crcs are checked for the specified context; "mode" is one
+# of the CRC_xxx values above. The mode is picked up by each block as it is
+# started, so a change takes effect right away if nothing has been decoded
+# from the current block yet, and otherwise from the next block.
+
+def WavpackSetCrcMode(wpc, mode) :
+    if (mode != CRC_STRICT and mode != CRC_DEFERRED and mode != CRC_DISABLED) :
+        wpc.error_message = "invalid crc mode!"
+        return FALSE
+
+    wpc.crc_mode = mode
+
+    if (wpc.stream.sample_index == wpc.stream.wphdr.block_index) :
+        for stream in wpc.streams[0:wpc.num_streams] :
+            stream.crc_mode = mode
+
+    return TRUE
+
+
+# return if any uncorrected lossy blocks were actually written or read
+
+def WavpackLossyBlocks (wpc) :
+    if(None != wpc) :
+         return wpc.lossy_blocks
+    else :
+        return 0
+
+
+# Returns the sample rate of the specified WavPack file
 
-        bleft = 32;
+def WavpackGetSampleRate(wpc) :
+    if ( None != wpc and wpc.config.sample_rate != 0) :
+        return wpc.config.sample_rate
+    else :
+        return 44100
 
-        buf4 = ord(buffer[4])
-        buf6 = ord(buffer[6])
-        buf7 = ord(buffer[7])
-        buf8 = ord(buffer[8])
-        buf9 = ord(buffer[9])
         
-        if  buffer[0] == 'w' and buffer[1] == 'v' and buffer[2] == 'p' and buffer[3] == 'k' \
-            and (buf4 & 1) == 0 and buf6 < 16 and buf7 == 0 and buf9 == 4 \
-            and buf8 >= (MIN_STREAM_VERS & 0xff) and buf8 <= (MAX_STREAM_VERS & 0xff) :
+# Returns the number of channels of the specified WavPack file.
+
+def WavpackGetNumChannels(wpc) :
+    if ( None != wpc and wpc.config.num_channels != 0) :
+        return wpc.config.num_channels
+    else :
+        return 2
+
+
+# Returns the channel mask of the channels decoded from the specified
+# WavPack file, with the bits assigned to speaker positions as in the
+# Microsoft WAVEFORMATEXTENSIBLE structure. The channels are returned in the
+# order of the bits that are set, followed by any channels that have no bit.
+# Unless only some channels were asked for on open, this is the file's mask.
+
+def WavpackGetChannelMask(wpc) :
+    if (None != wpc and wpc.channel_select != 0) :
+        return wpc.config.channel_mask & wpc.channel_select
+    elif (None != wpc) :
+        return wpc.config.channel_mask
+    else :
+        return 3
+
+
+# Returns the actual number of valid bits per sample contained in the
+# original file, which may or may not be a multiple of 8. Floating data
+# always has 32 bits, integers may be from 1 to 32 bits each. When this
+# value is not a multiple of 8, then the "extra" bits are located in the
+# LSBs of the results. That is, values are right justified when unpacked
+# into longs, but are left justified in the number of bytes used by the
+# original data.
+
+def WavpackGetBitsPerSample(wpc) :
+    if (None != wpc and wpc.config.bits_per_sample != 0) :
+        return wpc.config.bits_per_sample
+    else :
+        return 16
+
 
-            wphdr.ckID[0] = 'w';
-            wphdr.ckID[1] = 'v';
-            wphdr.ckID[2] = 'p';
-            wphdr.ckID[3] = 'k';
+# Returns the number of bytes used for each sample (1 to 4) in the original
+# file. This is required information for the user of this module because the
+# audio data is returned in the LOWER bytes of the long buffer and must be
+# left-shifted 8, 16, or 24 bits if normalized longs are required.
 
-            wphdr.ckSize =  (ord(buffer[7]) & 0xFF) << 24
-            wphdr.ckSize += (ord(buffer[6]) & 0xFF) << 16
-            wphdr.ckSize += (ord(buffer[5]) & 0xFF) << 8
-            wphdr.ckSize +=  ord(buffer[4]) & 0xFF
+def WavpackGetBytesPerSample(wpc) :
+    if ( None != wpc and wpc.config.bytes_per_sample != 0) :
+        return wpc.config.bytes_per_sample
+    else :
+        return 2
 
-            wphdr.version =  ord(buffer[9]) << 8
-            wphdr.version += ord(buffer[8])
 
-            wphdr.track_no = ord(buffer[10])
-            wphdr.index_no = ord(buffer[11])
+# This function will return the actual number of channels decoded from the
+# file, which is the number of values in each complete sample returned by
+# the WavpackUnpackXxx() functions. This is the same as
+# WavpackGetNumChannels() unless only some channels were asked for on open.
 
-            wphdr.total_samples =  (ord(buffer[15]) & 0xFF) << 24
-            wphdr.total_samples += (ord(buffer[14]) & 0xFF) << 16
-            wphdr.total_samples += (ord(buffer[13]) & 0xFF) << 8
-            wphdr.total_samples +=  ord(buffer[12]) & 0xFF
+def WavpackGetReducedChannels(wpc) :
+    if (None != wpc and wpc.reduced_channels != 0) :
+        return wpc.reduced_channels
+    elif (None != wpc and wpc.config.num_channels != 0) :
+        return wpc.config.num_channels
+    else :
+        return 2
 
-            wphdr.block_index =  (ord(buffer[19]) & 0xFF) << 24
-            wphdr.block_index += (ord(buffer[18]) & 0xFF) << 16
-            wphdr.block_index += (ord(buffer[17]) & 0xFF) << 8
-            wphdr.block_index +=  ord(buffer[16]) & 0XFF
 
-            wphdr.block_samples =  (ord(buffer[23]) & 0xFF) << 24
-            wphdr.block_samples += (ord(buffer[22]) & 0xFF) << 16
-            wphdr.block_samples += (ord(buffer[21]) & 0xFF) << 8
-            wphdr.block_samples +=  ord(buffer[20]) & 0XFF
 
-            wphdr.flags =  (ord(buffer[27]) & 0xFF) << 24
-            wphdr.flags += (ord(buffer[26]) & 0xFF) << 16
-            wphdr.flags += (ord(buffer[25]) & 0xFF) << 8
-            wphdr.flags +=  ord(buffer[24]) & 0xFF
+# Read from current file position until a valid 32-byte WavPack 4.0 header is
+# found and read into the specified pointer. If no WavPack header is found within 1 meg,
+# then an error is returned. No additional bytes are read past the header. 
 
-            wphdr.crc =  (ord(buffer[31]) & 0xFF) << 24
-            wphdr.crc += (ord(buffer[30]) & 0xFF) << 16
-            wphdr.crc += (ord(buffer[29]) & 0xFF) << 8
-            wphdr.crc +=  ord(buffer[28]) & 0xFF
+def read_next_header(infile, wphdr) :
+    buffer = bytearray()    # 32 is the size of a WavPack Header
+    bytes_skipped = 0
 
-            wphdr.status = 0;
+    while (TRUE) :
+        try :
+            temp = infile.read(32 - len(buffer))
+        except:
+            wphdr.status = 1;
+            return wphdr;
 
+        # Check if we are at the end of the file
+        if len(temp) < (32 - len(buffer)) :
+            wphdr.status = 1;
             return wphdr;
-        else :
-            counter = counter + 1
-            bleft = bleft - 1
 
-        while (bleft > 0 and buffer[counter] != 'w') :
-            counter = counter + 1
-            bleft = bleft - 1
+        buffer += temp
 
+        if (parse_header(buffer, 0, wphdr) == TRUE) :
+            return wphdr;
+
+        counter = buffer.find(b'w', 1)
+
+        if (counter < 0) :
+            counter = 32
+
+        del buffer[0:counter]
         bytes_skipped = bytes_skipped + counter;
 
-        if (bytes_skipped > 1048576L) :
+        if (bytes_skipped > 1048576) :
             wphdr.status = 1;
             return wphdr;
 
 
-def getbit(bs) :
-    uns_buf = 0
+# Find the number of samples in a file from the last block with audio in it
+# (block_index + block_samples), for files whose headers don't give it. The
+# file is read backwards from the end TAIL_SCAN_SIZE bytes at a time until
+# a valid header is found whose block fits in the file, so this reads at
+# most about one block (plus any tags at the end) whatever the file size.
+# The file position is restored afterwards. Returns -1 if the file isn't
+# seekable or no such header is found.
 
-    if (bs.bc > 0) :
-        bs.bc = bs.bc - 1
-    else :
-        bs.ptr = bs.ptr + 1
-        bs.buf_index = bs.buf_index + 1
-        bs.bc = 7;
+def find_final_index(infile) :
+    wphdr = WavpackHeader()
 
-        if (bs.ptr == bs.end) :
-            # wrap call here
-            bs = bs_read(bs);
-        uns_buf = ord(bs.buf[bs.buf_index]) & 0xff
-        bs.sr = uns_buf;
+    try :
+        saved_position = infile.tell()
+        infile.seek(0, 2)
+        file_size = infile.tell()
+    except (AttributeError, IOError, OSError, ValueError) :
+        return -1
 
-    bs.bitval = (bs.sr & 1);
-    bs.sr = bs.sr >> 1;
+    end = file_size
+    data = bytearray()
+    result = -1
 
-    return bs;
+    while (end > 0) :
+        start = max(end - TAIL_SCAN_SIZE, 0)
+        infile.seek(start)
+        data[0:0] = infile.read(end - start)
+        end = start
 
+        # headers starting in the bytes just read, from the last one back;
+        # the first 31 bytes of the previous read let one straddle the two
 
-def getbits(nbits, bs) :
-    uns_buf = 0
-    value = 0
+        index = data.rfind(b'wvpk', 0, TAIL_SCAN_SIZE + 31)
 
-    while ((nbits) > bs.bc) :
-        bs.ptr = bs.ptr + 1
-        bs.buf_index = bs.buf_index + 1
+        while (index >= 0) :
+            offset = start + index
 
-        if (bs.ptr == bs.end) :
-            bs = bs_read(bs);
-        uns_buf = ord(bs.buf[bs.buf_index]) & 0xff
-        bs.sr = bs.sr | (uns_buf << bs.bc); # values in buffer must be unsigned
-        bs.sr = bs.sr & 0xffffffff # bs.sr is unsigned 32 bit
-        bs.bc += 8;
+            if (index + 32 <= len(data) and parse_header(data, index, wphdr) == TRUE
+                and wphdr.block_samples > 0 and offset + wphdr.ckSize + 8 <= file_size) :
+                result = wphdr.block_index + wphdr.block_samples
+                break
 
-    value = bs.sr;
+            index = data.rfind(b'wvpk', 0, index)
 
-    if (bs.bc > 32) :
-        bs.bc -= (nbits);
-        bs.sr = (ord(bs.buf[bs.buf_index]) & 0xff) >> (8 - bs.bc);
-    else :
-        bs.bc -= (nbits);
-        bs.sr >>= (nbits);
+        if (result != -1) :
+            break
 
-    return (value)
+        del data[TAIL_SCAN_SIZE + 31:]
 
+    infile.seek(saved_position)
 
-def bs_open_read(stream, buffer_start, buffer_end, file, file_bytes, passed) :
-    bs = Bitstream();
+    return result
 
-    bs.buf = stream;
-    bs.buf_index = buffer_start;
-    bs.end = buffer_end;
-    bs.sr = 0;
-    bs.bc = 0;
 
-    if (passed != 0) :
-        bs.ptr = bs.end - 1;
-        bs.file_bytes = file_bytes;
-        bs.file = file;
-    else :
-        # Strange to set an index to -1, but the very first call to getbit will iterate this 
-        bs.buf_index = -1;
-        bs.ptr = -1;
+# Check for a valid WavPack 4.0 block header at "offset" in "data" (at least
+# 32 bytes must be there) and if there is one read it into "wphdr" and
+# return TRUE. This works on bytes alone, so it is shared by the file
+# reader and the push decoder.
 
-    return bs;
+def parse_header(data, offset, wphdr) :
+    ckID, ckSize, version, track_no, index_no, total_samples, block_index, \
+        block_samples, flags, crc = struct.unpack_from(WAVPACK_HEADER_FORMAT, data, offset)
 
+    if (ckID != b'wvpk' or (ckSize & 1) != 0 or ckSize >= 0x100000 or (version >> 8) != 4
+        or (version & 0xff) < (MIN_STREAM_VERS & 0xff) or (version & 0xff) > (MAX_STREAM_VERS & 0xff)) :
+        return FALSE
 
-def bs_read(bs) :
-    if (bs.file_bytes > 0) :
-        bytes_read = 0
-        bytes_to_read = 1024;
+    wphdr.ckID = ckID
+    wphdr.ckSize = ckSize
+    wphdr.version = version
+    wphdr.track_no = track_no
+    wphdr.index_no = index_no
+    wphdr.total_samples = total_samples
+    wphdr.block_index = block_index
 
-        if (bytes_to_read > bs.file_bytes) :
-            bytes_to_read = bs.file_bytes;
+    if (total_samples == 0xffffffff) :
+        wphdr.total_samples = -1    # the length wasn't known when it was written
 
-        try :
-            buf = [0] * 1024
-            buf = bs.file.read(bytes_to_read)
-            bytes_read = bytes_to_read
-            bs.buf_index = 0
-            bs.buf = buf
-        except :
-            bytes_read = 0;
-
-        if (bytes_read > 0) :
-            bs.end = bytes_read
-            bs.file_bytes -= bytes_read;
-        else :
-            for i in range(0, bs.end - bs.buf_index) :
-                bs.buf[i] = -1
-            bs.error = 1;
+    wphdr.block_samples = block_samples
+    wphdr.flags = flags
+    wphdr.crc = crc
+    wphdr.status = 0;
+
+    return TRUE
+
+
+# Create a bitstream over "data", the complete contents of a bitstream
+# metadata block. The data is converted to a tuple of little-endian 32-bit
+# words once, so bits can later be loaded into the bit window 32 at a time.
+# A partial last word is padded with ones.
+
+def bs_open_read(data) :
+    bs = Bitstream()
+    count = len(data) // 4
+
+    bs.words = struct.unpack_from('<%dI' % count, data)
+
+    if ((len(data) & 3) != 0) :
+        tail = bytearray(data[count * 4:]) + bytearray(b'\xff\xff\xff')
+        bs.words += struct.unpack('<I', bytes(tail[0:4]))
+
+    return bs
+
+
+# Load the next 32-bit word into the bit window. Past the end of the data
+# the bitstream reads as all ones (which makes get_words() stop) and the
+# error flag is set. Callers only do this when the window holds fewer bits
+# than they are about to read, at most WORD_BITS (which get_words() tops
+# the window up to before each word), so it never holds more than
+# WORD_BITS + 31 bits.
+
+def bs_fill(bs) :
+    if (bs.word_index < len(bs.words)) :
+        bs.sr |= bs.words[bs.word_index] << bs.bc
+        bs.word_index += 1
     else :
-        bs.error = 1;
+        bs.sr |= 0xffffffff << bs.bc
+        bs.error = 1
+
+    bs.bc += 32
+
+
+# Read a "nbits" (0 to 32) bit value, which is stored lowest bit first
+
+def bs_getbits(bs, nbits) :
+    if (bs.bc < nbits) :
+        bs_fill(bs)
 
-    if (bs.error > 0) :
-        for i in range(0,bs.end - bs.buf_index) :
-            bs.buf[i] = -1;
+    value = bs.sr & ((1 << nbits) - 1)
+    bs.sr >>= nbits
+    bs.bc -= nbits
 
-    bs.ptr = 0;
-    bs.buf_index = 0;
+    return value
 
-    return bs;
 
+# Read a unary coded value, that is a run of 1 bits ended by a 0 bit, and
+# return the number of 1s. The run is counted a window at a time rather
+# than bit by bit. If "limit" 1s are read the count stops there (without
+# reading a 0 bit) and "limit" is returned.
+
+def bs_unary(bs, limit) :
+    count = 0
+
+    while (TRUE) :
+        if (bs.bc == 0) :
+            bs_fill(bs)
+
+        sr = bs.sr
+        run = (~sr & (sr + 1)).bit_length() - 1    # number of trailing 1s
+
+        if (count + run >= limit) :
+            bs.sr >>= limit - count
+            bs.bc -= limit - count
+            return limit
+
+        if (run < bs.bc) :
+            bs.sr >>= run + 1
+            bs.bc -= run + 1
+            return count + run
+
+        count += run
+        bs.sr = 0
+        bs.bc = 0
 
 
 def read_float_info (wps, wpmd) :
     bytecnt = wpmd.byte_length
-    byteptr = wpmd.data
+    byteptr = struct.unpack_from('<%dB' % wpmd.byte_length, wpmd.data)
     counter = 0;
 
     if bytecnt != 4 :
         return FALSE
 
-    wps.float_flags = ord(byteptr[counter])
+    wps.float_flags = byteptr[counter]
     counter = counter + 1
-    wps.float_shift = ord(byteptr[counter])
+    wps.float_shift = byteptr[counter]
     counter = counter + 1
-    wps.float_max_exp = ord(byteptr[counter])
+    wps.float_max_exp = byteptr[counter]
     counter = counter + 1
-    wps.float_norm_exp = ord(byteptr[counter])
+    wps.float_norm_exp = byteptr[counter]
 
     return TRUE;
 
 
-def float_values (wps, values, num_values) :
+def float_values (wps, values, num_values, value_counter) :
     shift = wps.float_max_exp - wps.float_norm_exp + wps.float_shift
-    value_counter = 0
 
     if (shift > 32) :
         shift = 32
@@ -919,10 +2339,10 @@ def float_values (wps, values, num_values) :
         elif (shift < 0) :
             values[value_counter] >>= -shift
 
-        if (values[value_counter] > 8388607L) :
-            values[value_counter] = 8388607L
-        elif (values[value_counter] < -8388608L) :
-            values[value_counter] = -8388608L
+        if (values[value_counter] > 8388607) :
+            values[value_counter] = 8388607
+        elif (values[value_counter] < -8388608) :
+            values[value_counter] = -8388608
 
         value_counter = value_counter + 1
         num_values = num_values - 1
@@ -930,152 +2350,184 @@ def float_values (wps, values, num_values) :
     return values
 
 
+# The other way of finishing float data, used for WavpackUnpackFloat32Into():
+# each value becomes the bits of the IEEE 32-bit float it came from (as a
+# signed int), the same as the C library without a wvx file. The value is
+# the mantissa for an exponent of float_max_exp, which is normalized here,
+# with the bits shifted in filled with ones if the block says so.
+
+def float_bits_values(wps, values, num_values, value_counter) :
+    while (num_values > 0) :
+        value = values[value_counter]
+        outval = 0
+
+        if (value != 0) :
+            value <<= wps.float_shift
+            exp = wps.float_max_exp
+            shift_count = 0
+
+            if (value < 0) :
+                value = -value
+                outval = 0x80000000
+
+            if (value == 0x1000000) :
+                outval |= 255 << 23
+            else :
+                while (exp > 0 and (value & 0x800000) == 0) :
+                    exp = exp - 1
+
+                    if (exp == 0) :
+                        break
+
+                    shift_count = shift_count + 1
+                    value <<= 1
+
+                if (shift_count > 0 and (wps.float_flags & FLOAT_SHIFT_ONES) != 0) :
+                    value |= (1 << shift_count) - 1
+
+                outval |= (value & 0x7fffff) | ((exp & 0xff) << 23)
+
+        if (outval >= 0x80000000) :
+            outval -= 0x100000000
+
+        values[value_counter] = outval
+        value_counter = value_counter + 1
+        num_values = num_values - 1
+
+    return values
+
 
 def read_metadata_buff(wpc, wpmd) :
-    bytes_to_read = 0;
-    tchar = 0;
+    wps = wpc.stream
+    blockbuff = wps.blockbuff
+    index = wps.blockbuff_index
 
-    try :
-        wpmd.id = ord(wpc.infile.read(1))
-        tchar =   ord(wpc.infile.read(1))
-    except:
+    if (index + 2 > len(blockbuff)) :
         wpmd.status = 1;
         return FALSE
 
+    wpmd.id, tchar = struct.unpack_from('<BB', blockbuff, index)
+    index += 2
+
     wpmd.byte_length = tchar << 1;
 
     if ((wpmd.id & ID_LARGE) != 0) :
         wpmd.id &= ~ID_LARGE;
 
-        try :
-            tchar = ord(wpc.infile.read(1));
-        except:
+        if (index + 2 > len(blockbuff)) :
             wpmd.status = 1;
             return FALSE;
 
-        wpmd.byte_length += tchar << 9;
-
-        try :
-            tchar = ord(wpc.infile.read(1));
-        except:
-            wpmd.status = 1;
-            return FALSE;
+        tchar, tchar2 = struct.unpack_from('<BB', blockbuff, index)
+        index += 2
 
-        wpmd.byte_length += tchar << 17;
+        wpmd.byte_length += (tchar << 9) + (tchar2 << 17);
 
     if ((wpmd.id & ID_ODD_SIZE) != 0) :
         wpmd.id &= ~ID_ODD_SIZE;
         wpmd.byte_length = wpmd.byte_length - 1
 
-    if (wpmd.byte_length == 0 or wpmd.id == ID_WV_BITSTREAM) :
-        wpmd.hasdata = FALSE;
-        return TRUE;
-
     bytes_to_read = wpmd.byte_length + (wpmd.byte_length & 1)
-    
-    if (bytes_to_read > wpc.READ_BUFFER_SIZE) :
-        bytes_read = 0
-        wpmd.hasdata = FALSE;
-
-        while (bytes_to_read > wpc.READ_BUFFER_SIZE) :
-            try :
-                wpc.read_buffer = wpc.infile.read( wpc.READ_BUFFER_SIZE )
-                bytes_read = len(wpc.read_buffer)
-                if(bytes_read != wpc.READ_BUFFER_SIZE) :
-                    return FALSE;
-            except:
-                return FALSE;
-            bytes_to_read -= wpc.READ_BUFFER_SIZE
-    else :
-        wpmd.hasdata = TRUE;
-        wpmd.data = wpc.read_buffer;
-
-    if (bytes_to_read != 0) :
-        bytes_read = 0
 
-        try :
-            wpc.read_buffer = wpc.infile.read(bytes_to_read)
-            wpmd.data = wpc.read_buffer
-            bytes_read = len(wpc.read_buffer)
-            if(bytes_read !=  bytes_to_read) :
-                wpmd.hasdata = FALSE;
-                return FALSE;
-        except:
-            wpmd.hasdata = FALSE;
-            return FALSE;
-
-    return TRUE;
-
-def process_metadata(wpc, wpmd) :
-    wps = wpc.stream
+    # only the audio bitstream may be cut short (by a truncated file), in
+    # which case whatever is there is decoded
 
-    try :
-        switch (wpmd.id)
+    if (index + bytes_to_read > len(blockbuff) and wpmd.id != ID_WV_BITSTREAM) :
+        wpmd.status = 1;
+        return FALSE;
 
-    except case(ID_DUMMY):
-        return TRUE;
+    handler = wpc.metadata_handlers.get(wpmd.id)
 
-    except case(ID_DECORR_TERMS):
-        return read_decorr_terms(wps, wpmd);
+    if (handler == None or handler == skip_metadata) :
+        wpmd.data = None
+    else :
+        wpmd.data = blockbuff[index:index + wpmd.byte_length]
 
-    except case(ID_DECORR_WEIGHTS):
-        return read_decorr_weights(wps, wpmd);
+    wpmd.hasdata = (wpmd.byte_length != 0)
+    wps.blockbuff_index = index + bytes_to_read
 
-    except case(ID_DECORR_SAMPLES):
-        return read_decorr_samples(wps, wpmd);
+    return TRUE;
 
-    except case(ID_ENTROPY_VARS):
-        return read_entropy_vars(wps, wpmd);
+# Apply a metadata sub-block with the context's handler for its id (see
+# metadata_handlers below). Ids without a handler are ignored if they are
+# optional and are otherwise an error.
 
-    except case(ID_HYBRID_PROFILE):
-        return read_hybrid_profile(wps, wpmd);
+def process_metadata(wpc, wpmd) :
+    handler = wpc.metadata_handlers.get(wpmd.id)
 
-    except case(ID_FLOAT_INFO):
-        return read_float_info(wps, wpmd);
+    if (handler != None) :
+        return handler(wpc, wpmd)
+    elif ((wpmd.id & ID_OPTIONAL_DATA) != 0) :
+        return TRUE
+    else :
+        return FALSE
 
-    except case(ID_INT32_INFO):
-        return read_int32_info(wps, wpmd);
 
-    except case(ID_CHANNEL_INFO):
-        return read_channel_info(wpc, wpmd);
+# Handler for metadata that is passed over; its data isn't even sliced from
+# the block by read_metadata_buff()
 
-    except case(ID_SAMPLE_RATE):
-        return read_sample_rate(wpc, wpmd);
+def skip_metadata(wpc, wpmd) :
+    return TRUE
 
-    except case(ID_CONFIG_BLOCK):
-        return read_config_info(wpc, wpmd);
 
-    except case(ID_WV_BITSTREAM):
-        return init_wv_bitstream(wpc, wpmd);
+# Have "handler" called as handler(wpc, wpmd) for each metadata sub-block
+# with the given id (one of the ID_xxx values above, such as ID_RIFF_HEADER,
+# ID_REPLAY_GAIN, ID_CUESHEET or ID_MD5_CHECKSUM) in the blocks unpacked.
+# wpmd.data holds its wpmd.byte_length bytes of data, which are only valid
+# during the call, and the handler returns TRUE, or FALSE if the data is
+# invalid. A handler of None skips the id without looking at its data.
+# Given a context "wpc", the handler is used for that context only (which
+# gets its own copy of the table the first time). The file open functions
+# read the first block before returning, so handlers for its metadata have
+# to be passed to them instead (their "handlers" argument). Otherwise the
+# handler goes in the global table, which is used by every context that
+# hasn't been given a handler of its own (but not by the workers started by
+# WavpackUnpackParallel(), which are in other processes). The ids used for
+# decoding shouldn't be given other handlers.
+
+def WavpackSetMetadataHandler(id, handler, wpc = None) :
+    if (handler == None) :
+        handler = skip_metadata
+
+    if (wpc == None) :
+        metadata_handlers[id] = handler
+    else :
+        if (wpc.metadata_handlers is metadata_handlers) :
+            wpc.metadata_handlers = dict(metadata_handlers)
 
-    except multicase(ID_SHAPING_WEIGHTS , ID_WVC_BITSTREAM , ID_WVX_BITSTREAM):
-        return TRUE;
+        wpc.metadata_handlers[id] = handler
 
-    except:
-        if ((wpmd.id & ID_OPTIONAL_DATA) != 0) :
-            return TRUE
-        else :
-            return FALSE
 
+# Set up the "handlers" dict (id : handler) given on open for the context
 
+def set_metadata_handlers(wpc, handlers) :
+    if (handlers != None) :
+        for id in handlers :
+            WavpackSetMetadataHandler(id, handlers[id], wpc)
 
 
 # This function initializes everything required to unpack a WavPack block
 # and must be called before unpack_samples() is called to obtain audio data.
 # It is assumed that the WavpackHeader has been read into the wps.wphdr
-# (in the current WavpackStream). This is where all the metadata blocks are
+# (in the current WavpackStream) and "blockbuff" holds the rest of the block
+# (see read_next_block()). This is where all the metadata blocks are
 # scanned up to the one containing the audio bitstream.
 
-def unpack_init(wpc) :
+def unpack_init(wpc, blockbuff) :
     wps = wpc.stream;
     wpmd =WavpackMetadata();
 
     if (wps.wphdr.block_samples > 0 and wps.wphdr.block_index != -1) :
         wps.sample_index = wps.wphdr.block_index;
 
+    wps.blockbuff = blockbuff
+    wps.blockbuff_index = 0
+
     wps.mute_error = 0;
     wps.crc = 0xffffffff;
-    wps.wvbits.sr = 0;
+    wps.crc_mode = wpc.crc_mode
+    wps.crc_values = []
+    wps.wvbits = Bitstream()
 
     while ((read_metadata_buff(wpc, wpmd)) == TRUE) :
         if ((process_metadata(wpc, wpmd)) == FALSE) :
@@ -1086,14 +2538,20 @@ def unpack_init(wpc) :
         if (wpmd.id == ID_WV_BITSTREAM) :
             break;
 
-    
-    if (wps.wphdr.block_samples != 0 and (None == wps.wvbits.file) ) :
+    # everything needed has been taken from the block now, and letting go of
+    # it allows a memory mapping it came from to be closed
+
+    wps.blockbuff = None
+
+    if (wps.wphdr.block_samples != 0 and (None == wps.wvbits.words) ) :
         wpc.error_message = "invalid WavPack file!";
         wpc.error = TRUE;
         return FALSE;
 
 
     if (wps.wphdr.block_samples != 0) :
+        select_decorr(wps)
+
         if ((wps.wphdr.flags & INT32_DATA) != 0 and wps.int32_sent_bits != 0) :
             wpc.lossy_blocks = 1
 
@@ -1112,10 +2570,7 @@ def init_wv_bitstream(wpc, wpmd) :
     wps = wpc.stream;
 
     if (wpmd.hasdata == TRUE) :
-        wps.wvbits = bs_open_read(wpmd.data, 0, wpmd.byte_length, wpc.infile, 0, 0);
-    elif (wpmd.byte_length > 0) :
-        blen = wpmd.byte_length & 1
-        wps.wvbits = bs_open_read(wpc.read_buffer, -1, len(wpc.read_buffer), wpc.infile, (wpmd.byte_length + blen), 1);
+        wps.wvbits = bs_open_read(wpmd.data);
 
     return TRUE;
 
@@ -1129,7 +2584,7 @@ def init_wv_bitstream(wpc, wpmd) :
 
 def read_decorr_terms(wps, wpmd) :
     termcnt = wpmd.byte_length;
-    byteptr = wpmd.data;
+    byteptr = struct.unpack_from('<%dB' % wpmd.byte_length, wpmd.data)
     tmpwps = WavpackStream();
     
     counter = 0;
@@ -1143,12 +2598,15 @@ def read_decorr_terms(wps, wpmd) :
     dcounter = termcnt - 1;
 
     for dcounter in range(termcnt-1,-1,-1) :
-        tmpwps.decorr_passes[dcounter].term =   (ord(byteptr[counter]) & 0x1f) - 5
-        tmpwps.decorr_passes[dcounter].delta =  (ord(byteptr[counter]) >> 5) & 0x7
+        tmpwps.decorr_passes[dcounter].term =   (byteptr[counter] & 0x1f) - 5
+        tmpwps.decorr_passes[dcounter].delta =  (byteptr[counter] >> 5) & 0x7
         
         counter = counter + 1
     
-        if (tmpwps.decorr_passes[dcounter].term < -3 \
+        # there's no term 0, and the decorrelation code can't apply one
+
+        if (tmpwps.decorr_passes[dcounter].term == 0 \
+            or tmpwps.decorr_passes[dcounter].term < -3 \
             or (tmpwps.decorr_passes[dcounter].term > MAX_TERM and tmpwps.decorr_passes[dcounter].term < 17) \
             or tmpwps.decorr_passes[dcounter].term > 18) :
             return FALSE;
@@ -1168,14 +2626,14 @@ def read_decorr_terms(wps, wpmd) :
 def read_decorr_weights(wps, wpmd) :
     termcnt = wpmd.byte_length
     tcount = 0
-    byteptr = wpmd.data
+    byteptr = struct.unpack_from('<%dB' % wpmd.byte_length, wpmd.data)
     dpp = decorr_pass()
     counter = 0
     dpp_idx = 0
     myiterator = 0
 
     if ((wps.wphdr.flags & (MONO_FLAG | FALSE_STEREO)) == 0) :
-        termcnt /= 2;
+        termcnt //= 2;
 
     if (termcnt > wps.num_terms) :
         return FALSE;
@@ -1191,7 +2649,7 @@ def read_decorr_weights(wps, wpmd) :
         
         # We need the input to restore_weight to be a signed value
         
-        signedCalc1 = ord(byteptr[counter])
+        signedCalc1 = byteptr[counter]
 
         if signedCalc1 & 0x80 == 0x80:
             signedCalc1 = signedCalc1 & 0x7F
@@ -1206,7 +2664,7 @@ def read_decorr_weights(wps, wpmd) :
         if ((wps.wphdr.flags & (MONO_FLAG | FALSE_STEREO)) == 0) :
             # We need the input to restore_weight to be a signed value
 
-            signedCalc1 = ord(byteptr[counter])
+            signedCalc1 = byteptr[counter]
 
             if signedCalc1 & 0x80 == 0x80:
                 signedCalc1 = signedCalc1 & 0x7F
@@ -1238,137 +2696,52 @@ def read_decorr_weights(wps, wpmd) :
 # those must obviously come first in the metadata.
 
 def read_decorr_samples(wps, wpmd) :
-    byteptr = wpmd.data;
-    dpp = decorr_pass();
-    tcount = 0
+    byteptr = struct.unpack_from('<%dh' % (wpmd.byte_length // 2), wpmd.data)
     counter = 0
-    dpp_index = 0;
-    uns_buf0 = 0
-    uns_buf1 = 0
-    uns_buf2 = 0
-    uns_buf3 = 0
-    sample_counter = 0
-
-    for tcount in range(wps.num_terms,0,-1) :
-        dpp.term = wps.decorr_passes[dpp_index].term;
+    mono = (wps.wphdr.flags & (MONO_FLAG | FALSE_STEREO)) != 0
 
+    for dpp_index in range(0, wps.num_terms) :
         for internalc in range(0,MAX_TERM) :
-            dpp.samples_A[internalc] = 0;
-            dpp.samples_B[internalc] = 0;
             wps.decorr_passes[dpp_index].samples_A[internalc] = 0;
             wps.decorr_passes[dpp_index].samples_B[internalc] = 0;
 
-        dpp_index = dpp_index + 1
-
     if (wps.wphdr.version == 0x402 and (wps.wphdr.flags & HYBRID_FLAG) > 0) :
-        counter += 2;
-
-        if ((wps.wphdr.flags & (MONO_FLAG | FALSE_STEREO)) == 0) :
-            counter += 2;
-
-    dpp_index = dpp_index - 1
-    
-    while (counter < wpmd.byte_length) :
-        if (dpp.term > MAX_TERM) :
-            uns_buf0 =  ord(byteptr[counter]) & 0xff
-            uns_buf1 =  ord(byteptr[counter + 1]) & 0xff
-            uns_buf2 =  ord(byteptr[counter + 2]) & 0xff
-            uns_buf3 =  ord(byteptr[counter + 3]) & 0xff
-
-            # We need to convert to 16-bit signed values
-            # 0x8000 represents the left most bit in a 16-bit value
-            # 0x7fff masks all bits except the leftmost in 16 bits
-            
-            signedCalc1 = uns_buf0 + (uns_buf1 << 8)
-            if signedCalc1 & 0x8000 == 0x8000:
-                signedCalc1 = signedCalc1 & 0x7FFF
-                signedCalc1 = signedCalc1 - 0x8000
-
-            signedCalc2 = uns_buf2 + (uns_buf3 << 8)
-            if signedCalc2 & 0x8000 == 0x8000:
-                signedCalc2 = signedCalc2 & 0x7FFF
-                signedCalc2 = signedCalc2 - 0x8000
-
-            dpp.samples_A[0] = exp2s( signedCalc1 );
-            dpp.samples_A[1] = exp2s( signedCalc2 );
-            counter += 4;
-
-            if ((wps.wphdr.flags & (MONO_FLAG | FALSE_STEREO)) == 0) :
-                uns_buf0 =  ord(byteptr[counter]) & 0xff
-                uns_buf1 =  ord(byteptr[counter + 1]) & 0xff
-                uns_buf2 =  ord(byteptr[counter + 2]) & 0xff
-                uns_buf3 =  ord(byteptr[counter + 3]) & 0xff
-
-                signedCalc1 = uns_buf0 + (uns_buf1 << 8)
-                if signedCalc1 & 0x8000 == 0x8000:
-                    signedCalc1 = signedCalc1 & 0x7FFF
-                    signedCalc1 = signedCalc1 - 0x8000
-
-                signedCalc2 = uns_buf2 + (uns_buf3 << 8)
-                if signedCalc2 & 0x8000 == 0x8000:
-                    signedCalc2 = signedCalc2 & 0x7FFF
-                    signedCalc2 = signedCalc2 - 0x8000
-
-                dpp.samples_B[0] = exp2s( signedCalc1 )
-                dpp.samples_B[1] = exp2s( signedCalc2 )
-                counter += 4;
-
-        elif (dpp.term < 0) :
-            
-            uns_buf0 =  ord(byteptr[counter]) & 0xff
-            uns_buf1 =  ord(byteptr[counter + 1]) & 0xff
-            uns_buf2 =  ord(byteptr[counter + 2]) & 0xff
-            uns_buf3 =  ord(byteptr[counter + 3]) & 0xff
-
-            signedCalc1 = uns_buf0 + (uns_buf1 << 8)
-            if signedCalc1 & 0x8000 == 0x8000:
-                signedCalc1 = signedCalc1 & 0x7FFF
-                signedCalc1 = signedCalc1 - 0x8000
-                
-            signedCalc2 = uns_buf2 + (uns_buf3 << 8)
-            if signedCalc2 & 0x8000 == 0x8000:
-                signedCalc2 = signedCalc2 & 0x7FFF
-                signedCalc2 = signedCalc2 - 0x8000
+        counter += 1;
 
-            dpp.samples_A[0] = exp2s( signedCalc1 )
-            dpp.samples_B[0] = exp2s( signedCalc2 )
+        if (not mono) :
+            counter += 1;
 
-            counter += 4;
-        else :
+    # the values are signed 16-bit log2 values, and each pass has its own
+    # layout depending on its term
 
-            m = 0
-            cnt = dpp.term
+    dpp_index = wps.num_terms - 1
 
-            while (cnt > 0) :
-                uns_buf0 =  ord(byteptr[counter]) & 0xff
-                uns_buf1 =  ord(byteptr[counter + 1]) & 0xff
+    while (counter < len(byteptr) and dpp_index >= 0) :
+        dpp = wps.decorr_passes[dpp_index]
 
-                signedCalc1 = uns_buf0 + (uns_buf1 << 8)
-                if signedCalc1 & 0x8000 == 0x8000:
-                    signedCalc1 = signedCalc1 & 0x7FFF
-                    signedCalc1 = signedCalc1 - 0x8000
+        if (dpp.term > MAX_TERM) :
+            dpp.samples_A[0] = exp2s(byteptr[counter])
+            dpp.samples_A[1] = exp2s(byteptr[counter + 1])
+            counter += 2;
 
-                dpp.samples_A[m] = exp2s(signedCalc1)
+            if (not mono) :
+                dpp.samples_B[0] = exp2s(byteptr[counter])
+                dpp.samples_B[1] = exp2s(byteptr[counter + 1])
                 counter += 2;
 
-                if ((wps.wphdr.flags & (MONO_FLAG | FALSE_STEREO)) == 0) :
-                    uns_buf0 =  ord(byteptr[counter]) & 0xff
-                    uns_buf1 =  ord(byteptr[counter + 1]) & 0xff
-
-                    signedCalc1 = uns_buf0 + (uns_buf1 << 8)
-                    if signedCalc1 & 0x8000 == 0x8000:
-                        signedCalc1 = signedCalc1 & 0x7FFF
-                        signedCalc1 = signedCalc1 - 0x8000
-                        
-                    dpp.samples_B[m] = exp2s( signedCalc1 )
-                    counter += 2;
+        elif (dpp.term < 0) :
+            dpp.samples_A[0] = exp2s(byteptr[counter])
+            dpp.samples_B[0] = exp2s(byteptr[counter + 1])
+            counter += 2;
 
-                m = m + 1
-                cnt = cnt - 1
+        else :
+            for m in range(0, dpp.term) :
+                dpp.samples_A[m] = exp2s(byteptr[counter])
+                counter += 1;
 
-        for sample_counter in range(0,MAX_TERM) :
-            wps.decorr_passes[dpp_index].samples_A[sample_counter] = dpp.samples_A[sample_counter]
-            wps.decorr_passes[dpp_index].samples_B[sample_counter] = dpp.samples_B[sample_counter]
+                if (not mono) :
+                    dpp.samples_B[m] = exp2s(byteptr[counter])
+                    counter += 1;
 
         dpp_index = dpp_index - 1
 
@@ -1382,19 +2755,19 @@ def read_decorr_samples(wps, wpmd) :
 def read_int32_info( wps, wpmd) :
 
     bytecnt = wpmd.byte_length
-    byteptr = wpmd.data
+    byteptr = struct.unpack_from('<%dB' % wpmd.byte_length, wpmd.data)
     counter = 0
 
     if (bytecnt != 4) :
         return FALSE
 
-    wps.int32_sent_bits = ord(byteptr[counter])
+    wps.int32_sent_bits = byteptr[counter]
     counter = counter + 1
-    wps.int32_zeros = ord(byteptr[counter])
+    wps.int32_zeros = byteptr[counter]
     counter = counter + 1
-    wps.int32_ones = ord(byteptr[counter])
+    wps.int32_ones = byteptr[counter]
     counter = counter + 1
-    wps.int32_dups = ord(byteptr[counter])
+    wps.int32_dups = byteptr[counter]
 
     return TRUE;
 
@@ -1408,21 +2781,18 @@ def read_channel_info(wpc, wpmd) :
 
     bytecnt = wpmd.byte_length
     shift = 0
-    byteptr = wpmd.data
-    counter = 0
     mask = 0
 
     if (bytecnt == 0 or bytecnt > 5) :
         return FALSE
 
-    wpc.config.num_channels = ord(byteptr[counter])
-    counter = counter + 1
+    byteptr = struct.unpack_from('<%dB' % bytecnt, wpmd.data)
 
-    while (bytecnt >= 0) :
-        mask |= (ord(byteptr[counter]) & 0xFF) << shift
-        counter = counter + 1
+    wpc.config.num_channels = byteptr[0]
+
+    for counter in range(1, bytecnt) :
+        mask |= byteptr[counter] << shift
         shift = shift + 8
-        bytecnt = bytecnt - 1
 
     wpc.config.channel_mask = mask
     return TRUE
@@ -1433,16 +2803,16 @@ def read_channel_info(wpc, wpmd) :
 def read_config_info(wpc, wpmd) :
 
     bytecnt = wpmd.byte_length
-    byteptr = wpmd.data
+    byteptr = struct.unpack_from('<%dB' % wpmd.byte_length, wpmd.data)
     counter = 0
 
     if (bytecnt >= 3) :
         wpc.config.flags &= 0xff
-        wpc.config.flags |= (ord(byteptr[counter]) & 0xFF) << 8
+        wpc.config.flags |= (byteptr[counter] & 0xFF) << 8
         counter = counter + 1
-        wpc.config.flags |= (ord(byteptr[counter]) & 0xFF) << 16
+        wpc.config.flags |= (byteptr[counter] & 0xFF) << 16
         counter = counter + 1
-        wpc.config.flags |= (ord(byteptr[counter]) & 0xFF) << 24
+        wpc.config.flags |= (byteptr[counter] & 0xFF) << 24
 
     return TRUE;
 
@@ -1451,19 +2821,47 @@ def read_config_info(wpc, wpmd) :
 
 def read_sample_rate(wpc, wpmd) :
     bytecnt = wpmd.byte_length
-    byteptr = wpmd.data
+    byteptr = struct.unpack_from('<%dB' % wpmd.byte_length, wpmd.data)
     counter = 0
 
     if (bytecnt == 3) :
-        wpc.config.sample_rate = ord(byteptr[counter]) & 0xFF
+        wpc.config.sample_rate = byteptr[counter] & 0xFF
         counter = counter + 1
-        wpc.config.sample_rate |= (ord(byteptr[counter]) & 0xFF) << 8
+        wpc.config.sample_rate |= (byteptr[counter] & 0xFF) << 8
         counter = counter + 1
-        wpc.config.sample_rate |= (ord(byteptr[counter]) & 0xFF) << 16
+        wpc.config.sample_rate |= (byteptr[counter] & 0xFF) << 16
     
     return TRUE
 
 
+# The function that reads each type of metadata sub-block, looked up by
+# process_metadata(). The ones that read into the stream being unpacked are
+# given it from the context.
+
+metadata_handlers = {
+    ID_DUMMY : skip_metadata,
+    ID_DECORR_TERMS : lambda wpc, wpmd : read_decorr_terms(wpc.stream, wpmd),
+    ID_DECORR_WEIGHTS : lambda wpc, wpmd : read_decorr_weights(wpc.stream, wpmd),
+    ID_DECORR_SAMPLES : lambda wpc, wpmd : read_decorr_samples(wpc.stream, wpmd),
+    ID_ENTROPY_VARS : lambda wpc, wpmd : read_entropy_vars(wpc.stream, wpmd),
+    ID_HYBRID_PROFILE : lambda wpc, wpmd : read_hybrid_profile(wpc.stream, wpmd),
+    ID_FLOAT_INFO : lambda wpc, wpmd : read_float_info(wpc.stream, wpmd),
+    ID_INT32_INFO : lambda wpc, wpmd : read_int32_info(wpc.stream, wpmd),
+    ID_CHANNEL_INFO : read_channel_info,
+    ID_SAMPLE_RATE : read_sample_rate,
+    ID_CONFIG_BLOCK : read_config_info,
+    ID_WV_BITSTREAM : init_wv_bitstream,
+    ID_SHAPING_WEIGHTS : skip_metadata,
+    ID_WVC_BITSTREAM : skip_metadata,
+    ID_WVX_BITSTREAM : skip_metadata,
+    ID_RIFF_HEADER : skip_metadata,
+    ID_RIFF_TRAILER : skip_metadata,
+    ID_REPLAY_GAIN : skip_metadata,
+    ID_CUESHEET : skip_metadata,
+    ID_MD5_CHECKSUM : skip_metadata,
+}
+
+
 
 # This monster actually unpacks the WavPack bitstream(s) into the specified
 # buffer as 32-bit integers or floats (depending on orignal data). Lossy
@@ -1479,19 +2877,19 @@ def read_sample_rate(wpc, wpmd) :
 # deep. For maximum efficiency, the conversion is isolated to tight loops
 # that handle an entire buffer. The function returns the total number of
 # samples unpacked, which can be less than the number requested if an error
-# occurs or the end of the block is reached.
+# occurs or the end of the block is reached. If a NumPy array "out" is
+# given, "mybuffer" is only used to decode in and the finished samples go
+# to "out" at "out_idx" instead.
 
-def unpack_samples(wpc, mybuffer, sample_count) :
+def unpack_samples(wpc, mybuffer, sample_count, buf_idx, out = None, out_idx = 0) :
     wps = wpc.stream;
     flags = wps.wphdr.flags;
     i = 0
-    crc = wps.crc
 
-
-    mute_limit = ((1L << ((flags & MAG_MASK) >> MAG_LSB)) + 2)
+    mute_limit = ((1 << ((flags & MAG_MASK) >> MAG_LSB)) + 2)
     dpp = decorr_pass()
     tcount = 0
-    buffer_counter = 0
+    buffer_counter = buf_idx
 
     samples_processed = 0;
 
@@ -1506,6 +2904,10 @@ def unpack_samples(wpc, mybuffer, sample_count) :
         else :
             tempc = 2 * sample_count
 
+        if (out is not None) :
+            out[out_idx:out_idx + tempc] = 0
+            tempc = 0
+
         while (tempc > 0) :
             mybuffer[buffer_counter] = 0;
             tempc = tempc - 1
@@ -1522,118 +2924,58 @@ def unpack_samples(wpc, mybuffer, sample_count) :
     # ///////////////////// handle version 4 mono data /////////////////////////
 
     if ((flags & (MONO_FLAG | FALSE_STEREO)) > 0) :
-        dpp_index = 0
-
-        i = get_words(sample_count, flags, wps.w, wps.wvbits, mybuffer);
-
-        # System.arraycopy(temp_buffer, 0, mybuffer, 0, sample_count);
-
-        for tcount in range(wps.num_terms - 1,-1,-1) :
-            dpp = wps.decorr_passes[dpp_index];
-            decorr_mono_pass(dpp, mybuffer, sample_count, buffer_counter);
-            dpp_index = dpp_index + 1
-
-        bf_abs = 0
-
-        for q in range(0, sample_count) :
-            if mybuffer[q] < 0 :
-                bf_abs = -mybuffer[q]
-            else :
-                bf_abs = mybuffer[q]
+        i = get_words(sample_count, flags, wps.w, wps.wvbits, mybuffer, buf_idx);
 
-            if (bf_abs > mute_limit) :
-                i = q
-                break
-            
-            crcstep1 = (crc * 3) & 0xffffffff
-            crc = (crcstep1 + mybuffer[q]) & 0xffffffff
- 
-            # crc = crc * 3 + mybuffer[q];
+        if (wps.fused_decorr != None) :
+            wps.fused_decorr(wps.decorr_passes, mybuffer, buf_idx, buf_idx + sample_count)
+        else :
+            for dpp, decorr_kernel in zip(wps.decorr_passes, wps.decorr_kernels) :
+                decorr_kernel(dpp, mybuffer, buf_idx, buf_idx + sample_count)
 
 
     # //////////////////// handle version 4 stereo data ////////////////////////
 
     else :
         
-        samples_processed = get_words(sample_count, flags, wps.w, wps.wvbits, mybuffer);
+        samples_processed = get_words(sample_count, flags, wps.w, wps.wvbits, mybuffer, buf_idx);
 
         i = samples_processed;
 
-        if (sample_count < 16) :
-            dpp_index = 0
-
-            for tcount in range(wps.num_terms - 1, -1, -1) :
-                dpp = wps.decorr_passes[dpp_index];
-                decorr_stereo_pass(dpp, mybuffer, sample_count, buffer_counter);
-                wps.decorr_passes[dpp_index] = dpp;
-                dpp_index = dpp_index + 1
+        if (wps.fused_decorr != None) :
+            wps.fused_decorr(wps.decorr_passes, mybuffer, buf_idx, buf_idx + sample_count * 2)
         else :
-            dpp_index = 0;
-
-            for tcount in range(wps.num_terms - 1, -1, -1) :
-
-                dpp = wps.decorr_passes[dpp_index]
+            for dpp, decorr_kernel in zip(wps.decorr_passes, wps.decorr_kernels) :
+                decorr_kernel(dpp, mybuffer, buf_idx, buf_idx + sample_count * 2)
 
-                decorr_stereo_pass(dpp, mybuffer, 8, buffer_counter)
+    # with NumPy the rest is done on the whole buffer at once, unless there's
+    # nothing to do but check the samples (and they aren't going to an array
+    # anyway) or the values are too large
 
-                decorr_stereo_pass_cont(dpp, mybuffer, sample_count - 8, buffer_counter + 16)
-                wps.decorr_passes[dpp_index] = dpp
+    if (numpy is not None and ((flags & NUMPY_FINISH_FLAGS) != 0 or out is not None)) :
+        samples_finished = finish_samples_numpy(wpc, mybuffer, sample_count, buf_idx, i, mute_limit,
+            out, out_idx)
 
-                dpp_index = dpp_index + 1
+        if (samples_finished >= 0) :
+            wps.sample_index += samples_finished
 
-        if ((flags & JOINT_STEREO) > 0) :
-            bf_abs = 0
-            bf1_abs = 0
-
-            for buffer_counter in range(0,sample_count * 2,2) :
-
-                mybuffer[buffer_counter + 1] = mybuffer[buffer_counter + 1] - (mybuffer[buffer_counter] >> 1)
-                mybuffer[buffer_counter] = mybuffer[buffer_counter] + mybuffer[buffer_counter + 1]
-
-                if mybuffer[buffer_counter] < 0 :
-                    bf_abs = -mybuffer[buffer_counter]
-                else :
-                    bf_abs = mybuffer[buffer_counter]
-                
-                if mybuffer[buffer_counter + 1] < 0 :
-                    bf1_abs = -mybuffer[buffer_counter + 1]
-                else :
-                    bf1_abs = mybuffer[buffer_counter + 1]
-
-                if (bf_abs > mute_limit or bf1_abs > mute_limit) :
-                    i = buffer_counter / 2
-                    break
-
-                crcstep1 = (crc * 3) & 0xffffffff
-                crcstep2 = (crcstep1 + mybuffer[buffer_counter]) & 0xffffffff
-                crcstep3 = (crcstep2 * 3) & 0xffffffff
-
-                crc = (crcstep3 + mybuffer[buffer_counter + 1] ) & 0xffffffff
+            return samples_finished
 
-        else :
-            bf_abs = 0
-            bf1_abs = 0
+    if ((flags & (MONO_FLAG | FALSE_STEREO)) > 0) :
+        samples_checked = check_samples(wpc, mybuffer, buf_idx, sample_count, 1, mute_limit)
 
-            for buffer_counter in range(0,sample_count * 2,2) :
-                if mybuffer[buffer_counter] < 0 :
-                    bf_abs = -mybuffer[buffer_counter]
-                else :
-                    bf_abs = mybuffer[buffer_counter]
-                    
-                if mybuffer[buffer_counter + 1] < 0 :
-                    bf1_abs = -mybuffer[buffer_counter + 1]
-                else :
-                    bf1_abs = mybuffer[buffer_counter + 1]
+        if (samples_checked != sample_count) :
+            i = samples_checked
 
-                if (bf_abs > mute_limit or bf1_abs > mute_limit) :
-                    i = buffer_counter / 2;
-                    break
+    else :
+        if ((flags & JOINT_STEREO) > 0) :
+            for buffer_counter in range(buf_idx, buf_idx + sample_count * 2, 2) :
+                mybuffer[buffer_counter + 1] = mybuffer[buffer_counter + 1] - (mybuffer[buffer_counter] >> 1)
+                mybuffer[buffer_counter] = mybuffer[buffer_counter] + mybuffer[buffer_counter + 1]
 
-                crcstep1 = (crc * 3) & 0xffffffff
-                crcstep2 = (crcstep1 + mybuffer[buffer_counter]) & 0xffffffff
-                crcstep3 = (crcstep2 * 3) & 0xffffffff
+        samples_checked = check_samples(wpc, mybuffer, buf_idx, sample_count * 2, 2, mute_limit)
 
-                crc = (crcstep3 + mybuffer[buffer_counter + 1] ) & 0xffffffff
+        if (samples_checked != sample_count) :
+            i = samples_checked
 
     if (i != sample_count) :
         sc = 0
@@ -1643,7 +2985,7 @@ def unpack_samples(wpc, mybuffer, sample_count) :
         else :
             sc = 2 * sample_count
             
-        buffer_counter = 0
+        buffer_counter = buf_idx
 
         while (sc > 0) :
             mybuffer[buffer_counter] = 0
@@ -1653,11 +2995,11 @@ def unpack_samples(wpc, mybuffer, sample_count) :
         wps.mute_error = 1
         i = sample_count
 
-    mybuffer = fixup_samples(wps, mybuffer, i);
+    mybuffer = fixup_samples(wps, mybuffer, i, buf_idx, wpc.float_bits);
 
     if ((flags & FALSE_STEREO) > 0) :
-        dest_idx = i * 2;
-        src_idx = i;
+        dest_idx = buf_idx + i * 2;
+        src_idx = buf_idx + i;
         c = i;
 
         dest_idx = dest_idx - 1
@@ -1671,533 +3013,428 @@ def unpack_samples(wpc, mybuffer, sample_count) :
             src_idx = src_idx - 1
             c = c -1
 
+    if (out is not None) :
+        count = i * stream_channels(wps)
+        out[out_idx:out_idx + count] = mybuffer[buf_idx:buf_idx + count]
+
     wps.sample_index += i
-    wps.crc = crc
 
     return i;
 
 
-def decorr_stereo_pass(dpp, mybuffer, sample_count, buf_idx) :
-    delta = dpp.delta;
-    weight_A = dpp.weight_A;
-    weight_B = dpp.weight_B;
-    sam_A = 0
-    sam_B = 0
-    m = 0
-    k = 0
-    bptr_counter = 0
-
-    try :
-        switch (dpp.term)
-    except case(17) :
-        for bptr_counter in range(buf_idx, buf_idx + sample_count * 2, 2) :
-            sam_A = 2 * dpp.samples_A[0] - dpp.samples_A[1];
-            dpp.samples_A[1] = dpp.samples_A[0];
-            dpp.samples_A[0] = ((weight_A * sam_A + 512) >> 10) + mybuffer[bptr_counter];
-
-            if (sam_A != 0 and mybuffer[bptr_counter] != 0) :
-                if ((sam_A ^ mybuffer[bptr_counter]) < 0) :
-                    weight_A = weight_A - delta;
-                else :
-                    weight_A = weight_A + delta;
-
-            mybuffer[bptr_counter] = dpp.samples_A[0];
-
-            sam_A = 2 * dpp.samples_B[0] - dpp.samples_B[1];
-            dpp.samples_B[1] = dpp.samples_B[0];
-            dpp.samples_B[0] =  ((weight_B *sam_A + 512) >> 10) + mybuffer[bptr_counter + 1];
-
-            if (sam_A != 0 and mybuffer[bptr_counter + 1] != 0) :
-                if ((sam_A ^ mybuffer[bptr_counter + 1]) < 0) :
-                    weight_B = weight_B - delta;
-                else :
-                    weight_B = weight_B + delta;
-
-            mybuffer[bptr_counter + 1] = dpp.samples_B[0]
-
-    except case(18):
-        
-        for bptr_counter in range(buf_idx, buf_idx + sample_count * 2, 2) :
-            sam_A = (3 * dpp.samples_A[0] - dpp.samples_A[1]) >> 1;
-            dpp.samples_A[1] = dpp.samples_A[0];
-            dpp.samples_A[0] =  ((weight_A * sam_A + 512) >> 10) + mybuffer[bptr_counter];
-
-            if (sam_A != 0 and mybuffer[bptr_counter] != 0) :
-                if ((sam_A ^ mybuffer[bptr_counter]) < 0) :
-                    weight_A = weight_A - delta;
-                else :
-                    weight_A = weight_A + delta;
-
-            mybuffer[bptr_counter] = dpp.samples_A[0];
-
-            sam_A = (3 * dpp.samples_B[0] - dpp.samples_B[1]) >> 1;
-            dpp.samples_B[1] = dpp.samples_B[0];
-            dpp.samples_B[0] = ((weight_B * sam_A + 512) >> 10) + mybuffer[bptr_counter + 1];
-
-            if (sam_A != 0 and mybuffer[bptr_counter + 1] != 0) :
-                if ((sam_A ^ mybuffer[bptr_counter + 1]) < 0) :
-                    weight_B = weight_B - delta;
-                else :
-                    weight_B = weight_B + delta;
-
-            mybuffer[bptr_counter + 1] = dpp.samples_B[0]
-
-    except case(-1) :
-        for bptr_counter in range(buf_idx, buf_idx + sample_count * 2, 2) :
-            sam_A = mybuffer[bptr_counter] + ((weight_A * dpp.samples_A[0] + 512) >> 10);
-
-            if ((dpp.samples_A[0] ^ mybuffer[bptr_counter]) < 0) :
-                if (dpp.samples_A[0] != 0 and mybuffer[bptr_counter] != 0 ) :
-                    weight_A = weight_A - delta
-                    if weight_A < -1024:
-                        weight_A = -1024
-            else :
-                if (dpp.samples_A[0] != 0 and mybuffer[bptr_counter] != 0 ) :
-                    weight_A = weight_A + delta
-                    if weight_A > 1024 :
-                        weight_A = 1024
-
-            mybuffer[bptr_counter] = sam_A;
-            dpp.samples_A[0] = mybuffer[bptr_counter + 1] +  ((weight_B * sam_A + 512) >> 10);
-
-            if ((sam_A ^ mybuffer[bptr_counter + 1]) < 0) :
-                if (sam_A != 0 and mybuffer[bptr_counter + 1] != 0 ) :
-                    weight_B = weight_B - delta
-                    if weight_B < -1024 :
-                        weight_B = -1024
-            else :
-                if (sam_A != 0 and mybuffer[bptr_counter + 1] != 0 ) :
-                    weight_B = weight_B + delta
-                    if weight_B > 1024 :
-                        weight_B = 1024
-
-            mybuffer[bptr_counter + 1] = dpp.samples_A[0]
-
-    except case(-2) :
-        sam_B = 0;
-        sam_A = 0;
-
-        for bptr_counter in range(buf_idx, buf_idx + sample_count * 2, 2) :
-            sam_B = mybuffer[bptr_counter + 1] +((weight_B * dpp.samples_B[0] + 512) >> 10)
-
-            if ((dpp.samples_B[0] ^ mybuffer[bptr_counter + 1]) < 0) :
-                if (dpp.samples_B[0] != 0 and mybuffer[bptr_counter + 1] != 0 ) :
-                    weight_B = weight_B - delta
-                    if weight_B < -1024 :
-                        weight_B = -1024
-            else :
-                if (dpp.samples_B[0] != 0 and mybuffer[bptr_counter + 1] != 0 ) :
-                    weight_B = weight_B + delta
-                    if weight_B > 1024 :
-                        weight_B = 1024
-
-            mybuffer[bptr_counter + 1] = sam_B
-
-            dpp.samples_B[0] = mybuffer[bptr_counter] + ((weight_A * sam_B + 512) >> 10)
-
-            if ((sam_B ^ mybuffer[bptr_counter]) < 0) :
-                if (sam_B != 0 and mybuffer[bptr_counter] != 0 ) :
-                    weight_A = weight_A - delta
-                    if weight_A < -1024 :
-                        weight_A = -1024
-            else :
-                if (sam_B != 0 and mybuffer[bptr_counter] != 0 ) :
-                    weight_A = weight_A + delta
-                    if weight_A > 1024 :
-                        weight_A = 1024
-
-            mybuffer[bptr_counter] = dpp.samples_B[0];
-
-
-    except case(-3) :
-        sam_A = 0;
-
-        for bptr_counter in range(buf_idx, buf_idx + sample_count * 2, 2) :
-            sam_A = mybuffer[bptr_counter] + ((weight_A * dpp.samples_A[0] + 512) >> 10)
-
-            if ((dpp.samples_A[0] ^ mybuffer[bptr_counter]) < 0) :
-                if (dpp.samples_A[0] != 0 and mybuffer[bptr_counter] != 0 ) :
-                    weight_A = weight_A - delta
-                    if weight_A < -1024 :
-                        weight_A = -1024
-            else :
-                if (dpp.samples_A[0] != 0 and mybuffer[bptr_counter] != 0 ) :
-                    weight_A = weight_A + delta
-                    if weight_A > 1024 :
-                        weight_A = 1024
-
-            sam_B = mybuffer[bptr_counter + 1] + ((weight_B * dpp.samples_B[0] + 512) >> 10)
-
-            if ((dpp.samples_B[0] ^ mybuffer[bptr_counter + 1]) < 0) :
-                if (dpp.samples_B[0] != 0 and mybuffer[bptr_counter + 1] != 0 ) :
-                    weight_B = weight_B - delta
-                    if weight_B < -1024 :
-                        weight_B = -1024
-            else :
-                if (dpp.samples_B[0] != 0 and mybuffer[bptr_counter + 1] != 0 ) :
-                    weight_B = weight_B + delta
-                    if weight_B > 1024 :
-                        weight_B = 1024
-
-            mybuffer[bptr_counter] = dpp.samples_B[0] = sam_A
-            mybuffer[bptr_counter + 1] = dpp.samples_A[0] = sam_B
-
-    except :
-
-        sam_A = 0
-        m = 0
-        k = dpp.term & (MAX_TERM - 1)
-
-        for bptr_counter in range(buf_idx, buf_idx + sample_count * 2, 2) :
-            sam_A = dpp.samples_A[m];
-            dpp.samples_A[k] = ((weight_A * sam_A + 512) >> 10) + mybuffer[bptr_counter];
-
-            if (sam_A != 0 and mybuffer[bptr_counter] != 0) :
-                if ((sam_A ^ mybuffer[bptr_counter]) < 0) :
-                    weight_A = weight_A - delta
-                else :
-                    weight_A = weight_A + delta
-
-            mybuffer[bptr_counter] = dpp.samples_A[k];
-
-            sam_A = dpp.samples_B[m];
-            dpp.samples_B[k] = ((weight_B * sam_A + 512) >> 10) + mybuffer[bptr_counter + 1];
-   
-            if (sam_A != 0 and mybuffer[bptr_counter + 1] != 0) :
-                if ((sam_A ^ mybuffer[bptr_counter + 1]) < 0) :
-                    weight_B = weight_B - delta
-                else :
-                    weight_B = weight_B + delta
-
-            mybuffer[bptr_counter + 1] = dpp.samples_B[k];
+# Return the function that applies one decorrelation pass with "term" to
+# the samples in a buffer, as
+#
+#     decorr_kernel(dpp, buffer, start_index, end_index)
+#
+# Each kernel is generated for its term, mono or stereo, with the weights
+# and history of the pass in local variables for the length of the call.
+# Terms 1 to 8 (and 17 and 18, which use the last 2 samples) unroll the loop
+# over the samples by the length of their history, so that each unrolled
+# sample reads and replaces a different one of the history variables and
+# nothing has to be shifted or indexed. The history is left in the pass in
+# the same form as read_decorr_samples() gives it, so a block can be
+# unpacked in any number of calls. A kernel is only built the first time a
+# block using its term is unpacked one pass at a time (when DECORR_FUSED is
+# FALSE), and is then kept here.
+
+decorr_kernels = {}
+
+def get_decorr_kernel(term, stereo) :
+    key = (term, stereo)
+    decorr_kernel = decorr_kernels.get(key)
+
+    if (decorr_kernel == None) :
+        namespace = {}
+        exec(decorr_kernel_source(term, stereo), namespace)
+        decorr_kernel = namespace['decorr_kernel']
+        decorr_kernels[key] = decorr_kernel
+
+    return decorr_kernel
+
+
+# Return the source of the kernel for "term". The names are those of pass 0
+# in fused_decorr_source(), so the same pieces of source are used, except
+# that the history of terms 1 to 8, 17 and 18 is kept in a0_<i> and b0_<i>
+# for the unrolled sample i that reads (and replaces) it. In mono blocks a
+# negative term works like the positive term it wraps to.
+
+def decorr_kernel_source(term, stereo) :
+    if (not stereo and term < 17) :
+        term = ((term & (MAX_TERM - 1)) - 1) % MAX_TERM + 1
+
+    load = ['d0 = dpp.delta', 'wA0 = dpp.weight_A']
+    store = ['dpp.weight_A = wA0']
+    channels = [('A', 'l', 'a')]
+    step = 1
+
+    if (stereo) :
+        load.append('wB0 = dpp.weight_B')
+        store.append('dpp.weight_B = wB0')
+        channels.append(('B', 'r', 'b'))
+        step = 2
+
+    lines = ['def decorr_kernel(dpp, buffer, start_index, end_index) :']
+
+    if (term < 0) :
+        load += ['a0_0 = dpp.samples_A[0]', 'b0_0 = dpp.samples_B[0]']
+        store += ['dpp.samples_A[0] = a0_0', 'dpp.samples_B[0] = b0_0']
+
+        lines += ['    ' + line for line in load]
+        lines.append('    for index in range(start_index, end_index, 2) :')
+        lines.append('        l = buffer[index]')
+        lines.append('        r = buffer[index + 1]')
+        lines += ['        ' + line for line in fused_cross_pass_source(0, term)]
+        lines.append('        buffer[index] = l')
+        lines.append('        buffer[index + 1] = r')
+        lines += ['    ' + line for line in store]
+
+        return '\n'.join(lines) + '\n'
+
+    # unrolled sample i of terms 1 to 8 reads the output "term" samples back
+    # from samples_X[i], and for 17 and 18 the older of the last 2 samples
+    # is read from samples_X[1] first
+
+    if (term > MAX_TERM) :
+        period = 2
+        slots = [1, 0]
+    else :
+        period = term
+        slots = list(range(0, term))
 
-            m = (m + 1) & (MAX_TERM - 1)
-            k = (k + 1) & (MAX_TERM - 1)
+    for channel, v, h in channels :
+        for i in range(0, period) :
+            load.append('%s0_%d = dpp.samples_%s[%d]' % (h, i, channel, slots[i]))
 
-        if (m != 0) :
-            temp_samples = [0] * MAX_TERM
+    samples = []
 
-            for t in range(0, len(dpp.samples_A)) :
-                temp_samples[t] = dpp.samples_A[t]
+    for i in range(0, period) :
+        sample = []
 
-            for k in range(0,MAX_TERM) :
-                dpp.samples_A[k] = temp_samples[m & (MAX_TERM - 1)]
-                m = m + 1
+        for c in range(0, len(channels)) :
+            channel, v, h = channels[c]
+            sample.append('%s = buffer[index + %d]' % (v, i * step + c))
+            sample += kernel_term_source(term, i, period, channel, v, h)
+            sample.append('buffer[index + %d] = %s' % (i * step + c, v))
 
-            for tmpiter in range(0,MAX_TERM) :
-                temp_samples[tmpiter] = dpp.samples_B[tmpiter]
+        samples.append(sample)
 
-            for k in range(0,MAX_TERM) :
-                dpp.samples_B[k] = temp_samples[m & (MAX_TERM - 1)]
-                m = m + 1
+    lines += ['    ' + line for line in load]
+    lines.append('    full_end = end_index - (end_index - start_index) %% %d' % (period * step))
+    lines.append('    for index in range(start_index, full_end, %d) :' % (period * step))
 
-    dpp.weight_A =  weight_A;
-    dpp.weight_B =  weight_B;
+    for sample in samples :
+        lines += ['        ' + line for line in sample]
 
+    # the samples left over after the last full round
 
+    if (period > 1) :
+        lines.append('    index = full_end')
 
-def decorr_stereo_pass_cont(dpp, mybuffer, sample_count, buf_idx) :
-    delta = dpp.delta
-    weight_A = dpp.weight_A
-    weight_B = dpp.weight_B
-    tptr = 0
-    sam_A = 0
-    sam_B = 0
-    k = 0
-    i = 0
-    buffer_index = buf_idx
-    end_index = buf_idx + sample_count * 2
+        for i in range(0, period - 1) :
+            lines.append('    if (index + %d < end_index) :' % (i * step))
+            lines += ['        ' + line for line in samples[i]]
 
-    
-    try :
-        switch (dpp.term)
-    except case(17) :
-        for buffer_index in range(buf_idx, end_index, 2) :
-            sam_A = 2 * mybuffer[buffer_index - 2] - mybuffer[buffer_index - 4]
+    # after unpacking a number of samples that isn't a multiple of the
+    # period, the oldest history is in the variable at that remainder
 
-            sam_B = mybuffer[buffer_index]
-            mybuffer[buffer_index] = ((weight_A *  sam_A + 512) >> 10) + sam_B
+    lines += ['    ' + line for line in store]
+    lines.append('    p = ((end_index - start_index) // %d) %% %d' % (step, period))
 
-            if (sam_A != 0 and sam_B != 0) : 
-                if (sam_A ^ sam_B) < 0 :
-                    weight_A -= delta; 
-                else :
-                    weight_A += delta;
+    for channel, v, h in channels :
+        lines.append('    h = [%s]' % ', '.join(['%s0_%d' % (h, i) for i in range(0, period)]))
+        lines.append('    h = h[p:] + h[0:p]')
 
-            sam_A = 2 * mybuffer[buffer_index - 1] - mybuffer[buffer_index - 3]
-            sam_B = mybuffer[buffer_index + 1]
-            mybuffer[buffer_index + 1] = ((weight_B * sam_A + 512) >> 10) + sam_B
+        for i in range(0, period) :
+            lines.append('    dpp.samples_%s[%d] = h[%d]' % (channel, slots[i], i))
 
-            if (sam_A != 0 and sam_B != 0) : 
-                if (sam_A ^ sam_B) < 0 :
-                    weight_B -= delta; 
-                else :
-                    weight_B += delta;            
-            
+    return '\n'.join(lines) + '\n'
 
-        buffer_index = end_index
-        
-        dpp.samples_B[0] = mybuffer[buffer_index - 1]
-        dpp.samples_A[0] = mybuffer[buffer_index - 2]
-        dpp.samples_B[1] = mybuffer[buffer_index - 3]
-        dpp.samples_A[1] = mybuffer[buffer_index - 4]
-
-    except case(18) :
-        for buffer_index in range(buf_idx, end_index, 2) :
-            sam_A = (3 * mybuffer[buffer_index - 2] - mybuffer[buffer_index - 4]) >> 1;
-            sam_B = mybuffer[buffer_index]
-            mybuffer[buffer_index] = ((weight_A * sam_A + 512) >> 10) + sam_B
-
-            if (sam_A != 0 and sam_B != 0) : 
-                if (sam_A ^ sam_B) < 0 :
-                    weight_A -= delta; 
-                else :
-                    weight_A += delta;
 
+# Source for one channel of unrolled sample "i" of a kernel: the prediction
+# from the history "h" of the channel, the output replacing the value "v"
+# and the history variable read, and the weight update
 
-            sam_A = (3 * mybuffer[buffer_index - 1] - mybuffer[buffer_index - 3]) >> 1
-            sam_B = mybuffer[buffer_index + 1]
-            mybuffer[buffer_index + 1] = ((weight_B * sam_A + 512) >> 10) + sam_B
+def kernel_term_source(term, i, period, channel, v, h) :
+    older = '%s0_%d' % (h, i)
+    newer = '%s0_%d' % (h, (i - 1) % period)
 
-            if (sam_A != 0 and sam_B != 0) : 
-                if (sam_A ^ sam_B) < 0 :
-                    weight_B -= delta; 
-                else :
-                    weight_B += delta;
+    if (term == 17) :
+        prediction = 's = 2 * %s - %s' % (newer, older)
+    elif (term == 18) :
+        prediction = 's = (3 * %s - %s) >> 1' % (newer, older)
+    else :
+        prediction = 's = %s' % older
+
+    return [prediction,
+        'o = ((w%s0 * s + 512) >> 10) + %s' % (channel, v),
+        'if (s != 0 and %s != 0) :' % v,
+        '    if ((s ^ %s) < 0) :' % v,
+        '        w%s0 -= d0' % channel,
+        '    else :',
+        '        w%s0 += d0' % channel,
+        '%s = o' % older,
+        '%s = o' % v]
+
+
+# Return a function that applies all the decorrelation passes in "dpps" (in
+# order) to the samples in a buffer, as
+#
+#     fused_decorr(dpps, buffer, start_index, end_index)
+#
+# taking each sample through the whole cascade before going on to the next.
+# The function is generated for the list of terms (and mono or stereo), with
+# the weights and history of every pass in local variables for the length of
+# the call, so the buffer is read and written once per sample instead of
+# once per pass. It is bit-exact with the kernels above, and keeps the
+# pass history in the same form. Functions are cached by their terms, as
+# only a few sets of terms are used by the encoder's modes (the cache is
+# emptied if a damaged file fills it with others).
+
+FUSED_DECORR_CACHE_SIZE = 256
+
+fused_decorr_cache = {}
+
+def get_fused_decorr(dpps, stereo) :
+    key = (tuple([dpp.term for dpp in dpps]), stereo)
+    fused_decorr = fused_decorr_cache.get(key)
+
+    if (fused_decorr == None) :
+        if (len(fused_decorr_cache) >= FUSED_DECORR_CACHE_SIZE) :
+            fused_decorr_cache.clear()
+
+        namespace = {}
+        exec(fused_decorr_source(key[0], stereo), namespace)
+        fused_decorr = namespace['fused_decorr']
+        fused_decorr_cache[key] = fused_decorr
+
+    return fused_decorr
+
+
+# Pick the decorrelation functions for the block just read into "wps", once
+# for the whole block: the fused function for its terms, or with
+# DECORR_FUSED set to FALSE (which takes effect from the next block) the
+# kernel for each pass. unpack_samples() then just calls them.
+
+def select_decorr(wps) :
+    dpps = wps.decorr_passes[0:wps.num_terms]
+    stereo = (wps.wphdr.flags & (MONO_FLAG | FALSE_STEREO)) == 0
+
+    if (DECORR_FUSED and wps.num_terms > 0) :
+        wps.fused_decorr = get_fused_decorr(dpps, stereo)
+        wps.decorr_kernels = []
+    else :
+        wps.fused_decorr = None
+        wps.decorr_kernels = [get_decorr_kernel(dpp.term, stereo) for dpp in dpps]
 
-        buffer_index = end_index
 
-        dpp.samples_B[0] = mybuffer[buffer_index - 1]
-        dpp.samples_A[0] = mybuffer[buffer_index - 2]
-        dpp.samples_B[1] = mybuffer[buffer_index - 3]
-        dpp.samples_A[1] = mybuffer[buffer_index - 4]
+# Return the source of the fused decorrelation function for "terms". Each
+# pass keeps its weights in wA<n> and wB<n>. Terms 1 and 2, 17 and 18 keep
+# their history in a<n>_<j> and b<n>_<j>, the output of channel A or B j + 1
+# samples back (for negative terms a<n>_0 is the previous output of B and
+# b<n>_0 that of A, as in samples_A[0] and samples_B[0]). Terms 3 to 8,
+# which would have to shift too many of those along every sample, keep a
+# copy of samples_A and samples_B in a<n> and b<n> that is used as a ring
+# buffer of 8 samples, read at "m" (shared by all passes) and written at
+# k<term>, "term" samples ahead. In mono blocks a negative term works like
+# the positive term it wraps to in the history of 8 samples.
 
+def fused_decorr_source(terms, stereo) :
+    load = []
+    body = []
+    step = []
+    store = []
+    ring_terms = []
 
-    except case(-1) :
-        for buffer_index in range(buf_idx, end_index, 2) :
-            sam_A = mybuffer[buffer_index]
+    for n in range(0, len(terms)) :
+        term = terms[n]
 
-            mybuffer[buffer_index] = ((weight_A * mybuffer[buffer_index - 1] + 512) >> 10) + sam_A
+        if (not stereo and term < 17) :
+            term = ((term & (MAX_TERM - 1)) - 1) % MAX_TERM + 1
 
-            if ((mybuffer[buffer_index - 1] ^ sam_A) < 0) :
-                if (mybuffer[buffer_index - 1] != 0 and sam_A != 0 ) :
-                    weight_A = weight_A - delta
-                    if weight_A < -1024 :
-                        weight_A = -1024
-            else :
-                if (mybuffer[buffer_index - 1] != 0 and sam_A != 0 ) :
-                    weight_A = weight_A + delta
-                    if (weight_A > 1024) :
-                        weight_A = 1024
-
-            sam_A = mybuffer[buffer_index + 1]
-            mybuffer[buffer_index + 1] = ((weight_B *  mybuffer[buffer_index] + 512) >> 10) + sam_A
-
-            if ((mybuffer[buffer_index] ^ sam_A) < 0) :
-                if (mybuffer[buffer_index] != 0 and sam_A != 0 ) :
-                    weight_B = weight_B - delta
-                    if weight_B < -1024 :
-                        weight_B = -1024
-            else :
-                if (mybuffer[buffer_index] != 0 and sam_A != 0 ) :
-                    weight_B = weight_B + delta
-                    if weight_B > 1024 :
-                        weight_B = 1024
+        load.append('dpp = dpps[%d]' % n)
+        load.append('d%d = dpp.delta' % n)
+        load.append('wA%d = dpp.weight_A' % n)
+        store.append('dpp = dpps[%d]' % n)
+        store.append('dpp.weight_A = wA%d' % n)
 
-        buffer_index = end_index
-        
-        dpp.samples_A[0] = mybuffer[buffer_index - 1]
+        if (stereo) :
+            load.append('wB%d = dpp.weight_B' % n)
+            store.append('dpp.weight_B = wB%d' % n)
 
-    except case(-2):
-        sam_A = 0;
-        sam_B = 0;
+        if (term > 2 and term <= MAX_TERM) :
+            if (len(step) == 0) :
+                load.insert(0, 'm = 0')
+                step.append('m = (m + 1) & %d' % (MAX_TERM - 1))
 
-        for buffer_index in range(buf_idx, end_index, 2) :
-            sam_A = mybuffer[buffer_index + 1]
-            mybuffer[buffer_index + 1] =((weight_B * mybuffer[buffer_index - 2] + 512) >> 10) + sam_A
+            load.append('a%d = dpp.samples_A[0:%d]' % (n, MAX_TERM))
+            store.append('dpp.samples_A[0:%d] = a%d[m:] + a%d[0:m]' % (MAX_TERM, n, n))
 
-            if ((mybuffer[buffer_index - 2] ^ sam_A) < 0) :
-                if (mybuffer[buffer_index - 2] != 0 and sam_A != 0 ) :
-                    weight_B = weight_B - delta
-                    if weight_B < -1024 :
-                        weight_B = -1024
-            else :
-                if (mybuffer[buffer_index - 2] != 0 and sam_A != 0 ) :
-                    weight_B = weight_B + delta
-                    if weight_B > 1024 :
-                        weight_B = 1024
+            if (stereo) :
+                load.append('b%d = dpp.samples_B[0:%d]' % (n, MAX_TERM))
+                store.append('dpp.samples_B[0:%d] = b%d[m:] + b%d[0:m]' % (MAX_TERM, n, n))
 
+            # (m + 8) & 7 is just m, so term 8 needs no index of its own
 
-            sam_A = mybuffer[buffer_index]
-            mybuffer[buffer_index] = ((weight_A * mybuffer[buffer_index + 1] + 512) >> 10) + sam_A
+            if (term < MAX_TERM and not term in ring_terms) :
+                ring_terms.append(term)
+                load.append('k%d = %d' % (term, term))
+                step.append('k%d = (k%d + 1) & %d' % (term, term, MAX_TERM - 1))
 
-            if ((mybuffer[buffer_index + 1] ^ sam_A) < 0) :
-                if (mybuffer[buffer_index + 1] != 0 and sam_A != 0) :
-                    weight_A = weight_A - delta
-                    if weight_A < -1024 :
-                        weight_A = -1024
-            else :
-                if (mybuffer[buffer_index + 1] != 0 and sam_A != 0) :
-                    weight_A = weight_A + delta
-                    if (weight_A > 1024) :
-                        weight_A = 1024
+            body += fused_ring_source(n, term, 'A', 'l', 'a')
 
+            if (stereo) :
+                body += fused_ring_source(n, term, 'B', 'r', 'b')
 
-        buffer_index = end_index
-        
-        dpp.samples_B[0] = mybuffer[buffer_index - 2];
+            continue
 
-    except case(-3) :
-        for buffer_index in range(buf_idx, end_index, 2) :
-            sam_A = mybuffer[buffer_index]
+        if (term > MAX_TERM) :
+            history = 2
+        elif (term < 0) :
+            history = 1
+        else :
+            history = term
 
-            mybuffer[buffer_index] = ((weight_A * mybuffer[buffer_index - 1] + 512) >> 10) + sam_A
+        # history j + 1 samples back is kept in samples_X[term - 1 - j] for
+        # terms 1 and 2, and in samples_X[j] otherwise
 
-            if ((mybuffer[buffer_index - 1] ^ sam_A) < 0) :
-                if (mybuffer[buffer_index - 1] != 0 and sam_A != 0 ) :
-                    weight_A = weight_A - delta
-                    if weight_A < -1024 :
-                        weight_A = -1024
-            else :
-                if (mybuffer[buffer_index - 1] != 0 and sam_A != 0 ) :
-                    weight_A = weight_A + delta
-                    if weight_A > 1024 :
-                        weight_A = 1024
-
-            sam_A = mybuffer[buffer_index + 1]
-            mybuffer[buffer_index + 1] = ((weight_B * mybuffer[buffer_index - 2] + 512) >> 10) + sam_A
-
-            if ((mybuffer[buffer_index - 2] ^ sam_A) < 0) :
-                if (mybuffer[buffer_index - 2] != 0 and sam_A != 0 ) :
-                    weight_B = weight_B - delta
-                    if weight_B < -1024 :
-                        weight_B = -1024
+        for j in range(0, history) :
+            if (term > 0 and term <= MAX_TERM) :
+                slot = term - 1 - j
             else :
-                if (mybuffer[buffer_index - 2] != 0 and sam_A != 0 ) :
-                    weight_B = weight_B + delta
-                    if weight_B > 1024 :
-                        weight_B = 1024
-
-        buffer_index = end_index
-        
-        dpp.samples_A[0] = mybuffer[buffer_index - 1];
-        dpp.samples_B[0] = mybuffer[buffer_index - 2];
-
-    except :
-        tptr = buf_idx - (dpp.term * 2);
-
-        for buffer_index in range(buf_idx, end_index, 2) :
-            sam_A = mybuffer[buffer_index]
-            
-            mybuffer[buffer_index] = ((weight_A * mybuffer[tptr] + 512) >> 10) + sam_A
-
-            if (mybuffer[tptr] != 0 and sam_A != 0) : 
-                if (mybuffer[tptr] ^ sam_A) < 0 :
-                    weight_A -= delta; 
-                else :
-                    weight_A += delta;
-
-
-            sam_A = mybuffer[buffer_index + 1]
-            mybuffer[buffer_index + 1] = ((weight_B * mybuffer[tptr + 1] + 512) >> 10) + sam_A
+                slot = j
 
-            if (mybuffer[tptr + 1] != 0 and sam_A != 0) : 
-                if (mybuffer[tptr + 1] ^ sam_A) < 0 :
-                    weight_B -= delta; 
-                else :
-                    weight_B += delta;
+            load.append('a%d_%d = dpp.samples_A[%d]' % (n, j, slot))
+            store.append('dpp.samples_A[%d] = a%d_%d' % (slot, n, j))
 
+            if (stereo) :
+                load.append('b%d_%d = dpp.samples_B[%d]' % (n, j, slot))
+                store.append('dpp.samples_B[%d] = b%d_%d' % (slot, n, j))
 
-            tptr += 2;
+        if (term < 0) :
+            body += fused_cross_pass_source(n, term)
+        else :
+            body += fused_term_source(n, term, 'A', 'l', 'a')
 
-        buffer_index = end_index - 1
+            if (stereo) :
+                body += fused_term_source(n, term, 'B', 'r', 'b')
 
-        k = dpp.term - 1
-        i = 8
-        while i > 0 :
-            i = i - 1
-            dpp.samples_B[k & (MAX_TERM - 1)] = mybuffer[buffer_index]
-            buffer_index = buffer_index - 1
-            dpp.samples_A[k & (MAX_TERM - 1)] = mybuffer[buffer_index]
-            buffer_index = buffer_index - 1
-            k = k - 1
+    lines = ['def fused_decorr(dpps, buffer, start_index, end_index) :']
+    lines += ['    ' + line for line in load]
 
-    dpp.weight_A =  weight_A;
-    dpp.weight_B =  weight_B;
+    if (stereo) :
+        lines.append('    for index in range(start_index, end_index, 2) :')
+        lines.append('        l = buffer[index]')
+        lines.append('        r = buffer[index + 1]')
+        lines += ['        ' + line for line in body]
+        lines.append('        buffer[index] = l')
+        lines.append('        buffer[index + 1] = r')
+    else :
+        lines.append('    for index in range(start_index, end_index) :')
+        lines.append('        l = buffer[index]')
+        lines += ['        ' + line for line in body]
+        lines.append('        buffer[index] = l')
 
+    lines += ['        ' + line for line in step]
+    lines += ['    ' + line for line in store]
 
+    return '\n'.join(lines) + '\n'
 
-def decorr_mono_pass(dpp, mybuffer, sample_count,  buf_idx) :
-    delta = dpp.delta
-    weight_A = dpp.weight_A
-    sam_A = 0
-    m = 0
-    k = 0
-    bptr_counter = 0
-    end_index = buf_idx + sample_count
 
-    try :
-        switch (dpp.term)
-    except case(17) :
+# Source for one channel of a pass with term 1, 2, 17 or 18: the prediction
+# "s" from the history "h" of the channel, the output replacing the value
+# "v" and the weight update. The history is shifted along by one sample.
 
-        for bptr_counter in range(buf_idx, end_index, 1) :
-            sam_A = 2 * dpp.samples_A[0] - dpp.samples_A[1]
-            dpp.samples_A[1] = dpp.samples_A[0]
-            dpp.samples_A[0] =  ((weight_A *sam_A + 512) >> 10) + mybuffer[bptr_counter]
+def fused_term_source(n, term, channel, v, h) :
+    w = 'w%s%d' % (channel, n)
 
-            if (sam_A != 0 and mybuffer[bptr_counter] != 0) :
-                if ((sam_A ^ mybuffer[bptr_counter]) < 0) :
-                    weight_A = weight_A - delta;
-                else :
-                    weight_A = weight_A + delta
-                    
-            mybuffer[bptr_counter] = dpp.samples_A[0];
+    if (term == 17) :
+        prediction = 's = 2 * %s%d_0 - %s%d_1' % (h, n, h, n)
+    elif (term == 18) :
+        prediction = 's = (3 * %s%d_0 - %s%d_1) >> 1' % (h, n, h, n)
+    else :
+        prediction = 's = %s%d_%d' % (h, n, term - 1)
 
+    if (term > MAX_TERM) :
+        history = 2
+    else :
+        history = term
 
-    except case (18) :
-        for bptr_counter in range(buf_idx, end_index, 1) :
-            sam_A = (3 * dpp.samples_A[0] - dpp.samples_A[1]) >> 1
-            dpp.samples_A[1] = dpp.samples_A[0]
-            dpp.samples_A[0] = ((weight_A * sam_A + 512) >> 10) + mybuffer[bptr_counter]
+    shift = ['%s%d_%d' % (h, n, j) for j in range(0, history)]
 
-            if (sam_A != 0 and mybuffer[bptr_counter] != 0) :
-                if ((sam_A ^ mybuffer[bptr_counter]) < 0) :
-                    weight_A = weight_A - delta
-                else :
-                    weight_A = weight_A + delta
+    return [prediction,
+        'o = ((%s * s + 512) >> 10) + %s' % (w, v),
+        'if (s != 0 and %s != 0) :' % v,
+        '    if ((s ^ %s) < 0) :' % v,
+        '        %s -= d%d' % (w, n),
+        '    else :',
+        '        %s += d%d' % (w, n),
+        '%s = %s' % (', '.join(shift), ', '.join(['o'] + shift[0:history - 1])),
+        '%s = o' % v]
 
-            mybuffer[bptr_counter] = dpp.samples_A[0];
 
-    except :
-        m = 0
-        k = dpp.term & (MAX_TERM - 1)
-        
+# Source for one channel of a pass with a term from 3 to 8, where the
+# prediction is read from the ring buffer "h" at m and the output written
+# "term" samples ahead of it.
 
-        for bptr_counter in range(buf_idx, end_index, 1) :
-            sam_A = dpp.samples_A[m]
-            dpp.samples_A[k] = ((weight_A * sam_A + 512) >> 10) + mybuffer[bptr_counter]
+def fused_ring_source(n, term, channel, v, h) :
+    w = 'w%s%d' % (channel, n)
 
-            if (sam_A != 0 and mybuffer[bptr_counter] != 0) :
-                if ((sam_A ^ mybuffer[bptr_counter]) < 0) :
-                    weight_A = weight_A - delta
-                else :
-                    weight_A = weight_A + delta
+    if (term == MAX_TERM) :
+        k = 'm'
+    else :
+        k = 'k%d' % term
+
+    return ['s = %s%d[m]' % (h, n),
+        'o = ((%s * s + 512) >> 10) + %s' % (w, v),
+        'if (s != 0 and %s != 0) :' % v,
+        '    if ((s ^ %s) < 0) :' % v,
+        '        %s -= d%d' % (w, n),
+        '    else :',
+        '        %s += d%d' % (w, n),
+        '%s%d[%s] = o' % (h, n, k),
+        '%s = o' % v]
+
+
+# Source for a stereo pass with a negative term, which uses a<n>_0 and b<n>_0
+
+def fused_cross_pass_source(n, term) :
+    if (term == -1) :
+        body = fused_cross_source(n, 'A', 'l', 'a%d_0' % n)
+        body += fused_cross_source(n, 'B', 'r', 'l')
+        body.append('a%d_0 = r' % n)
+    elif (term == -2) :
+        body = fused_cross_source(n, 'B', 'r', 'b%d_0' % n)
+        body += fused_cross_source(n, 'A', 'l', 'r')
+        body.append('b%d_0 = l' % n)
+    else :
+        body = ['s = a%d_0' % n, 'a%d_0 = b%d_0' % (n, n)]
+        body += fused_cross_source(n, 'A', 'l', 's')
+        body += fused_cross_source(n, 'B', 'r', 'a%d_0' % n)
+        body.append('b%d_0 = l' % n)
+        body.append('a%d_0 = r' % n)
 
-            mybuffer[bptr_counter] = dpp.samples_A[k];
-            m = (m + 1) & (MAX_TERM - 1);
-            k = (k + 1) & (MAX_TERM - 1);
+    return body
 
-        if (m != 0) :
-            temp_samples = [0] * MAX_TERM
 
-            for tmpiter in range(0,MAX_TERM) :
-                temp_samples[tmpiter] = dpp.samples_A[tmpiter]
+# Source for one channel of a pass with a negative term, where "v" is
+# predicted from the value "s" of the other channel, and the weight is
+# limited to +/-1024.
 
-            for k in range(0,MAX_TERM) :
-                dpp.samples_A[k] = temp_samples[m & (MAX_TERM - 1)]
-                m = m + 1
+def fused_cross_source(n, channel, v, s) :
+    w = 'w%s%d' % (channel, n)
 
-    dpp.weight_A =  weight_A
+    return ['o = %s + ((%s * %s + 512) >> 10)' % (v, w, s),
+        'if (%s != 0 and %s != 0) :' % (s, v),
+        '    if ((%s ^ %s) < 0) :' % (s, v),
+        '        %s -= d%d' % (w, n),
+        '        if (%s < -1024) :' % w,
+        '            %s = -1024' % w,
+        '    else :',
+        '        %s += d%d' % (w, n),
+        '        if (%s > 1024) :' % w,
+        '            %s = 1024' % w,
+        '%s = o' % v]
 
 
 # This is a helper function for unpack_samples() that applies several final
@@ -2206,9 +3443,11 @@ def decorr_mono_pass(dpp, mybuffer, sample_count,  buf_idx) :
 # Otherwise, if the extended integer data applies, then that operation is
 # executed first. If the unpacked data is lossy (and not corrected) then
 # it is clipped and shifted in a single operation. Otherwise, if it's
-# lossless then the last step is to apply the final shift (if any).
+# lossless then the last step is to apply the final shift (if any). With
+# "float_bits" float data is converted by float_bits_values() instead, and
+# that really is the last step, as the values are no longer integers.
 
-def fixup_samples( wps, mybuffer, sample_count) :
+def fixup_samples( wps, mybuffer, sample_count, buf_idx, float_bits = FALSE) :
     flags = wps.wphdr.flags
     shift = (flags & SHIFT_MASK) >> SHIFT_LSB
 
@@ -2220,7 +3459,10 @@ def fixup_samples( wps, mybuffer, sample_count) :
         else :
             sc = sample_count * 2
 
-        mybuffer = float_values(wps, mybuffer, sc)
+        if (float_bits) :
+            return float_bits_values(wps, mybuffer, sc, buf_idx)
+
+        mybuffer = float_values(wps, mybuffer, sc, buf_idx)
 
     if ((flags & INT32_DATA) > 0) :
 
@@ -2228,7 +3470,7 @@ def fixup_samples( wps, mybuffer, sample_count) :
         zeros = wps.int32_zeros;
         ones = wps.int32_ones
         dups = wps.int32_dups
-        buffer_counter = 0
+        buffer_counter = buf_idx
         count = 0
 
         if ((flags & MONO_FLAG) > 0) :
@@ -2258,33 +3500,11 @@ def fixup_samples( wps, mybuffer, sample_count) :
         max_value = 0
         min_shifted = 0
         max_shifted = 0
-        buffer_counter = 0
+        buffer_counter = buf_idx
 
-        try :
-            switch (flags & BYTES_STORED)
-        except case(0) :
-            min_value = -128
-            min_shifted = (min_value >> shift) << shift
-            max_value = 127
-            max_shifted = (max_value >> shift) << shift
-
-        except case (1):
-            min_value = -32768
-            min_shifted = (min_value >> shift) << shift
-            max_value = 32767
-            max_shifted = (max_value >> shift) << shift
-
-        except case (2) :
-            min_value = -8388608
-            min_shifted = (min_value >> shift) << shift
-            max_value = 8388607
-            max_shifted = (max_value >> shift) << shift
-
-        except :
-            min_value = 0x80000000
-            min_shifted = (min_value >> shift) << shift
-            max_value = 0x7FFFFFFF
-            max_shifted = (max_value >> shift) << shift
+        min_value, max_value = hybrid_limits[flags & BYTES_STORED]
+        min_shifted = (min_value >> shift) << shift
+        max_shifted = (max_value >> shift) << shift
 
         if ((flags & MONO_FLAG) == 0) :
             sample_count *= 2
@@ -2303,7 +3523,7 @@ def fixup_samples( wps, mybuffer, sample_count) :
             sample_count = sample_count - 1
 
     elif (shift != 0) :
-        buffer_counter = 0;
+        buffer_counter = buf_idx;
 
         if ((flags & MONO_FLAG) == 0) :
             sample_count *= 2;
@@ -2316,17 +3536,282 @@ def fixup_samples( wps, mybuffer, sample_count) :
     return mybuffer
 
 
+# The same as the end of unpack_samples() from the joint stereo on, with
+# NumPy: the "sample_count" samples at "buf_idx" (of which get_words() gave
+# "i") are decoded into 64-bit ints once, checked, fixed up and, for false
+# stereo, duplicated as whole arrays, and put back in "mybuffer" in one go,
+# or assigned to the NumPy array "out" at "out_idx" if one is given.
+# Returns the number of samples unpacked, or -1 (with nothing changed) if
+# the values could be too large for 64 bits, when the list code is used.
+
+def finish_samples_numpy(wpc, mybuffer, sample_count, buf_idx, i, mute_limit, out = None, out_idx = 0) :
+    wps = wpc.stream
+    flags = wps.wphdr.flags
+
+    if ((flags & (MONO_FLAG | FALSE_STEREO)) > 0) :
+        step = 1
+    else :
+        step = 2
+
+    count = sample_count * step
+
+    if (fixup_bits(wps, mute_limit) > 62) :
+        return -1
+
+    try :
+        data = numpy.array(mybuffer[buf_idx:buf_idx + count], numpy.int64)
+    except OverflowError :
+        return -1
+
+    if (count > 0 and (data.max() > NUMPY_VALUE_LIMIT or data.min() < -NUMPY_VALUE_LIMIT)) :
+        return -1
+
+    if (step == 2 and (flags & JOINT_STEREO) > 0) :
+        right = data[1::2] - (data[0::2] >> 1)
+        data[0::2] += right
+        data[1::2] = right
+
+    samples_checked = check_samples(wpc, data, 0, count, step, mute_limit)
+
+    if (samples_checked != sample_count) :
+        i = samples_checked
+
+    if (i != sample_count) :
+        data[:] = 0
+        wps.mute_error = 1
+        i = sample_count
+
+    data = fixup_samples_numpy(wps, data, wpc.float_bits)
+
+    if ((flags & FALSE_STEREO) > 0) :
+        data = numpy.repeat(data, 2)
+
+    if (out is not None) :
+        out[out_idx:out_idx + len(data)] = data
+    else :
+        mybuffer[buf_idx:buf_idx + len(data)] = data.tolist()
+
+    return i
+
+
+# Return the number of bits that the values of the current block can need
+# while fixup_samples() works on them, once they have passed the mute limit
+
+def fixup_bits(wps, mute_limit) :
+    flags = wps.wphdr.flags
+    shift = (flags & SHIFT_MASK) >> SHIFT_LSB
+    bits = mute_limit.bit_length() + 1
+
+    if ((flags & FLOAT_DATA) > 0) :
+        bits += max(wps.float_max_exp - wps.float_norm_exp + wps.float_shift, wps.float_shift, 0)
+
+        if (bits <= 62) :
+            bits = 24
+
+    if ((flags & INT32_DATA) > 0) :
+        if ((flags & HYBRID_FLAG) == 0 and wps.int32_sent_bits == 0) :
+            bits += wps.int32_zeros + wps.int32_ones + wps.int32_dups + 1
+        else :
+            shift += wps.int32_zeros + wps.int32_sent_bits + wps.int32_ones + wps.int32_dups
+
+    return max(bits, 33) + shift
+
+
+# fixup_samples() for the NumPy array of 64-bit ints "data", which holds
+# all the values of the samples. Returns the array of fixed up values.
+
+def fixup_samples_numpy(wps, data, float_bits = FALSE) :
+    flags = wps.wphdr.flags
+    shift = (flags & SHIFT_MASK) >> SHIFT_LSB
+
+    if ((flags & FLOAT_DATA) > 0 and float_bits) :
+        return float_bits_numpy(wps, data)
+
+    if ((flags & FLOAT_DATA) > 0) :
+        float_shift = wps.float_max_exp - wps.float_norm_exp + wps.float_shift
+
+        if (float_shift > 32) :
+            float_shift = 32
+        elif (float_shift < -32) :
+            float_shift = -32
+
+        if (float_shift > 0) :
+            data <<= float_shift
+        elif (float_shift < 0) :
+            data >>= -float_shift
+
+        data = numpy.clip(data, -8388608, 8388607)
+
+    if ((flags & INT32_DATA) > 0) :
+        sent_bits = wps.int32_sent_bits
+        zeros = wps.int32_zeros
+        ones = wps.int32_ones
+        dups = wps.int32_dups
+
+        if ((flags & HYBRID_FLAG) == 0 and sent_bits == 0 and (zeros + ones + dups) != 0) :
+            if (zeros != 0) :
+                data <<= zeros
+            elif (ones != 0) :
+                data = ((data + 1) << ones) - 1
+            else :
+                odd = data & 1
+                data = ((data + odd) << dups) - odd
+        else :
+            shift += zeros + sent_bits + ones + dups
+
+    if ((flags & HYBRID_FLAG) > 0) :
+        min_value, max_value = hybrid_limits[flags & BYTES_STORED]
+        min_shifted = (min_value >> shift) << shift
+        max_shifted = (max_value >> shift) << shift
+
+        data = numpy.where(data < min_value, min_shifted,
+            numpy.where(data > max_value, max_shifted, data << shift))
+
+    elif (shift != 0) :
+        data <<= shift
+
+    return data
+
+
+# float_bits_values() for the NumPy array of 64-bit ints "data". The number
+# of places each value is shifted to bring its top bit up to bit 23 comes
+# from the length of its bits below bit 23 (as given by frexp()), and is
+# limited by the exponent, which can't go below 0 (as for denormals).
+
+def float_bits_numpy(wps, data) :
+    data = data << wps.float_shift
+    sign = numpy.where(data < 0, 0x80000000, 0)
+    value = numpy.abs(data)
+    mantissa = value & 0x7fffff
+    exp = wps.float_max_exp
+
+    # only the bits below bit 23 end up in the mantissa, and once they are
+    # all shifted past it (or there are none) shifting further changes
+    # nothing, so the shifts are limited to keep them in 64 bits
+
+    if (exp > 0) :
+        low_bits = numpy.frexp(mantissa.astype(numpy.float64))[1].astype(numpy.int64)
+        needed = numpy.where((value & 0x800000) != 0, 0, numpy.where(low_bits > 0, 24 - low_bits, 256))
+        shift_count = numpy.minimum(numpy.minimum(needed, exp - 1), 24)
+        exps = numpy.where(needed <= exp - 1, exp - needed, 0)
+        mantissa = mantissa << shift_count
+
+        if ((wps.float_flags & FLOAT_SHIFT_ONES) != 0) :
+            mantissa |= (1 << shift_count) - 1
+    else :
+        exps = 0
+
+    outval = sign | (mantissa & 0x7fffff) | ((exps & 0xff) << 23)
+    outval = numpy.where(value == 0x1000000, sign | (255 << 23), outval)
+    outval = numpy.where(data == 0, 0, outval)
+
+    return numpy.where(outval >= 0x80000000, outval - 0x100000000, outval)
+
+
+# Check the "count" values starting at "start" in "values" (taken after
+# decorrelation and joint stereo) against the mute limit, and then, depending
+# on the crc mode of the context, either add the values that passed to the
+# block's crc or save them for check_crc_error(). "step" is the number of
+# values in each complete sample. Returns the number of complete samples
+# that passed.
+
+def check_samples(wpc, values, start, count, step, mute_limit) :
+    wps = wpc.stream
+    data = None
+
+    if (numpy is not None) :
+        try :
+            data = numpy.array(values[start:start + count], numpy.int64)
+        except OverflowError :
+            data = None     # only a corrupt block gets values this large
+
+    if (data is not None) :
+        muted = numpy.flatnonzero(numpy.abs(data) > mute_limit)
+
+        if (len(muted) > 0) :
+            count = (int(muted[0]) // step) * step
+    else :
+        data = values[start:start + count]
+
+        for q in range(0, count) :
+            if (data[q] > mute_limit or data[q] < -mute_limit) :
+                count = (q // step) * step
+                break
+
+    if (wps.crc_mode == CRC_STRICT) :
+        wps.crc = update_crc(wps.crc, data, count)
+    elif (wps.crc_mode == CRC_DEFERRED) :
+        wps.crc_values.append(data[0:count])
+
+    return count // step
+
+
+# Table of the powers of 3 (mod 2^32) used by update_crc(), extended as
+# longer runs of values are seen
+
+crc_powers = None
+
+def get_crc_powers(count) :
+    global crc_powers
+
+    if (crc_powers is None or len(crc_powers) < count) :
+        crc_powers = numpy.empty(max(count, 4096), numpy.uint64)
+        crc_powers[0] = 1
+        crc_powers[1:] = 3
+        crc_powers = numpy.cumprod(crc_powers) & 0xffffffff
+
+    return crc_powers
+
+
+# Add the first "count" values in "values" to the crc, which is calculated
+# as crc = crc * 3 + value for each value (to 32 bits). Because this is a
+# linear recurrence, with NumPy a whole run of values is added at once as
+# crc * 3^count plus the dot product of the values with descending powers
+# of 3, all mod 2^32 (unsigned 64-bit arithmetic wraps, which preserves the
+# low 32 bits).
+
+def update_crc(crc, values, count) :
+    if (count == 0) :
+        return crc
+
+    if (numpy is not None) :
+        powers = get_crc_powers(count + 1)
+        data = numpy.asarray(values[0:count], numpy.int64).astype(numpy.uint64)
+        total = int((data * powers[count - 1::-1]).sum())
+
+        return (crc * int(powers[count]) + total) & 0xffffffff
+
+    for q in range(0, count) :
+        crc = ((crc * 3) + values[q]) & 0xffffffff
+
+    return crc
+
+
 # This function checks the crc value(s) for an unpacked block, returning the
 # number of actual crc errors detected for the block. The block must be
 # completely unpacked before this test is valid. For losslessly unpacked
 # blocks of float or extended integer data the extended crc is also checked.
 # Note that WavPack's crc is not a CCITT approved polynomial algorithm, but
 # is a much simpler method that is virtually as robust for real world data.
+# With CRC_DEFERRED the block's saved values are added to the crc here in
+# one pass, and with CRC_DISABLED no errors are ever reported.
 
 def check_crc_error(wpc) :
     wps = wpc.stream;
     result = 0;
 
+    if (wps.crc_mode == CRC_DISABLED) :
+        return result
+
+    if (wps.crc_mode == CRC_DEFERRED) :
+        if (numpy is not None and len(wps.crc_values) > 1) :
+            wps.crc_values = [numpy.concatenate(wps.crc_values)]
+
+        for values in wps.crc_values :
+            wps.crc = update_crc(wps.crc, values, len(values))
+
+        wps.crc_values = []
+
     if (wps.crc != wps.wphdr.crc) :
         result = result + 1
 
@@ -2338,13 +3823,13 @@ def check_crc_error(wpc) :
 # exactly correct then we flag and return an error.
 
 def read_entropy_vars(wps, wpmd) :
-    byteptr = wpmd.data # byteptr needs to be unsigned chars, so convert to int array
+    byteptr = struct.unpack_from('<%dB' % wpmd.byte_length, wpmd.data)
     b_array = [0] * 12
     i = 0;
     w = words_data()
 
     for i in range(0,6) :
-        b_array[i] = ord(byteptr[i]) & 0xff
+        b_array[i] = byteptr[i] & 0xff
 
     w.holding_one = 0;
     w.holding_zero = 0;
@@ -2359,7 +3844,7 @@ def read_entropy_vars(wps, wpmd) :
 
     if ((wps.wphdr.flags & (MONO_FLAG | FALSE_STEREO)) == 0) :
         for i in range(6,12) :
-            b_array[i] = ord(byteptr[i]) & 0xff
+            b_array[i] = byteptr[i] & 0xff
 
         w.c[1].median[0] = exp2s(b_array[6] + (b_array[7] << 8));
         w.c[1].median[1] = exp2s(b_array[8] + (b_array[9] << 8));
@@ -2376,49 +3861,49 @@ def read_entropy_vars(wps, wpmd) :
 # we know what to do with.
 
 def read_hybrid_profile(wps, wpmd) :
-    byteptr = wpmd.data
+    byteptr = struct.unpack_from('<%dB' % wpmd.byte_length, wpmd.data)
     bytecnt = wpmd.byte_length
     buffer_counter = 0
     uns_buf = 0
     uns_buf_plusone = 0
 
     if ((wps.wphdr.flags & HYBRID_BITRATE) != 0) :
-        uns_buf = ord(byteptr[buffer_counter]) & 0xff
-        uns_buf_plusone =  ord(byteptr[buffer_counter + 1]) & 0xff
+        uns_buf = byteptr[buffer_counter] & 0xff
+        uns_buf_plusone =  byteptr[buffer_counter + 1] & 0xff
 
         wps.w.c[0].slow_level = exp2s(uns_buf + (uns_buf_plusone << 8))
         buffer_counter = buffer_counter + 2;
 
         if ((wps.wphdr.flags & (MONO_FLAG | FALSE_STEREO)) == 0) :
-            uns_buf = ord(byteptr[buffer_counter]) & 0xff
-            uns_buf_plusone = ord(byteptr[buffer_counter + 1]) & 0xff
+            uns_buf = byteptr[buffer_counter] & 0xff
+            uns_buf_plusone = byteptr[buffer_counter + 1] & 0xff
             wps.w.c[1].slow_level = exp2s(uns_buf + (uns_buf_plusone << 8))
             buffer_counter = buffer_counter + 2
 
 
-    uns_buf = ord(byteptr[buffer_counter]) & 0xff
-    uns_buf_plusone = ord(byteptr[buffer_counter + 1]) & 0xff
+    uns_buf = byteptr[buffer_counter] & 0xff
+    uns_buf_plusone = byteptr[buffer_counter + 1] & 0xff
 
     wps.w.bitrate_acc[0] = (uns_buf + (uns_buf_plusone << 8)) << 16
     buffer_counter = buffer_counter + 2
 
     if ((wps.wphdr.flags & (MONO_FLAG | FALSE_STEREO)) == 0) :
-        uns_buf = ord(byteptr[buffer_counter]) & 0xff
-        uns_buf_plusone = ord(byteptr[buffer_counter + 1]) & 0xff
+        uns_buf = byteptr[buffer_counter] & 0xff
+        uns_buf_plusone = byteptr[buffer_counter + 1] & 0xff
 
         wps.w.bitrate_acc[1] =(uns_buf + (uns_buf_plusone << 8)) << 16
         buffer_counter = buffer_counter + 2
 
     if (buffer_counter < bytecnt) :
-        uns_buf = ord(byteptr[buffer_counter]) & 0xff
-        uns_buf_plusone = ord(byteptr[buffer_counter + 1]) & 0xff
+        uns_buf = byteptr[buffer_counter] & 0xff
+        uns_buf_plusone = byteptr[buffer_counter + 1] & 0xff
 
         wps.w.bitrate_delta[0] = exp2s((uns_buf + (uns_buf_plusone << 8)))
         buffer_counter = buffer_counter + 2;
 
         if ((wps.wphdr.flags & (MONO_FLAG | FALSE_STEREO)) == 0) :
-            uns_buf = ord(byteptr[buffer_counter]) & 0xff
-            uns_buf_plusone = ord(byteptr[buffer_counter + 1]) & 0xff
+            uns_buf = byteptr[buffer_counter] & 0xff
+            uns_buf_plusone = byteptr[buffer_counter + 1] & 0xff
             wps.w.bitrate_delta[1] = exp2s((uns_buf + (uns_buf_plusone << 8)))
             buffer_counter = buffer_counter + 2
 
@@ -2491,6 +3976,18 @@ def update_error_limit(w, flags) :
     return w
 
 
+# Return "slow_level" after "count" zeros. Each zero takes away 1/256th of
+# it (rounded) until the level is small enough not to change any more, so
+# a long run only costs as many steps as it takes to get there.
+
+def decay_slow_level(slow_level, count) :
+    while (count > 0 and ((slow_level + SLO) >> SLS) != 0) :
+        slow_level -= (slow_level + SLO) >> SLS
+        count -= 1
+
+    return slow_level
+
+
 # Read the next word from the bitstream "wvbits" and return the value. This
 # function can be used for hybrid or lossless streams, but since an
 # optimized version is available for lossless this function would normally
@@ -2499,285 +3996,264 @@ def update_error_limit(w, flags) :
 # of WORD_EOF indicates that the end of the bitstream was reached (all 1s) or
 # some other error occurred.
 
-def get_words(nsamples, flags, w, bs, buffer) :
+def get_words(nsamples, flags, w, bs, buffer, buf_idx) :
     c = w.c;
-    csamples = 0
-    buffer_counter = 0;
+    csamples = buf_idx
     entidx = 1;
+    mono = (flags & (MONO_FLAG | FALSE_STEREO)) != 0
+    hybrid = (flags & HYBRID_FLAG) != 0
+    hybrid_bitrate = (flags & HYBRID_BITRATE) != 0
 
-    if ((flags & (MONO_FLAG | FALSE_STEREO)) == 0) : # if not mono
+    if (not mono) :
         nsamples *= 2;
     else :
-        # it is mono
         entidx = 0;
 
-    for csamples in range(0, nsamples) :
+    # the values are written from "buf_idx" on, which is even for stereo so
+    # that the channel of each value still follows from csamples & 1
 
-        ones_count = 0
-        low = 0
-        mid = 0
-        high = 0
+    nsamples += buf_idx
 
-        if ((flags & (MONO_FLAG | FALSE_STEREO)) == 0) : # if not mono
+    # the bit window and the holding state are kept in locals here and only
+    # written back around the calls that need them. The window is refilled
+    # in one place, at the start of each word's bits, to hold WORD_BITS,
+    # which covers the longest word read without going through "bs".
+
+    sr = bs.sr
+    bc = bs.bc
+    words = bs.words
+    word_index = bs.word_index
+    num_words = len(words)
+    holding_one = w.holding_one
+    holding_zero = w.holding_zero
+    median_0 = c[0].median
+    median_1 = c[1].median
+
+    while (csamples < nsamples) :
+
+        if (not mono) :
             entidx = 1 - entidx
 
-        if ((w.c[0].median[0] & ~1) == 0 and w.holding_zero == 0 and w.holding_one == 0
-            and (w.c[1].median[0] & ~1) == 0) :
+        ed = c[entidx]
+        median = ed.median
 
-            mask = 0
-            cbits = 0
+        if ((median_0[0] & ~1) == 0 and holding_zero == 0 and holding_one == 0
+            and (median_1[0] & ~1) == 0) :
 
             if (w.zeros_acc > 0) :
-                w.zeros_acc = w.zeros_acc - 1
-
-                if (w.zeros_acc > 0) :
-                    c[entidx].slow_level -= (c[entidx].slow_level + SLO) >> SLS;
-                    buffer[buffer_counter] = 0;
-                    buffer_counter = buffer_counter + 1
-                    continue;
+                zeros = w.zeros_acc - 1
             else :
-                # section called by mono code
-                cbits = 0;
-                bs = getbit(bs);
+                bs.sr = sr
+                bs.bc = bc
+                bs.word_index = word_index
+                cbits = bs_unary(bs, 33)
 
-                while (cbits < 33 and bs.bitval > 0) :
-                    cbits = cbits + 1
-                    bs = getbit(bs)
+                if (cbits < 2) :
+                    w.zeros_acc = cbits
+                elif (cbits < 33) :
+                    w.zeros_acc = bs_getbits(bs, cbits - 1) | (1 << (cbits - 1))
+
+                sr = bs.sr
+                bc = bs.bc
+                word_index = bs.word_index
 
                 if (cbits == 33) :
                     break;
 
-                if (cbits < 2) :
-                    w.zeros_acc = cbits
-                else :
+                zeros = w.zeros_acc
 
-                    cbits = cbits - 1
-                    
-                    mask = 1
-                    w.zeros_acc = 0
-                    
-                    while cbits > 0 :
-                        bs = getbit(bs);
-
-                        if (bs.bitval > 0) :
-                            w.zeros_acc |= mask;
-                        mask <<= 1
-                        cbits = cbits - 1
-
-                    w.zeros_acc |= mask;
-
-                if (w.zeros_acc > 0) :
-                    c[entidx].slow_level -= (c[entidx].slow_level + SLO) >> SLS;
-                    w.c[0].median[0] = 0;
-                    w.c[0].median[1] = 0;
-                    w.c[0].median[2] = 0;
-                    w.c[1].median[0] = 0;
-                    w.c[1].median[1] = 0;
-                    w.c[1].median[2] = 0;
-
-                    buffer[buffer_counter] = 0;
-                    buffer_counter = buffer_counter + 1
-                    continue;
-
-        if (w.holding_zero > 0) :
-            ones_count = w.holding_zero = 0;
-        else :
-            next8 = 0
-            uns_buf = 0
+                if (zeros > 0) :
+                    median_0[0] = 0;
+                    median_0[1] = 0;
+                    median_0[2] = 0;
+                    median_1[0] = 0;
+                    median_1[1] = 0;
+                    median_1[2] = 0;
 
-            if (bs.bc < 8) :
+            # "zeros" values from this one on are zeros, and nothing that
+            # decides whether they are changes during the run, so as many
+            # as fit are written at once. zeros_acc is left as it would be
+            # after writing them one at a time.
 
-                bs.ptr = bs.ptr + 1
-                bs.buf_index = bs.buf_index + 1
+            if (zeros > 0) :
+                count = min(zeros, nsamples - csamples)
+                buffer[csamples:csamples + count] = [0] * count
+                w.zeros_acc = zeros - count + 1
 
-                if (bs.ptr == bs.end) :
-                    bs = bs_read(bs);
+                if (mono) :
+                    ed.slow_level = decay_slow_level(ed.slow_level, count)
+                else :
+                    ed.slow_level = decay_slow_level(ed.slow_level, (count + 1) >> 1)
+                    ed = c[1 - entidx]
+                    ed.slow_level = decay_slow_level(ed.slow_level, count >> 1)
 
-                uns_buf = ord(bs.buf[bs.buf_index]) & 0xff
+                    if ((count & 1) == 0) :
+                        entidx = 1 - entidx
 
-                bs.sr = bs.sr | (uns_buf << bs.bc); # values in buffer must be unsigned
+                csamples += count
+                continue;
 
-                next8 =  bs.sr & 0xff
+            w.zeros_acc = 0
 
-                bs.bc += 8;
+        while (bc < WORD_BITS) :
+            if (word_index < num_words) :
+                sr |= words[word_index] << bc
+                word_index += 1
             else :
-                next8 =  bs.sr & 0xff
+                sr |= 0xffffffff << bc
+                bs.error = 1
 
-            if (next8 == 0xff) :
+            bc += 32
 
-                bs.bc -= 8;
-                bs.sr >>= 8;
-
-                ones_count = 8;
-                bs = getbit(bs);
+        if (holding_zero > 0) :
+            ones_count = holding_zero = 0;
+        else :
+            # the usual case, a run of 1s that ends within the peek, takes
+            # one lookup that also applies and updates holding_one
 
-                while (ones_count < (LIMIT_ONES + 1) and bs.bitval > 0) :
-                    ones_count = ones_count + 1
-                    bs = getbit(bs)
-                
-                if (ones_count == (LIMIT_ONES + 1)) :
-                    break;
+            entry = unary_table[(holding_one << UNARY_PEEK_BITS) | (sr & UNARY_PEEK_MASK)]
 
-                if (ones_count == LIMIT_ONES) :
-                    mask = 0
+            if (entry != None) :
+                ones_count, used, holding_one = entry
+                sr >>= used
+                bc -= used
+            else :
+                bs.sr = sr >> UNARY_PEEK_BITS
+                bs.bc = bc - UNARY_PEEK_BITS
+                bs.word_index = word_index
 
-                    cbits = 0;
-                    bs = getbit(bs)
+                ones_count = UNARY_PEEK_BITS + bs_unary(bs, LIMIT_ONES + 1 - UNARY_PEEK_BITS)
+                cbits = 0
 
-                    while (cbits < 33 and bs.bitval > 0) :
-                        cbits = cbits + 1
-                        bs = getbit(bs)
-                    
-                    if (cbits == 33) :
-                        break;
+                if (ones_count == (LIMIT_ONES + 1)) :
+                    cbits = 33
+                elif (ones_count == LIMIT_ONES) :
+                    cbits = bs_unary(bs, 33)
 
                     if (cbits < 2) :
                         ones_count = cbits;
-                    else :
-                        mask = 1
-                        ones_count = 0
-                        
-                        # We decrement cbits before entering while condition. This is to reflect the preincrement that is used
-                        # in the Java version of the code
-
-                        cbits = cbits - 1
-                        
-                        while cbits > 0 :
-                            bs = getbit(bs)
+                    elif (cbits < 33) :
+                        ones_count = bs_getbits(bs, cbits - 1) | (1 << (cbits - 1))
 
-                            if (bs.bitval > 0) :
-                                ones_count |= mask
+                    ones_count += LIMIT_ONES;
 
-                            mask <<= 1
-                            cbits = cbits - 1
+                # the rest of the word is read from the window as usual
 
-                        
-                        ones_count |= mask;
+                while (bs.bc < WORD_BITS - UNARY_PEEK_BITS) :
+                    bs_fill(bs)
 
-                    ones_count += LIMIT_ONES;
+                sr = bs.sr
+                bc = bs.bc
+                word_index = bs.word_index
 
-            else :
-                ones_count = ones_count_table[next8]
-                bs.bc -= ones_count + 1;
-                bs.sr = bs.sr >> ones_count + 1; # needs to be unsigned
+                if (cbits == 33) :
+                    break;
 
-            if (w.holding_one > 0) :
-                w.holding_one = ones_count & 1;
-                ones_count = (ones_count >> 1) + 1;
-            else :
-                w.holding_one = ones_count & 1;
-                ones_count >>= 1;
+                if (holding_one > 0) :
+                    holding_one = ones_count & 1;
+                    ones_count = (ones_count >> 1) + 1;
+                else :
+                    holding_one = ones_count & 1;
+                    ones_count >>= 1;
 
-            w.holding_zero =  (~w.holding_one & 1);
+            holding_zero = (~holding_one & 1);
 
-        if ((flags & HYBRID_FLAG) > 0
-            and ((flags & (MONO_FLAG | FALSE_STEREO)) > 0 or (csamples & 1) == 0)) :
+        if (hybrid and (mono or (csamples & 1) == 0)) :
             w = update_error_limit(w, flags);
 
         if (ones_count == 0) :
             low = 0;
-            high = (((c[entidx].median[0]) >> 4) + 1) - 1;
-            c[entidx].median[0] -= (((c[entidx].median[0] + (DIV0 - 2)) / DIV0) * 2);
+            high = (((median[0]) >> 4) + 1) - 1;
+            median[0] -= (((median[0] + (DIV0 - 2)) // DIV0) * 2);
         else :
-            low = (((c[entidx].median[0]) >> 4) + 1);
+            low = (((median[0]) >> 4) + 1);
 
-            c[entidx].median[0] += ((c[entidx].median[0] + DIV0) / DIV0) * 5;
+            median[0] += ((median[0] + DIV0) // DIV0) * 5;
 
             if (ones_count == 1) :
-                high = low + (((c[entidx].median[1]) >> 4) + 1) - 1;
-                c[entidx].median[1] -= ((c[entidx].median[1] + (DIV1 - 2)) / DIV1) * 2;
+                high = low + (((median[1]) >> 4) + 1) - 1;
+                median[1] -= ((median[1] + (DIV1 - 2)) // DIV1) * 2;
             else :
-                low += (((c[entidx].median[1]) >> 4) + 1);
-                c[entidx].median[1] += ((c[entidx].median[1] + DIV1) / DIV1) * 5;
+                low += (((median[1]) >> 4) + 1);
+                median[1] += ((median[1] + DIV1) // DIV1) * 5;
 
                 if (ones_count == 2) :
-                    high = low + (((c[entidx].median[2]) >> 4) + 1) - 1;
-                    c[entidx].median[2] -= ((c[entidx].median[2] + (DIV2 - 2)) / DIV2) * 2;
+                    high = low + (((median[2]) >> 4) + 1) - 1;
+                    median[2] -= ((median[2] + (DIV2 - 2)) // DIV2) * 2;
                 else :
-                    low += (ones_count - 2) * (((c[entidx].median[2]) >> 4) + 1);
-                    high = low + (((c[entidx].median[2]) >> 4) + 1) - 1;
-                    c[entidx].median[2] += ((c[entidx].median[2] + DIV2) / DIV2) * 5;
+                    low += (ones_count - 2) * (((median[2]) >> 4) + 1);
+                    high = low + (((median[2]) >> 4) + 1) - 1;
+                    median[2] += ((median[2] + DIV2) // DIV2) * 5;
 
         mid = (high + low + 1) >> 1;
 
-        if (c[entidx].error_limit == 0) :
-            mid = read_code(bs, high - low)
-
-            mid = mid + low
-        else :
-            while (high - low > c[entidx].error_limit) :
-
-                bs = getbit(bs)
-
-                if (bs.bitval > 0) :
-                    low = mid
-                    mid = (high + (low) + 1) >> 1
-                else :
-                    high = mid -1
-                    mid = ((high) + low + 1) >> 1
-
+        # only a corrupt stream gets medians big enough to need more bits
+        # than WORD_BITS allows for
 
-        bs = getbit(bs);
-
-        if (bs.bitval > 0) :
-            buffer[buffer_counter] = ~mid
-        else :
-            buffer[buffer_counter] = mid
+        if (high - low > 0xffffffff) :
+            bs.error = 1
+            break;
 
-        buffer_counter = buffer_counter + 1
+        if (ed.error_limit == 0) :
+            maxcode = high - low
 
-        if ((flags & HYBRID_BITRATE) > 0) :
-            c[entidx].slow_level = c[entidx].slow_level - ((c[entidx].slow_level + SLO) >> SLS) + mylog2(mid)
+            # Read a value from 0 to maxcode. If there are exactly a power
+            # of two number of possible codes then this reads a fixed number
+            # of bits; otherwise it reads the minimum number of bits and then
+            # determines whether another bit is needed to define the code.
+            # The window holds at least the 32 bits this can need, so the
+            # code is masked straight out of it.
 
-    w.c = c
-    csamples =  csamples + 1
+            bitcount = maxcode.bit_length()
 
-    if ((flags & (MONO_FLAG | FALSE_STEREO)) != 0) :
-        return csamples;
-    else :
-        return (csamples / 2);
+            if (bitcount > 0) :
+                extras = (1 << bitcount) - maxcode - 1
+                code = sr & ((1 << (bitcount - 1)) - 1)
+                sr >>= bitcount - 1
+                bc -= bitcount - 1
 
+                if (code >= extras) :
+                    code = (code + code) - extras + (sr & 1)
+                    sr >>= 1
+                    bc -= 1
 
-def count_bits(av) :
-    if (av < (1 << 8)) :
-        return nbits_table[av]
-    else :
-        if (av < (1 << 16)) :
-            return nbits_table[ (av >> 8)] + 8
-        else :
-            if (av < (1 << 24)) :
-                return nbits_table[ (av >> 16)] + 16
+                mid = code + low
             else :
-                return nbits_table[ (av >> 24)] + 24
-
-
-# Read a single unsigned value from the specified bitstream with a value
-# from 0 to maxcode. If there are exactly a power of two number of possible
-# codes then this will read a fixed number of bits; otherwise it reads the
-# minimum number of bits and then determines whether another bit is needed
-# to define the code.
-
-def read_code( bs, maxcode) :
-    bitcount = count_bits(maxcode);
-    extras = (1L << bitcount) - maxcode - 1
-    code = 0
+                mid = low
+        else :
+            while (high - low > ed.error_limit) :
+                if ((sr & 1) > 0) :
+                    low = mid
+                else :
+                    high = mid - 1
 
-    if (bitcount == 0) :
-        return (0)
+                sr >>= 1
+                bc -= 1
+                mid = (high + low + 1) >> 1
 
-    code = getbits(bitcount - 1, bs)
-    
-    code &= (1L << (bitcount - 1)) - 1
+        if ((sr & 1) > 0) :
+            buffer[csamples] = ~mid
+        else :
+            buffer[csamples] = mid
 
-    if (code >= extras) :
-        code = (code + code) - extras
+        sr >>= 1
+        bc -= 1
+        csamples = csamples + 1
 
-        bs = getbit(bs)
+        if (hybrid_bitrate) :
+            ed.slow_level = ed.slow_level - ((ed.slow_level + SLO) >> SLS) + mylog2(mid)
 
-        if (bs.bitval > 0) :
-            code = code + 1
+    bs.sr = sr
+    bs.bc = bc
+    bs.word_index = word_index
+    w.holding_one = holding_one
+    w.holding_zero = holding_zero
+    w.c = c
 
-    return (code)
+    if (mono) :
+        return csamples - buf_idx;
+    else :
+        return ((csamples - buf_idx) // 2);
 
 
 # The concept of a base 2 logarithm is used in many parts of WavPack. It is
@@ -2803,10 +4279,10 @@ def mylog2(avalue) :
         dbits = nbits_table[avalue]
         return (dbits << 8) + log2_table[(avalue << (9 - dbits)) & 0xff]
     else :
-        if (avalue < (1L << 16)) :
+        if (avalue < (1 << 16)) :
             dbits = nbits_table[(avalue >> 8)] + 8
 
-        elif (avalue < (1L << 24)) :
+        elif (avalue < (1 << 24)) :
             dbits = nbits_table[(avalue >> 16)] + 16
 
         else :
@@ -0,0 +1,203 @@
+"""
+** WavWriter.py
+**
+** RIFF WAV file writer for use with WavPack.py
+**
+** Copyright (c) 2007-2013 Peter McQuillan
+**
+** All Rights Reserved.
+**
+** Distributed under the BSD Software License (see license.txt)
+**
+"""
+
+import sys
+import struct
+from array import array
+
+# PCM data is collected until at least this many bytes are waiting and then
+# written to the file in one go
+
+WRITE_BUFFER_SIZE = 1048576
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_EXTENSIBLE = 0xfffe
+
+# RIFF header, fmt chunk and data chunk header, all little-endian
+
+WAV_HEADER_FORMAT = '<4sI4s4sIHHIIHH4sI'
+WAV_HEADER_SIZE = 44
+
+# the same with the WAVE_FORMAT_EXTENSIBLE fmt chunk, which is used for more
+# than two channels so that the speaker positions (the channel mask) can be
+# given
+
+WAV_EXT_HEADER_FORMAT = '<4sI4s4sIHHIIHHHHI16s4sI'
+WAV_EXT_HEADER_SIZE = 68
+
+KSDATAFORMAT_SUBTYPE_PCM = b'\x01\x00\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71'
+
+# largest data chunk that still fits in a RIFF file, used as the size of
+# streams whose length isn't known when the header is written
+
+MAX_DATA_BYTES = 0xffffffff - (WAV_EXT_HEADER_SIZE - 8)
+
+if array('i').itemsize == 4 :
+    INT32_TYPECODE = 'i'
+else :
+    INT32_TYPECODE = 'l'
+
+# table to move 8-bit samples from signed to the unsigned values WAV uses
+
+UNSIGNED_8BIT = bytes(bytearray([(i + 128) & 0xff for i in range(256)]))
+
+
+class WavWriterContext :
+    def __init__(self):
+        self.outfile = None
+        self.num_channels = 0
+        self.sample_rate = 0
+        self.bits_per_sample = 0
+        self.bytes_per_sample = 0
+        self.channel_mask = 0
+        self.declared_bytes = 0    # size of the data chunk given in the header
+        self.data_bytes = 0        # PCM bytes written so far
+        self.buffer = bytearray()
+        self.error = 0
+        self.error_message = ""
+
+
+# Return the contents of an array as little-endian bytes
+
+def array_to_bytes(samples) :
+    if (sys.byteorder == 'big') :
+        samples.byteswap()
+
+    if hasattr(samples, 'tobytes') :
+        return samples.tobytes()
+    else :
+        return samples.tostring()
+
+
+# Convert "count" values from the 32-bit ints in "src" into little-endian
+# PCM with the specified number of bytes per sample. The whole buffer is
+# converted at once through the array module instead of byte by byte.
+
+def format_samples(bps, src, count) :
+    if (bps == 1) :
+        return array_to_bytes(array('b', src[:count])).translate(UNSIGNED_8BIT)
+
+    if (bps == 2) :
+        return array_to_bytes(array('h', src[:count]))
+
+    data = array_to_bytes(array(INT32_TYPECODE, src[:count]))
+
+    if (bps == 3) :
+        data = bytearray(data)
+        del data[3::4]
+
+    return data
+
+
+def pack_header(wwc, data_bytes) :
+    block_align = wwc.num_channels * wwc.bytes_per_sample
+
+    if (wwc.num_channels > 2) :
+        return struct.pack(WAV_EXT_HEADER_FORMAT,
+            b'RIFF', data_bytes + WAV_EXT_HEADER_SIZE - 8, b'WAVE',
+            b'fmt ', 40, WAVE_FORMAT_EXTENSIBLE, wwc.num_channels, wwc.sample_rate,
+            wwc.sample_rate * block_align, block_align, wwc.bytes_per_sample * 8,
+            22, wwc.bits_per_sample, wwc.channel_mask, KSDATAFORMAT_SUBTYPE_PCM,
+            b'data', data_bytes)
+
+    return struct.pack(WAV_HEADER_FORMAT,
+        b'RIFF', data_bytes + WAV_HEADER_SIZE - 8, b'WAVE',
+        b'fmt ', 16, WAVE_FORMAT_PCM, wwc.num_channels, wwc.sample_rate,
+        wwc.sample_rate * block_align, block_align, wwc.bits_per_sample,
+        b'data', data_bytes)
+
+
+# Write the WAV header to "outfile" (opened for binary writing) and return
+# the context used for the other calls. If the number of samples isn't
+# known (-1) the header claims the largest possible size, and the real
+# sizes are filled in by WavCloseFileOutput() when the file is seekable.
+# "channel_mask" gives the speaker positions of the channels (as from
+# WavpackGetChannelMask()) and is only written for more than two channels.
+
+def WavOpenFileOutput(outfile, num_channels, sample_rate, bits_per_sample, bytes_per_sample, total_samples, channel_mask = 0) :
+    wwc = WavWriterContext()
+
+    wwc.outfile = outfile
+    wwc.num_channels = num_channels
+    wwc.bytes_per_sample = bytes_per_sample
+    wwc.sample_rate = sample_rate
+    wwc.bits_per_sample = bits_per_sample
+    wwc.channel_mask = channel_mask
+
+    if (total_samples < 0 or total_samples * num_channels * bytes_per_sample > MAX_DATA_BYTES) :
+        wwc.declared_bytes = MAX_DATA_BYTES
+    else :
+        wwc.declared_bytes = total_samples * num_channels * bytes_per_sample
+
+    try :
+        outfile.write(pack_header(wwc, wwc.declared_bytes))
+    except IOError :
+        wwc.error = 1
+        wwc.error_message = "can't write WAV header!"
+
+    return wwc
+
+
+# Add "sample_count" complete samples (that is, sample_count * num_channels
+# values as returned by WavpackUnpackSamples()) from "buffer", which may be
+# a list or an array of ints. Returns false if writing to the file failed.
+
+def WavWriteSamples(wwc, buffer, sample_count) :
+    return WavWriteBytes(wwc, format_samples(wwc.bytes_per_sample, buffer, sample_count * wwc.num_channels))
+
+
+# Add PCM data that is already in the file's format (as returned by
+# format_samples()). Returns false if writing to the file failed.
+
+def WavWriteBytes(wwc, data) :
+    wwc.buffer += data
+
+    if (len(wwc.buffer) >= WRITE_BUFFER_SIZE) :
+        flush_buffer(wwc)
+
+    return (wwc.error == 0)
+
+
+def flush_buffer(wwc) :
+    if (len(wwc.buffer) > 0) :
+        try :
+            wwc.outfile.write(wwc.buffer)
+        except IOError :
+            wwc.error = 1
+            wwc.error_message = "can't write WAV data!"
+
+        wwc.data_bytes += len(wwc.buffer)
+        wwc.buffer = bytearray()
+
+
+# Write out any buffered data and, if the amount of data written doesn't
+# match the header, go back and correct the sizes in it. The file object
+# itself is left open for the caller to close. Returns false on error.
+
+def WavCloseFileOutput(wwc) :
+    flush_buffer(wwc)
+
+    if (wwc.error == 0 and wwc.data_bytes != wwc.declared_bytes) :
+        try :
+            position = wwc.outfile.tell()
+            wwc.outfile.seek(0)
+            wwc.outfile.write(pack_header(wwc, wwc.data_bytes))
+            wwc.outfile.seek(position)
+            wwc.declared_bytes = wwc.data_bytes
+        except (IOError, OSError) :
+            # a stream of unknown length going to a pipe keeps the largest size
+            if (wwc.declared_bytes != MAX_DATA_BYTES) :
+                wwc.error = 1
+                wwc.error_message = "can't update WAV header sizes!"
+
+    return (wwc.error == 0)
@@ -0,0 +1,189 @@
+"""
+** WvAsync.py
+**
+** Decoding of WavPack streams with asyncio (Python 3.7 or later)
+**
+** Copyright (c) 2007-2013 Peter McQuillan
+**
+** All Rights Reserved.
+**
+** Distributed under the BSD Software License (see license.txt)
+**
+"""
+
+import asyncio
+import concurrent.futures
+import WavPack
+
+# number of bytes asked for in each read from the stream
+
+READ_SIZE = 65536
+
+# process pool used by decode_stream() when no executor is given, shared by
+# all the streams in the process and started on first use
+
+default_executor = None
+
+
+def get_default_executor() :
+    global default_executor
+
+    if (default_executor == None) :
+        default_executor = concurrent.futures.ProcessPoolExecutor()
+
+    return default_executor
+
+
+# Asynchronous generator decoding the WavPack data read from "reader" (an
+# asyncio.StreamReader, or anything with an async read(n) method), yielding
+# (start_sample, samples) tuples in the same form as WavpackIterBlocks(),
+# e.g.
+#
+#     async for start_sample, samples in decode_stream(reader) :
+#
+# Only reading and splitting the data into blocks happens on the event
+# loop. Each group of blocks holding the same samples is decoded on its own
+# by unpack_block_group() in "executor", which should be a
+# concurrent.futures.ProcessPoolExecutor: the decoding is pure Python and
+# holds the GIL, so threads would just take turns with the loop. If no
+# executor is given a process pool shared by all the streams is used, and
+# passing one pool to all the streams sets how many groups are decoded at
+# once across the process. Each stream has one group in the executor while
+# it reads the next one and doesn't read any further ahead of its caller,
+# so it holds about two blocks of data at a time. "wpc" is the context from
+# WavpackOpenDecoder() to use, which the caller can pass in to get the
+# stream information; it is valid once the first samples are yielded and
+# counts the crc errors. An IOError is raised if the stream doesn't contain
+# valid WavPack data.
+
+async def decode_stream(reader, executor = None, wpc = None, read_size = READ_SIZE) :
+    loop = asyncio.get_running_loop()
+
+    if (executor == None) :
+        executor = get_default_executor()
+
+    if (wpc == None) :
+        wpc = WavPack.WavpackOpenDecoder()
+
+    splitter = WavPack.WavpackOpenDecoder()    # only used to find the blocks
+    wphdr = WavPack.WavpackHeader()
+    group = None
+    ready = []
+    pending = None
+    more = WavPack.TRUE
+
+    while (more) :
+        data = await reader.read(read_size)
+
+        if (len(data) == 0) :
+            more = WavPack.FALSE
+        else :
+            splitter.input_buffer += data
+
+        # split what has been read into groups of blocks, each complete once
+        # its final block is there (or another group starts without it)
+
+        while (WavPack.read_block_header(splitter, wphdr) == WavPack.TRUE) :
+            block = WavPack.pack_wavpack_header(wphdr) + WavPack.read_block_body(splitter, wphdr).tobytes()
+
+            if (wphdr.block_samples > 0 and (wphdr.flags & WavPack.INITIAL_BLOCK) != 0) :
+                if (group != None) :
+                    ready.append(group)
+
+                group = (wphdr.block_index, wphdr.block_samples, [])
+
+            if (group == None) :
+                continue
+
+            group[2].append(block)
+
+            if ((wphdr.flags & WavPack.FINAL_BLOCK) != 0) :
+                ready.append(group)
+                group = None
+
+        if (splitter.error and not wpc.stream_started) :
+            raise IOError(splitter.error_message)
+
+        if (not more and group != None) :
+            ready.append(group)
+
+        for complete in ready :
+            if (pending != None) :
+                for result in await finish_group(wpc, pending) :
+                    yield result
+
+            pending = start_group(loop, executor, wpc, complete)
+
+        del ready[:]
+
+    if (pending != None) :
+        for result in await finish_group(wpc, pending) :
+            yield result
+
+    if (not wpc.stream_started) :
+        raise IOError("no WavPack audio found in stream!")
+
+
+# Send a complete group of blocks to the executor and return what
+# finish_group() needs to collect it. The first group is also opened in
+# "wpc" (just its metadata is parsed, nothing is decoded) to get the
+# stream information the workers need.
+
+def start_group(loop, executor, wpc, group) :
+    block_index, block_samples, blocks = group
+    data = b''.join(blocks)
+
+    if (not wpc.stream_started) :
+        wpc.input_buffer += data
+
+        if (WavPack.open_stream(wpc) == WavPack.FALSE) :
+            raise IOError(wpc.error_message or "invalid WavPack file!")
+
+        del wpc.input_buffer[:]
+        wpc.stream.sample_index = block_index
+
+    future = loop.run_in_executor(executor, WavPack.unpack_block_group, (data, wpc.crc_mode,
+        wpc.config.num_channels, wpc.config.channel_mask, wpc.channel_select))
+
+    return (block_index, block_samples, future)
+
+
+# Wait for a group sent by start_group() and return its (start_sample,
+# samples) tuples: silence for any gap before it, then its own samples,
+# which are silence too if it couldn't be decoded (as in
+# WavpackUnpackParallel()). The context's position and error counts are
+# kept up to date.
+
+async def finish_group(wpc, pending) :
+    block_index, block_samples, future = pending
+    wps = wpc.stream
+    num_channels = WavPack.WavpackGetReducedChannels(wpc)
+    results = []
+
+    try :
+        samples, crc_errors, lossy_blocks = await future
+    except Exception :
+        samples, crc_errors, lossy_blocks = None, 0, 0
+
+    if (samples == None or len(samples) != block_samples * num_channels) :
+        samples = [0] * (block_samples * num_channels)
+        crc_errors = crc_errors + 1
+    else :
+        samples = samples.tolist()
+
+    wpc.crc_errors += crc_errors
+
+    if (lossy_blocks) :
+        wpc.lossy_blocks = 1
+
+    if (wps.sample_index < block_index) :
+        results.append((wps.sample_index, [0] * ((block_index - wps.sample_index) * num_channels)))
+    elif (wps.sample_index > block_index) :
+        samples = samples[(wps.sample_index - block_index) * num_channels:]
+
+    if (len(samples) > 0) :
+        results.append((max(wps.sample_index, block_index), samples))
+
+    wps.sample_index = block_index + block_samples
+
+    return results
@@ -0,0 +1,234 @@
+"""
+** WvBatch.py
+**
+** Batch decoding of many WavPack files using a pool of worker processes
+**
+** Copyright (c) 2007-2013 Peter McQuillan
+**
+** All Rights Reserved.
+**
+** Distributed under the BSD Software License (see license.txt)
+**
+"""
+
+import sys
+import os
+import time
+import getopt
+import multiprocessing
+import WavPack
+import WavWriter
+
+# number of samples decoded per call to WavpackUnpackSamples() in the workers
+
+DECODE_CHUNK_SIZE = 4096
+
+
+# The outcome of decoding one file, passed to the sink. "data" is the audio
+# as little-endian PCM in the same format as a WAV file data chunk.
+
+class WvBatchResult :
+    def __init__(self):
+        self.path = ""
+        self.error = 0
+        self.error_message = ""
+        self.num_channels = 0
+        self.channel_mask = 0
+        self.sample_rate = 0
+        self.bits_per_sample = 0
+        self.bytes_per_sample = 0
+        self.num_samples = 0
+        self.crc_errors = 0
+        self.input_bytes = 0
+        self.data = b''
+
+class WvBatchStats :
+    def __init__(self):
+        self.files = 0
+        self.failed = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.seconds = 0.0
+
+
+# Decode the file at "path" in a worker process and return a WvBatchResult.
+# Anything that goes wrong, including crc errors, is reported in the result
+# so that one bad file doesn't stop the batch.
+
+def decode_file(path) :
+    result = WvBatchResult()
+    result.path = path
+
+    try :
+        infile = open(path, "rb")
+    except IOError :
+        result.error = 1
+        result.error_message = "can't open file!"
+        return result
+
+    try :
+        result.input_bytes = os.fstat(infile.fileno()).st_size
+
+        wpc = WavPack.WavpackOpenFileMmap(infile)
+
+        if (wpc.error) :
+            result.error = 1
+            result.error_message = wpc.error_message
+            return result
+
+        result.num_channels = WavPack.WavpackGetReducedChannels(wpc)
+        result.channel_mask = WavPack.WavpackGetChannelMask(wpc)
+        result.sample_rate = WavPack.WavpackGetSampleRate(wpc)
+        result.bits_per_sample = WavPack.WavpackGetBitsPerSample(wpc)
+        result.bytes_per_sample = WavPack.WavpackGetBytesPerSample(wpc)
+
+        buffer = [0] * (DECODE_CHUNK_SIZE * result.num_channels)
+        data = bytearray()
+
+        while (WavPack.TRUE) :
+            samples_unpacked = WavPack.WavpackUnpackSamples(wpc, buffer, DECODE_CHUNK_SIZE)
+
+            if (samples_unpacked == 0) :
+                break
+
+            data += WavWriter.format_samples(result.bytes_per_sample, buffer,
+                samples_unpacked * result.num_channels)
+            result.num_samples += samples_unpacked
+
+        result.data = bytes(data)
+        result.crc_errors = WavPack.WavpackGetNumErrors(wpc)
+
+        if (WavPack.WavpackGetNumSamples(wpc) != -1
+            and result.num_samples != WavPack.WavpackGetNumSamples(wpc)) :
+            result.error = 1
+            result.error_message = "incorrect number of samples!"
+        elif (result.crc_errors > 0) :
+            result.error = 1
+            result.error_message = "crc errors detected!"
+
+    except Exception as e :
+        result.error = 1
+        result.error_message = "decoding failed: " + repr(e)
+
+    finally :
+        infile.close()
+
+    return result
+
+
+# Decode all the files in "paths" using a pool of "workers" processes (the
+# default is one per CPU), or the already running multiprocessing pool
+# "pool", which can be kept warm between batches. Results are handed to
+# sink(result) in the order the files finish, not the order given. A sink
+# may set "error" on a result (if it couldn't write the output, say) to
+# have the file counted as failed. Returns the WvBatchStats for the batch.
+
+def WvDecodeMany(paths, sink = None, workers = 0, pool = None) :
+    stats = WvBatchStats()
+    start_time = time.time()
+    own_pool = (pool == None)
+
+    if (own_pool) :
+        if (workers <= 0) :
+            workers = multiprocessing.cpu_count()
+
+        pool = multiprocessing.Pool(workers)
+
+    try :
+        for result in pool.imap_unordered(decode_file, paths) :
+            if (sink != None) :
+                sink(result)
+
+            stats.files += 1
+            stats.input_bytes += result.input_bytes
+            stats.output_bytes += len(result.data)
+
+            if (result.error) :
+                stats.failed += 1
+
+    finally :
+        if (own_pool) :
+            pool.terminate()
+            pool.join()
+
+    stats.seconds = time.time() - start_time
+
+    return stats
+
+
+# Sink used by the command line: write each decoded file as a WAV file
+# with the same name in "output_dir" (or next to the WavPack file) and
+# report failures.
+
+class WavFileSink :
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+
+    def __call__(self, result):
+        if (result.error == 0) :
+            name = os.path.splitext(os.path.basename(result.path))[0] + ".wav"
+
+            if (self.output_dir != None) :
+                name = os.path.join(self.output_dir, name)
+            else :
+                name = os.path.join(os.path.dirname(result.path), name)
+
+            try :
+                outfile = open(name, "wb")
+
+                try :
+                    wwc = WavWriter.WavOpenFileOutput(outfile, result.num_channels, result.sample_rate,
+                        result.bits_per_sample, result.bytes_per_sample, result.num_samples,
+                        result.channel_mask)
+                    WavWriter.WavWriteBytes(wwc, result.data)
+
+                    if (not WavWriter.WavCloseFileOutput(wwc)) :
+                        result.error = 1
+                        result.error_message = wwc.error_message
+                finally :
+                    outfile.close()
+
+            except IOError :
+                result.error = 1
+                result.error_message = "can't write " + name + "!"
+
+        if (result.error) :
+            print(result.path + ": " + result.error_message)
+
+
+def usage() :
+    print("usage: python WvBatch.py [-j workers] [-o output_dir] file.wv ...")
+    sys.exit(1)
+
+
+# Start of main routine
+
+if __name__ == '__main__' :
+    try :
+        opts, args = getopt.getopt(sys.argv[1:], "j:o:")
+    except getopt.GetoptError :
+        usage()
+
+    workers = 0
+    output_dir = None
+
+    for opt, value in opts :
+        if (opt == "-j") :
+            workers = int(value)
+        elif (opt == "-o") :
+            output_dir = value
+
+    if (len(args) == 0) :
+        usage()
+
+    stats = WvDecodeMany(args, WavFileSink(output_dir), workers)
+    seconds = max(stats.seconds, 0.001)
+
+    print("Decoded " + str(stats.files) + " files (" + str(stats.failed) + " failed) in "
+        + ("%.2f" % stats.seconds) + " seconds")
+    print(("%.1f" % (stats.files / seconds)) + " files/sec, "
+        + ("%.2f" % (stats.input_bytes / seconds / 1048576.0)) + " MB/sec in, "
+        + ("%.2f" % (stats.output_bytes / seconds / 1048576.0)) + " MB/sec out")
+
+    if (stats.failed > 0) :
+        sys.exit(1)